@@ -1,11 +1,36 @@
 from flask import Flask
+from werkzeug.middleware.proxy_fix import ProxyFix
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 import os
 
-db = SQLAlchemy()
+from .replicas import RoutingSession, engine_options
+from .metrics import metrics
+
+# RoutingSession sends reads from @read_replica views to the replica bind, if one is configured.
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 login_manager = LoginManager() # Create the manager instance here
 
+from .event_loop import background_loop
+from .update_queue import update_queue
+from .outbound import outbound
+from .bot_clients import bot_clients
+from .tenants import tenant_cache
+from .catalog import catalog_cache
+from .nowpayments import nowpayments
+from .currencies import currency_cache
+from .ipn_consumer import ipn_consumer
+from .update_dedupe import update_dedupe
+from .conversations import conversations
+from .carts import cart_writer
+from .render_cache import render_cache
+from . import rollups  # Registers the order listeners that keep sales rollups current.
+from .principals import principal_cache
+from .passwords import login_throttle, password_hasher
+from .write_lane import write_lane
+from . import sqlite_profile
+from .replicas import replica_router
+
 def create_app():
     """
     This is the application factory. It creates and configures the Flask app.
@@ -19,17 +44,126 @@ def create_app():
     app.config['SECRET_KEY'] = os.environ.get('FLASK_SECRET_KEY', 'a-dev-secret-key')
     app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///../instance/bots.db')
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # Public base URL Telegram webhooks and NOWPayments IPNs are sent to; set it to the local
+    # app (e.g. http://127.0.0.1:5000) when running against app/nowpayments_stub.py.
+    app.config['SERVER_URL'] = os.environ.get('SERVER_URL', 'https://telegram-bot-creator.onrender.com').rstrip('/')
+    # Pool tuning per bind: DATABASE_POOL_SIZE, DATABASE_MAX_OVERFLOW, DATABASE_POOL_PRE_PING=1.
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options('DATABASE')
+    # Optional read replica for the heavy read-only views, tuned with the same DATABASE_REPLICA_* variables.
+    # Pre-ping defaults to on there, since replicas are more often restarted or failed over.
+    if os.environ.get('DATABASE_REPLICA_URL'):
+        app.config['SQLALCHEMY_BINDS'] = {
+            'replica': {'url': os.environ['DATABASE_REPLICA_URL'], **engine_options('DATABASE_REPLICA', pre_ping_default='1')}
+        }
+    # After a logged-in user writes, their reads stay on the primary this long (seconds).
+    app.config['REPLICA_STICKY_SECONDS'] = float(os.environ.get('REPLICA_STICKY_SECONDS', 5))
+    # Opt-in SQLite tuning (WAL, synchronous=NORMAL, busy timeout, larger caches); see app/sqlite_profile.py.
+    app.config['SQLITE_PERFORMANCE_PROFILE'] = os.environ.get('SQLITE_PERFORMANCE_PROFILE', '0') == '1'
+    app.config['SQLITE_BUSY_TIMEOUT_MS'] = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000))
+    app.config['SQLITE_MMAP_SIZE'] = int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+    app.config['SQLITE_CACHE_SIZE_KB'] = int(os.environ.get('SQLITE_CACHE_SIZE_KB', 64 * 1024))
+    # Small writes (cart taps, update ids) are batched on one thread per worker; on with the profile
+    # and only available with it.
+    app.config['SQLITE_WRITE_LANE'] = os.environ.get(
+        'SQLITE_WRITE_LANE', '1' if app.config['SQLITE_PERFORMANCE_PROFILE'] else '0') == '1'
+    app.config['SQLITE_WRITE_BATCH'] = int(os.environ.get('SQLITE_WRITE_BATCH', 64))
+    # 'inline' handles Telegram updates inside the webhook request, 'queue' acks first
+    # and hands the update to the background worker pool.
+    app.config['TELEGRAM_DISPATCH_MODE'] = os.environ.get('TELEGRAM_DISPATCH_MODE', 'inline')
+    app.config['UPDATE_QUEUE_WORKERS'] = int(os.environ.get('UPDATE_QUEUE_WORKERS', 4))
+    app.config['UPDATE_QUEUE_MAXSIZE'] = int(os.environ.get('UPDATE_QUEUE_MAXSIZE', 1000))
+    # Threads per worker for the database work of update handlers, kept off the event loop.
+    app.config['BLOCKING_THREADS'] = int(os.environ.get('BLOCKING_THREADS', 8))
+    # Shared Telegram client pool: how many shops to keep warm and how many connections they share.
+    app.config['TELEGRAM_BOT_CACHE_SIZE'] = int(os.environ.get('TELEGRAM_BOT_CACHE_SIZE', 512))
+    app.config['TELEGRAM_POOL_SIZE'] = int(os.environ.get('TELEGRAM_POOL_SIZE', 32))
+    # Product listings: products per page and whether to send photos as albums.
+    app.config['PRODUCT_PAGE_SIZE'] = max(1, int(os.environ.get('PRODUCT_PAGE_SIZE', 5)))
+    app.config['PRODUCT_ALBUMS'] = os.environ.get('PRODUCT_ALBUMS', '0') == '1'
+    # Outbound rate limits (messages per second) for each bot, private chat and group chat.
+    app.config['TELEGRAM_BOT_RATE'] = float(os.environ.get('TELEGRAM_BOT_RATE', 30))
+    app.config['TELEGRAM_CHAT_RATE'] = float(os.environ.get('TELEGRAM_CHAT_RATE', 1))
+    app.config['TELEGRAM_GROUP_RATE'] = float(os.environ.get('TELEGRAM_GROUP_RATE', 20 / 60))
+    # Messages a chat can be sent back to back before its rate applies.
+    app.config['TELEGRAM_CHAT_BURST'] = int(os.environ.get('TELEGRAM_CHAT_BURST', 3))
+    app.config['NOWPAYMENTS_API_URL'] = os.environ.get('NOWPAYMENTS_API_URL', 'https://api.nowpayments.io')
+    app.config['NOWPAYMENTS_API_KEY'] = os.environ.get('NOWPAYMENTS_API_KEY')
+    app.config['NOWPAYMENTS_TIMEOUT'] = float(os.environ.get('NOWPAYMENTS_TIMEOUT', 10))
+    app.config['CURRENCY_CACHE_TTL'] = float(os.environ.get('CURRENCY_CACHE_TTL', 3600))
+    app.config['TENANT_CACHE_TTL'] = float(os.environ.get('TENANT_CACHE_TTL', 60))
+    app.config['TENANT_NEGATIVE_CACHE_TTL'] = float(os.environ.get('TENANT_NEGATIVE_CACHE_TTL', 300))
+    # Recent update_ids remembered per bot; set TELEGRAM_DEDUPE_PERSIST=1 to also keep them in the database.
+    app.config['TELEGRAM_DEDUPE_WINDOW'] = int(os.environ.get('TELEGRAM_DEDUPE_WINDOW', 1000))
+    app.config['TELEGRAM_DEDUPE_PERSIST'] = os.environ.get('TELEGRAM_DEDUPE_PERSIST', '0') == '1'
+    app.config['TELEGRAM_DEDUPE_RETENTION_HOURS'] = float(os.environ.get('TELEGRAM_DEDUPE_RETENTION_HOURS', 24))
+    # Where pending address/note replies are tracked: 'db' (any number of workers) or 'memory' (one worker).
+    app.config['CONVERSATION_BACKEND'] = os.environ.get('CONVERSATION_BACKEND', 'db')
+    app.config['CONVERSATION_TTL'] = float(os.environ.get('CONVERSATION_TTL', 7 * 24 * 3600))
+    # 0 (the default) writes each add_cart tap straight through as an upsert. A window in milliseconds
+    # sums taps in memory first; they are lost on a crash and unseen by other workers until written.
+    app.config['CART_COALESCE_MS'] = float(os.environ.get('CART_COALESCE_MS', 0))
+    # How long a logged-in user's id, flags and bot ids are trusted before reloading them.
+    app.config['PRINCIPAL_CACHE_TTL'] = float(os.environ.get('PRINCIPAL_CACHE_TTL', 30))
+    # Password hashing runs in a process pool of this size (0 hashes on the request thread),
+    # with at most PASSWORD_HASH_QUEUE hashes in flight before logins get a 503.
+    app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS', 2))
+    app.config['PASSWORD_HASH_QUEUE'] = int(os.environ.get('PASSWORD_HASH_QUEUE', 32))
+    app.config['PASSWORD_HASH_TIMEOUT'] = float(os.environ.get('PASSWORD_HASH_TIMEOUT', 10))
+    app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt')
+    # Proxies in front of the app that set X-Forwarded-For/-Proto (Render has one). Only that many
+    # hops are trusted, so clients cannot pick their own IP for the per-IP login limit; 0 trusts none.
+    app.config['TRUSTED_PROXY_HOPS'] = int(os.environ.get('TRUSTED_PROXY_HOPS', 1))
+    # Failed logins allowed per email and per IP within the window (seconds) before a 429.
+    # LOGIN_MAX_FAILURES_PER_IP=0 turns the per-IP limit off.
+    app.config['LOGIN_THROTTLE_WINDOW'] = float(os.environ.get('LOGIN_THROTTLE_WINDOW', 300))
+    app.config['LOGIN_MAX_FAILURES_PER_EMAIL'] = int(os.environ.get('LOGIN_MAX_FAILURES_PER_EMAIL', 10))
+    app.config['LOGIN_MAX_FAILURES_PER_IP'] = int(os.environ.get('LOGIN_MAX_FAILURES_PER_IP', 50))
+    # /metrics (off unless METRICS_ENABLED=1): each worker saves a snapshot to METRICS_DIR
+    # (default instance/metrics) this often (seconds).
+    # Set METRICS_TOKEN to require "Authorization: Bearer <token>" on scrapes.
+    app.config['METRICS_ENABLED'] = os.environ.get('METRICS_ENABLED', '0') == '1'
+    app.config['METRICS_DIR'] = os.environ.get('METRICS_DIR')
+    app.config['METRICS_FLUSH_INTERVAL'] = float(os.environ.get('METRICS_FLUSH_INTERVAL', 10))
+    app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
     
+    # request.remote_addr becomes the client's address as seen by the trusted proxies.
+    if app.config['TRUSTED_PROXY_HOPS'] > 0:
+        hops = app.config['TRUSTED_PROXY_HOPS']
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=hops, x_proto=hops)
+
     # --- Initialize Extensions ---
     db.init_app(app)
+    if app.config['SQLITE_PERFORMANCE_PROFILE']:
+        with app.app_context():
+            for engine in db.engines.values():
+                sqlite_profile.install(engine, app.config)
     login_manager.init_app(app) # Initialize it with the app
+    background_loop.init_app(app)
+    update_queue.init_app(app)
+    bot_clients.init_app(app)
+    outbound.init_app(app)
+    tenant_cache.init_app(app)
+    catalog_cache.init_app(app)
+    nowpayments.init_app(app)
+    currency_cache.init_app(app)
+    ipn_consumer.init_app(app)
+    update_dedupe.init_app(app)
+    conversations.init_app(app)
+    cart_writer.init_app(app)
+    render_cache.init_app(app)
+    principal_cache.init_app(app)
+    password_hasher.init_app(app)
+    login_throttle.init_app(app)
+    write_lane.init_app(app)
+    replica_router.init_app(app)
+    metrics.init_app(app)
 
-    # This user_loader function is used by Flask-Login to reload the user object
-    # from the user ID stored in the session.
+    # This user_loader function is used by Flask-Login to reload the user from
+    # the user ID stored in the session. It returns a cached Principal rather than
+    # the User row; see app/principals.py.
     @login_manager.user_loader
     def load_user(user_id):
-        from .models import User
-        return User.query.get(user_id)
+        return principal_cache.get(user_id)
 
     with app.app_context():
         # Import and register Blueprints
@@ -0,0 +1,109 @@
+"""
+Process-wide registry of telegram.Bot clients, keyed by token.
+
+Every Bot shares one HTTPXRequest, so all shops in a worker draw from a single
+bounded httpx connection pool and keep their TLS connections to
+api.telegram.org alive between updates. Cold shops are evicted LRU-style.
+Evicting a Bot never closes the shared pool. Bots are ScheduledBots, so their
+sends are rate limited by the outbound scheduler. Every Bot API call is timed
+for /metrics.
+"""
+import collections
+import logging
+import os
+import threading
+import time
+
+from telegram.request import HTTPXRequest
+
+from .metrics import metrics
+from .outbound import ScheduledBot
+
+
+class TimedHTTPXRequest(HTTPXRequest):
+    """
+    HTTPXRequest that records each Bot API call's latency and failures.
+    """
+    async def do_request(self, url, method, *args, **kwargs):
+        # Label by API method (e.g. sendMessage), never by the token in the URL.
+        api_method = 'file_download' if '/file/bot' in url else url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception:
+            metrics.inc('telegram_api_errors_total', method=api_method)
+            raise
+        finally:
+            metrics.observe('telegram_api_seconds', time.perf_counter() - started, method=api_method)
+        if code >= 400:
+            metrics.inc('telegram_api_errors_total', method=api_method)
+        return code, payload
+
+
+class BotRegistry:
+    def __init__(self, app=None):
+        self.max_bots = 512
+        self.pool_size = 32
+        self._bots = collections.OrderedDict()
+        self._request = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_bots = max(1, int(app.config.get('TELEGRAM_BOT_CACHE_SIZE', 512)))
+        self.pool_size = max(1, int(app.config.get('TELEGRAM_POOL_SIZE', 32)))
+        app.extensions['bot_clients'] = self
+
+    def _shared_request(self):
+        # The httpx client must not be inherited across a fork, so build one per process.
+        if self._pid != os.getpid():
+            self._bots.clear()
+            self._request = TimedHTTPXRequest(connection_pool_size=self.pool_size)
+            self._pid = os.getpid()
+        return self._request
+
+    def get(self, token):
+        """
+        Returns the cached Bot for `token`, creating it on first use.
+        """
+        with self._lock:
+            request = self._shared_request()
+            bot = self._bots.get(token)
+            if bot is not None:
+                self._bots.move_to_end(token)
+                self.hits += 1
+                return bot
+
+            self.misses += 1
+            bot = ScheduledBot(token=token, request=request, get_updates_request=request)
+            self._bots[token] = bot
+            while len(self._bots) > self.max_bots:
+                self._bots.popitem(last=False)
+                self.evictions += 1
+            return bot
+
+    def invalidate(self, token):
+        """
+        Drops the Bot for `token`, e.g. when the shop is deleted.
+        """
+        with self._lock:
+            if self._bots.pop(token, None) is not None:
+                logging.info(f"--- Dropped cached Telegram client for {token[:10]}... ---")
+
+    def stats(self):
+        return {
+            'bots': len(self._bots),
+            'capacity': self.max_bots,
+            'pool_size': self.pool_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+bot_clients = BotRegistry()
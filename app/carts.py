@@ -0,0 +1,179 @@
+"""
+Cart writes as single-statement upserts, with tap coalescing.
+
+Adding to a cart is two INSERT ... ON CONFLICT statements in one transaction:
+one returns the chat's cart id, creating the cart if needed, and the other
+adds to the tier's quantity. No read comes first, so fast taps can no longer
+race into the unique constraints. Both SQLite (3.35+) and Postgres support
+this. The quantity upsert only inserts while the tier still exists: taps come
+from a catalog snapshot that can be a minute old, and SQLite does not enforce
+the foreign key.
+
+By default every tap is written straight through. Concurrent taps on one
+cart are combined by the database, since the quantity upsert adds to the row
+rather than replacing it, so nothing needs to be held back. Setting
+CART_COALESCE_MS sums taps on the same cart in memory and writes them
+together once the window closes. Those taps are lost if the worker dies
+first and other workers cannot see them until then, so only use it with a
+single worker. Anything that reads a cart calls `flush()` first, so this
+worker never shows a stale cart. The writer is only used from the background
+event loop, and its writes run on the loop's blocking pool.
+"""
+import asyncio
+import collections
+import logging
+import uuid
+
+from sqlalchemy import exists, literal, select
+
+from . import db
+from .event_loop import background_loop
+from .sql import dialect_insert
+from .write_lane import write_lane
+
+
+def _insert(table):
+    return dialect_insert(table, db.session.get_bind())
+
+
+def upsert_cart(bot_id, chat_id):
+    """
+    Returns the id of the chat's cart, creating the cart if it does not exist.
+    """
+    from .models import Cart
+    table = Cart.__table__
+    stmt = _insert(table).values(id=str(uuid.uuid4()), chat_id=str(chat_id), bot_id=bot_id)
+    # A no-op update, so RETURNING also yields the id of an existing cart.
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.chat_id, table.c.bot_id],
+        set_={'chat_id': stmt.excluded.chat_id}
+    ).returning(table.c.id)
+    return db.session.execute(stmt).scalar_one()
+
+
+def add_to_cart(cart_id, price_tier_id, quantity=1):
+    """
+    Adds `quantity` of a tier to a cart and returns the new quantity, or
+    None if the tier has been deleted.
+    """
+    from .models import CartItem, PriceTier
+    table = CartItem.__table__
+    row = select(
+        literal(str(uuid.uuid4())), literal(cart_id), literal(price_tier_id), literal(quantity)
+    ).where(exists().where(PriceTier.id == price_tier_id))
+    stmt = _insert(table).from_select([table.c.id, table.c.cart_id, table.c.price_tier_id, table.c.quantity], row)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.cart_id, table.c.price_tier_id],
+        set_={'quantity': table.c.quantity + stmt.excluded.quantity}
+    ).returning(table.c.quantity)
+    return db.session.execute(stmt).scalar_one_or_none()
+
+
+def write_cart(bot_id, chat_id, counts):
+    """
+    Adds {price tier id: quantity} to the chat's cart, creating it if needed.
+    Returns the ids of tiers that no longer exist. The caller commits.
+    """
+    cart_id = upsert_cart(bot_id, chat_id)
+    return [
+        price_tier_id for price_tier_id, quantity in counts.items()
+        if add_to_cart(cart_id, price_tier_id, quantity) is None
+    ]
+
+
+class CartWriter:
+    def __init__(self, app=None):
+        self.app = None
+        self.window = 0.0
+        # (bot id, chat id) -> {price tier id: taps not yet written}
+        self._pending = {}
+        self._timers = {}
+        # (bot id, chat id) -> writes started by a closed window and still running
+        self._writing = {}
+        self.taps = 0
+        self.writes = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.window = max(0.0, float(app.config.get('CART_COALESCE_MS', 0)) / 1000)
+        app.extensions['cart_writer'] = self
+
+    async def add(self, bot_id, chat_id, price_tier_id):
+        """
+        Records one tap on a tier. Written straight away when coalescing is
+        off, otherwise when the cart's window closes or it is next read.
+        Returns False if the write found the tier deleted.
+        """
+        self.taps += 1
+        key = (bot_id, str(chat_id))
+        if not self.window:
+            return not await background_loop.run_blocking(self._write, key, {price_tier_id: 1})
+
+        counts = self._pending.setdefault(key, collections.Counter())
+        counts[price_tier_id] += 1
+        if key not in self._timers:
+            self._timers[key] = asyncio.get_running_loop().call_later(self.window, self._flush_later, key)
+        return True
+
+    async def flush(self, bot_id, chat_id):
+        """
+        Writes any pending taps for the chat's cart. Call before reading it.
+        """
+        key = (bot_id, str(chat_id))
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        counts = self._pending.pop(key, None)
+        if counts:
+            await background_loop.run_blocking(self._write, key, counts)
+        writing = self._writing.get(key)
+        if writing:
+            await asyncio.wait(writing)
+
+    def _flush_later(self, key):
+        self._timers.pop(key, None)
+        counts = self._pending.pop(key, None)
+        if not counts:
+            return
+        task = asyncio.ensure_future(self._write_later(key, counts))
+        writing = self._writing.setdefault(key, set())
+        writing.add(task)
+        task.add_done_callback(lambda _: self._write_done(key, task))
+
+    async def _write_later(self, key, counts):
+        try:
+            await background_loop.run_blocking(self._write_in_new_context, key, counts)
+        except Exception as e:
+            logging.error(f"--- Failed to write cart for chat {key[1]}: {e} ---", exc_info=True)
+
+    def _write_done(self, key, task):
+        writing = self._writing.get(key)
+        writing.discard(task)
+        if not writing:
+            del self._writing[key]
+
+    def _write_in_new_context(self, key, counts):
+        # The window closed outside any update, so the write gets its own session.
+        with self.app.app_context():
+            self._write(key, counts)
+
+    def _write(self, key, counts):
+        bot_id, chat_id = key
+        missing = write_lane.run(write_cart, bot_id, chat_id, dict(counts))
+        self.writes += 1
+        if missing:
+            logging.info(f"--- Dropped taps on {len(missing)} deleted price tier(s) for chat {chat_id} ---")
+        return missing
+
+    def stats(self):
+        return {
+            'window_ms': int(self.window * 1000),
+            'pending_carts': len(self._pending),
+            'taps': self.taps,
+            'writes': self.writes,
+        }
+
+
+cart_writer = CartWriter()
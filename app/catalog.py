@@ -0,0 +1,135 @@
+"""
+Immutable, per-bot catalog snapshots for the customer browsing flow.
+
+A snapshot holds a shop's whole category tree, products and price tiers,
+loaded in three column-only queries and kept in memory. It is valid while its
+version matches `Bot.catalog_version`. That column is bumped by every catalog
+edit and read through the tenant cache, so browsing does no SQL between edits.
+"""
+import collections
+import threading
+import types
+
+from . import db
+
+CatalogTier = collections.namedtuple('CatalogTier', ['id', 'label', 'price'])
+CatalogProduct = collections.namedtuple(
+    'CatalogProduct',
+    ['id', 'name', 'description', 'unit', 'image_url', 'video_url', 'image_file_id', 'price_tiers']
+)
+CatalogCategory = collections.namedtuple(
+    'CatalogCategory', ['id', 'name', 'parent_id', 'sub_categories', 'products']
+)
+# `tiers` maps a price tier id to its (CatalogProduct, CatalogTier).
+CatalogSnapshot = collections.namedtuple('CatalogSnapshot', ['bot_id', 'version', 'roots', 'categories', 'tiers'])
+
+
+def load_snapshot(bot_id, version):
+    """
+    Builds a CatalogSnapshot for `bot_id` in a fixed number of queries.
+    """
+    from .models import Category, Product, PriceTier
+
+    category_rows = (
+        db.session.query(Category.id, Category.name, Category.parent_id)
+        .filter(Category.bot_id == bot_id)
+        .all()
+    )
+    product_rows = (
+        db.session.query(
+            Product.id, Product.name, Product.description, Product.unit,
+            Product.image_url, Product.video_url, Product.image_file_id, Product.category_id
+        )
+        .join(Category, Product.category_id == Category.id)
+        .filter(Category.bot_id == bot_id)
+        .all()
+    )
+    tier_rows = (
+        db.session.query(PriceTier.id, PriceTier.label, PriceTier.price, PriceTier.product_id)
+        .join(Product, PriceTier.product_id == Product.id)
+        .join(Category, Product.category_id == Category.id)
+        .filter(Category.bot_id == bot_id)
+        .all()
+    )
+
+    tiers_by_product = collections.defaultdict(list)
+    for tier_id, label, price, product_id in tier_rows:
+        tiers_by_product[product_id].append(CatalogTier(tier_id, label, price))
+
+    products_by_category = collections.defaultdict(list)
+    tiers = {}
+    for product_id, name, description, unit, image_url, video_url, image_file_id, category_id in product_rows:
+        product = CatalogProduct(
+            product_id, name, description, unit, image_url, video_url, image_file_id,
+            tuple(tiers_by_product[product_id])
+        )
+        products_by_category[category_id].append(product)
+        for tier in product.price_tiers:
+            tiers[tier.id] = (product, tier)
+
+    children = collections.defaultdict(list)
+    for category_id, _, parent_id in category_rows:
+        children[parent_id].append(category_id)
+
+    rows_by_id = {row[0]: row for row in category_rows}
+    categories = {}
+
+    def build(category_id):
+        # Depth-first, so sub-categories are frozen before their parent.
+        _, name, parent_id = rows_by_id[category_id]
+        sub_categories = tuple(build(child_id) for child_id in children[category_id])
+        category = CatalogCategory(
+            category_id, name, parent_id, sub_categories, tuple(products_by_category[category_id])
+        )
+        categories[category_id] = category
+        return category
+
+    roots = tuple(build(root_id) for root_id in children[None])
+    return CatalogSnapshot(
+        bot_id, version, roots, types.MappingProxyType(categories), types.MappingProxyType(tiers)
+    )
+
+
+class CatalogCache:
+    def __init__(self, app=None):
+        self.max_bots = 256
+        self._snapshots = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.loads = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_bots = max(1, int(app.config.get('CATALOG_CACHE_SIZE', 256)))
+        app.extensions['catalog_cache'] = self
+
+    def get(self, tenant):
+        """
+        Returns the snapshot for a Tenant, reloading it if the version moved on.
+        """
+        with self._lock:
+            snapshot = self._snapshots.get(tenant.id)
+            if snapshot is not None and snapshot.version == tenant.catalog_version:
+                self._snapshots.move_to_end(tenant.id)
+                self.hits += 1
+                return snapshot
+
+        snapshot = load_snapshot(tenant.id, tenant.catalog_version)
+        with self._lock:
+            self.loads += 1
+            self._snapshots[tenant.id] = snapshot
+            self._snapshots.move_to_end(tenant.id)
+            while len(self._snapshots) > self.max_bots:
+                self._snapshots.popitem(last=False)
+        return snapshot
+
+    def invalidate(self, bot_id):
+        with self._lock:
+            self._snapshots.pop(bot_id, None)
+
+    def stats(self):
+        return {'bots': len(self._snapshots), 'hits': self.hits, 'loads': self.loads}
+
+
+catalog_cache = CatalogCache()
@@ -0,0 +1,153 @@
+"""
+Per-chat conversation state, keyed by (bot id, chat id).
+
+After a payment is confirmed the bot asks the customer for a shipping address
+and then a note. The free-text handler asks this store what, if anything, a
+chat owes us, instead of scanning the orders table on every message. States
+expire after CONVERSATION_TTL seconds.
+
+The 'db' backend keeps states in the small conversation_state table and works
+across workers; state changes join the caller's transaction. The 'memory'
+backend keeps them in this process only and is meant for single-worker
+deployments, where it lets ordinary messages skip the database entirely.
+Each process loads pending states from the orders table once, on first use.
+"""
+import collections
+import datetime
+import os
+import threading
+import time
+
+from . import db
+
+AWAITING_ADDRESS = 'awaiting_address'
+AWAITING_NOTE = 'awaiting_note'
+
+Conversation = collections.namedtuple('Conversation', ['state', 'order_id'])
+
+PRUNE_EVERY = 200   # State changes between deletes of expired rows.
+
+
+class ConversationStore:
+    def __init__(self, app=None):
+        self.backend = 'db'
+        self.ttl = 7 * 24 * 3600
+        self._memory = {}
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._loaded_pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.backend = app.config.get('CONVERSATION_BACKEND', 'db')
+        if self.backend not in ('db', 'memory'):
+            raise ValueError(f"CONVERSATION_BACKEND must be 'db' or 'memory', not {self.backend!r}")
+        self.ttl = float(app.config.get('CONVERSATION_TTL', self.ttl))
+        app.extensions['conversations'] = self
+
+    def get(self, bot_id, chat_id):
+        """
+        Returns the chat's Conversation, or None if nothing is pending.
+        """
+        key = (bot_id, str(chat_id))
+        if self.backend == 'memory':
+            if self._loaded_pid != os.getpid():
+                self._loaded_pid = os.getpid()
+                self._memory.clear()
+                self.backfill()
+            with self._lock:
+                entry = self._memory.get(key)
+                if entry is None:
+                    return None
+                if entry[0] <= time.monotonic():
+                    del self._memory[key]
+                    return None
+                return entry[1]
+
+        from .models import ConversationState
+        row = db.session.get(ConversationState, key)
+        if row is None or row.expires_at <= datetime.datetime.utcnow():
+            return None
+        return Conversation(row.state, row.order_id)
+
+    def set(self, bot_id, chat_id, state, order_id=None):
+        """
+        Records what the chat is expected to send next. With the 'db'
+        backend the caller commits.
+        """
+        key = (bot_id, str(chat_id))
+        if self.backend == 'memory':
+            with self._lock:
+                self._memory[key] = (time.monotonic() + self.ttl, Conversation(state, order_id))
+            return
+
+        from .models import ConversationState
+        expires_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=self.ttl)
+        row = db.session.get(ConversationState, key)
+        if row is None:
+            db.session.add(ConversationState(
+                bot_id=key[0], chat_id=key[1], state=state, order_id=order_id, expires_at=expires_at
+            ))
+        else:
+            row.state, row.order_id, row.expires_at = state, order_id, expires_at
+        self._count_write()
+
+    def clear(self, bot_id, chat_id):
+        key = (bot_id, str(chat_id))
+        if self.backend == 'memory':
+            with self._lock:
+                self._memory.pop(key, None)
+            return
+
+        from .models import ConversationState
+        row = db.session.get(ConversationState, key)
+        if row is not None:
+            db.session.delete(row)
+
+    def _count_write(self):
+        self._writes += 1
+        if self._writes % PRUNE_EVERY == 0:
+            self.prune()
+
+    def prune(self):
+        """
+        Deletes expired states. With the 'db' backend the caller commits.
+        """
+        if self.backend == 'memory':
+            now = time.monotonic()
+            with self._lock:
+                for key in [k for k, (expires, _) in self._memory.items() if expires <= now]:
+                    del self._memory[key]
+            return
+
+        from .models import ConversationState
+        db.session.query(ConversationState).filter(
+            ConversationState.expires_at <= datetime.datetime.utcnow()
+        ).delete(synchronize_session=False)
+
+    def backfill(self):
+        """
+        Creates states for orders that were already waiting on an address or
+        note before this store existed. Safe to run repeatedly.
+        """
+        from .models import Order
+        orders = (
+            db.session.query(Order.id, Order.bot_id, Order.chat_id, Order.status)
+            .filter(Order.status.in_([AWAITING_ADDRESS, AWAITING_NOTE]), Order.chat_id.isnot(None))
+            .order_by(Order.timestamp)
+            .all()
+        )
+        for order_id, bot_id, chat_id, status in orders:
+            self.set(bot_id, chat_id, status, order_id)
+        db.session.commit()
+        return len(orders)
+
+    def stats(self):
+        stats = {'backend': self.backend, 'ttl': self.ttl}
+        if self.backend == 'memory':
+            stats['chats'] = len(self._memory)
+        return stats
+
+
+conversations = ConversationStore()
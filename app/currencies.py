@@ -0,0 +1,162 @@
+"""
+NOWPayments currency list with stale-while-revalidate caching.
+
+Checkout never waits on NOWPayments once a list is known. A stale list is
+served immediately while a single background fetch refreshes it, so
+concurrent checkouts cannot stampede the API. Fetches go through the async
+NOWPayments client, and the cache is only used from the background event
+loop. The last good list is saved under the instance folder for cold starts.
+Keyboard pages are precomputed whenever the list changes, so paging only
+fills in the cart id.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from .nowpayments import nowpayments
+
+MAX_CURRENCIES = 120    # Keeps the keyboard within Telegram's limits.
+ITEMS_PER_PAGE = 30
+BUTTONS_PER_ROW = 5
+RETRY_BACKOFF = 60      # Seconds between attempts after a failed fetch.
+
+
+class CurrencyCache:
+    def __init__(self, app=None):
+        self.ttl = 3600
+        self.path = None
+        self.currencies = ()
+        self.version = 0
+        self.fetched_at = 0.0
+        self._pages = ()
+        self._next_attempt = 0.0
+        self._loaded_from_disk = False
+        self._refreshing = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttl = float(app.config.get('CURRENCY_CACHE_TTL', 3600))
+        self.path = app.config.get('CURRENCY_CACHE_PATH') or os.path.join(app.instance_path, 'currencies.json')
+        app.extensions['currency_cache'] = self
+
+    # --- Storage ---
+
+    def _load_from_disk(self):
+        self._loaded_from_disk = True
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+            self._set(saved['currencies'], saved.get('fetched_at', 0.0))
+            logging.info(f"--- Loaded {len(self.currencies)} currencies from {self.path} ---")
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"--- Ignoring unreadable currency cache file {self.path}: {e} ---")
+
+    def _save_to_disk(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump({'currencies': list(self.currencies), 'fetched_at': self.fetched_at}, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.warning(f"--- Could not save currency cache to {self.path}: {e} ---")
+
+    def _set(self, currencies, fetched_at):
+        currencies = tuple(currencies)
+        if currencies != self.currencies:
+            self.currencies = currencies
+            self.version += 1
+            self._pages = self._build_pages(currencies)
+        self.fetched_at = fetched_at
+
+    # --- Fetching ---
+
+    async def fetch(self):
+        """
+        Fetches the list from NOWPayments. Raises on any failure.
+        """
+        data = await nowpayments.full_currencies()
+        available = [c['code'] for c in data.get('currencies', []) if c.get('available_for_payment') is True]
+        logging.info(f"--- Found {len(available)} total, using {len(available[:MAX_CURRENCIES])} ---")
+        return available[:MAX_CURRENCIES]
+
+    async def _refresh(self):
+        try:
+            self._set(await self.fetch(), time.time())
+            self._save_to_disk()
+        except Exception as e:
+            logging.error(f"--- Failed to fetch currencies from NOWPayments: {e} ---")
+            self._next_attempt = time.monotonic() + RETRY_BACKOFF
+        finally:
+            self._refreshing = None
+
+    def _start_refresh(self):
+        # Single flight: at most one fetch is in progress per worker.
+        if self._refreshing is None and time.monotonic() >= self._next_attempt:
+            self._refreshing = asyncio.ensure_future(self._refresh())
+        return self._refreshing
+
+    async def get(self, wait_timeout=10):
+        """
+        Returns the currency codes. Waits only on a cold start with nothing
+        in memory or on disk; otherwise stale data is returned immediately.
+        """
+        if not self._loaded_from_disk:
+            self._load_from_disk()
+
+        if time.time() - self.fetched_at >= self.ttl:
+            refresh = self._start_refresh()
+            if not self.currencies and refresh is not None:
+                # asyncio.wait leaves the fetch running if we give up waiting.
+                await asyncio.wait({refresh}, timeout=wait_timeout)
+        return self.currencies
+
+    # --- Keyboards ---
+
+    @staticmethod
+    def _build_pages(currencies):
+        pages = []
+        for start in range(0, len(currencies), ITEMS_PER_PAGE):
+            page_currencies = currencies[start:start + ITEMS_PER_PAGE]
+            pages.append(tuple(
+                tuple((code.upper(), f"select_currency:{code}:{{cart_id}}") for code in page_currencies[i:i + BUTTONS_PER_ROW])
+                for i in range(0, len(page_currencies), BUTTONS_PER_ROW)
+            ))
+        return tuple(pages)
+
+    async def keyboard(self, page=1, cart_id=None):
+        """
+        Creates the paginated currency keyboard for a cart.
+        """
+        await self.get()
+        pages = self._pages
+        if not pages:
+            return InlineKeyboardMarkup([[InlineKeyboardButton("Payment system unavailable.", callback_data="main_menu")]])
+
+        total_pages = len(pages)
+        page = min(max(page, 1), total_pages)
+        keyboard = [
+            [InlineKeyboardButton(label, callback_data=template.format(cart_id=cart_id)) for label, template in row]
+            for row in pages[page - 1]
+        ]
+
+        nav_row = []
+        if page > 1:
+            nav_row.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"view_currency_page:{page-1}:{cart_id}"))
+        nav_row.append(InlineKeyboardButton(f"Page {page}/{total_pages}", callback_data="no_op"))
+        if page < total_pages:
+            nav_row.append(InlineKeyboardButton("Next ➡️", callback_data=f"view_currency_page:{page+1}:{cart_id}"))
+
+        keyboard.append(nav_row)
+        keyboard.append([InlineKeyboardButton("⬅️ Back to Cart", callback_data=f"view_cart:{cart_id}")])
+        return InlineKeyboardMarkup(keyboard)
+
+
+currency_cache = CurrencyCache()
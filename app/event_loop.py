@@ -0,0 +1,178 @@
+"""
+One long-lived asyncio event loop per worker process.
+
+The loop runs in a daemon thread and is started lazily, so a gunicorn master
+that imports the app before forking never owns it. Request threads hand
+coroutines over with `submit` (returns a concurrent Future) or `run`
+(blocks for the result). Connections opened by Telegram and HTTP clients stay
+bound to this one loop and can be reused across requests.
+
+Blocking work, which in practice means SQLAlchemy, must not run on the loop
+itself: one slow query would stall every update this worker is handling.
+Coroutines hand it to a bounded thread pool with `await run_blocking(fn,
+*args)` (BLOCKING_THREADS threads per worker).
+"""
+import asyncio
+import atexit
+import concurrent.futures
+import contextvars
+import functools
+import logging
+import os
+import threading
+
+
+class BackgroundLoop:
+    def __init__(self):
+        self._loop = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._count_lock = threading.Lock()
+        self._executor = None
+        self.blocking_threads = 8
+        self._spawned = set()
+
+    def init_app(self, app):
+        self.blocking_threads = max(1, int(app.config.get('BLOCKING_THREADS', 8)))
+        app.extensions['background_loop'] = self
+
+    @property
+    def loop(self):
+        self._ensure_started()
+        return self._loop
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def in_loop_thread(self):
+        return self._thread is not None and threading.current_thread() is self._thread
+
+    def _ensure_started(self):
+        if self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            started = threading.Event()
+            self._loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(
+                target=self._run, args=(self._loop, started),
+                name="background-event-loop", daemon=True
+            )
+            self._thread.start()
+            started.wait()
+            if self._pid != os.getpid():
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.blocking_threads, thread_name_prefix="background-blocking"
+                )
+            self._pid = os.getpid()
+            self._in_flight = 0
+            logging.info(f"--- Background event loop started in process {self._pid} ---")
+
+    @staticmethod
+    def _run(loop, started):
+        asyncio.set_event_loop(loop)
+        loop.call_soon(started.set)
+        loop.run_forever()
+
+    def _track(self, delta):
+        with self._count_lock:
+            self._in_flight += delta
+
+    def submit(self, coroutine):
+        """
+        Schedules a coroutine on the background loop from any thread.
+
+        The caller's context variables (e.g. the Flask app context) are copied
+        into the task. Returns a concurrent.futures.Future.
+        """
+        loop = self.loop
+        context = contextvars.copy_context()
+        self._track(1)
+        future = asyncio.run_coroutine_threadsafe(self._wrap(coroutine, context), loop)
+        future.add_done_callback(lambda _: self._track(-1))
+        return future
+
+    @staticmethod
+    async def _wrap(coroutine, context):
+        # Run the real work as a task created inside the caller's copied context.
+        return await context.run(asyncio.ensure_future, coroutine)
+
+    def run(self, coroutine, timeout=None):
+        """
+        Runs a coroutine on the background loop and blocks until it finishes.
+        """
+        if self.in_loop_thread():
+            coroutine.close()
+            raise RuntimeError("run() would deadlock when called from the background loop itself.")
+        return self.submit(coroutine).result(timeout)
+
+    async def run_blocking(self, fn, *args):
+        """
+        Runs the blocking call `fn(*args)` on the worker's thread pool and
+        awaits its result. The caller's context variables, including the
+        Flask app context and so its database session, go with it.
+        """
+        call = functools.partial(contextvars.copy_context().run, fn, *args)
+        try:
+            future = asyncio.get_running_loop().run_in_executor(self._executor, call)
+        except RuntimeError:
+            # The pool takes no new work once the interpreter is exiting; finish it here.
+            return call()
+        return await future
+
+    def spawn(self, coroutine):
+        """
+        Starts a coroutine as a task that nothing awaits. Call from the loop
+        thread. The task is kept alive until it finishes and failures are logged.
+        """
+        task = self.loop.create_task(coroutine)
+        self._track(1)
+        self._spawned.add(task)
+        task.add_done_callback(self._spawned_done)
+        return task
+
+    def _spawned_done(self, task):
+        self._spawned.discard(task)
+        self._track(-1)
+        if not task.cancelled() and task.exception() is not None:
+            logging.error(f"--- Background task failed: {task.exception()} ---", exc_info=task.exception())
+
+    def call_soon(self, callback, *args):
+        """
+        Thread-safe `call_soon` on the background loop.
+        """
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    def shutdown(self, timeout=5.0):
+        """
+        Cancels outstanding tasks, closes async generators and stops the loop.
+        """
+        if self._pid != os.getpid() or self._loop is None or self._loop.is_closed():
+            return
+
+        async def _cancel_pending():
+            current = asyncio.current_task()
+            tasks = [t for t in asyncio.all_tasks() if t is not current]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self._loop.shutdown_asyncgens()
+
+        try:
+            asyncio.run_coroutine_threadsafe(_cancel_pending(), self._loop).result(timeout)
+        except Exception as e:
+            logging.warning(f"--- Background loop did not shut down cleanly: {e} ---")
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout)
+        if not self._thread.is_alive():
+            self._loop.close()
+        self._executor.shutdown(wait=False)
+        self._pid = None
+
+
+background_loop = BackgroundLoop()
+atexit.register(background_loop.shutdown)
@@ -0,0 +1,83 @@
+"""
+Streamed order exports for the admin panel.
+
+Orders are read with a server-side cursor (`yield_per`) and the owner's email
+is joined into the same query, so memory use does not grow with the number of
+orders and there is no per-row lookup. Output is produced in chunks of
+EXPORT_CHUNK_ROWS rows, which Flask sends to the client as they are ready.
+"""
+import csv
+import io
+import json
+
+from . import db
+from .models import Bot, Order, User
+from .serializers import ORDER_COLUMNS, order_dict
+
+EXPORT_CHUNK_ROWS = 1000
+CSV_FIELDS = (
+    'id', 'product_name', 'price', 'timestamp', 'status', 'payout_status',
+    'telegram_username', 'shipping_address', 'customer_note',
+    'payment_currency', 'amount_paid', 'user_email',
+)
+
+
+def orders_with_owner_query(*criteria):
+    """
+    Rows of ORDER_COLUMNS followed by the shop owner's email.
+    """
+    return (
+        db.session.query(*ORDER_COLUMNS, User.email)
+        .join(Bot, Order.bot_id == Bot.id)
+        .join(User, Bot.user_id == User.id)
+        .filter(*criteria)
+    )
+
+
+def order_with_owner_dict(row):
+    data = order_dict(row)
+    data['user_email'] = row[-1]
+    return data
+
+
+def _stream_rows(criteria):
+    query = (
+        orders_with_owner_query(*criteria)
+        .order_by(Order.timestamp.desc(), Order.id.desc())
+        .execution_options(stream_results=True)
+        .yield_per(EXPORT_CHUNK_ROWS)
+    )
+    for row in query:
+        yield order_with_owner_dict(row)
+
+
+def iter_ndjson(criteria):
+    """
+    Yields the matching orders as newline-delimited JSON, one chunk at a time.
+    """
+    chunk = []
+    for data in _stream_rows(criteria):
+        chunk.append(json.dumps(data))
+        if len(chunk) >= EXPORT_CHUNK_ROWS:
+            yield '\n'.join(chunk) + '\n'
+            chunk = []
+    if chunk:
+        yield '\n'.join(chunk) + '\n'
+
+
+def iter_csv(criteria):
+    """
+    Yields the matching orders as CSV with a header row, one chunk at a time.
+    """
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=CSV_FIELDS)
+    writer.writeheader()
+    rows = 0
+    for data in _stream_rows(criteria):
+        writer.writerow(data)
+        rows += 1
+        if rows % EXPORT_CHUNK_ROWS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
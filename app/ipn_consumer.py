@@ -0,0 +1,244 @@
+"""
+Background consumer for the NOWPayments IPN inbox.
+
+The webhook only verifies, inserts into IpnEvent and acks. This consumer
+claims pending events in batches, applies each event's Order status
+transition in its own transaction, and sends customer notifications once
+they are committed. It runs as a task on each worker's background loop and
+does its database work on the loop's blocking pool, so the loop is never
+blocked. Events are claimed with a lease, so several workers can share the
+inbox, and events left by a crashed worker are picked up again once the lease
+expires.
+
+An event whose payload can never be applied (not JSON, missing amounts) is
+marked processed and skipped. Any other failure, such as a locked database,
+is rolled back and the event stays pending, so it is retried once its lease
+expires.
+"""
+import asyncio
+import datetime
+import json
+import logging
+import os
+import socket
+import uuid
+
+from sqlalchemy import or_, select, update
+
+from . import db
+from .bot_clients import bot_clients
+from .conversations import AWAITING_ADDRESS, conversations
+from .event_loop import background_loop
+from .outbound import bulk
+
+
+class IpnConsumer:
+    def __init__(self, app=None):
+        self.app = None
+        self.batch_size = 50
+        self.poll_interval = 5.0
+        self.lease = datetime.timedelta(seconds=60)
+        self.worker_id = None
+        self._wakeup = None
+        self._task = None
+        self._pid = None
+        self.processed = 0
+        self.skipped = 0
+        self.retried = 0
+        self.failed_batches = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.batch_size = int(app.config.get('IPN_BATCH_SIZE', 50))
+        self.poll_interval = float(app.config.get('IPN_POLL_INTERVAL', 5))
+        app.extensions['ipn_consumer'] = self
+        # Started from the first request each worker serves, never in a pre-fork master.
+        app.before_request(self.ensure_started)
+
+    def ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self.worker_id = f"{socket.gethostname()}:{self._pid}:{uuid.uuid4().hex[:8]}"
+        background_loop.call_soon(self._start)
+
+    def _start(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run(), name="ipn-consumer")
+
+    def wake(self):
+        """
+        Called after an insert so the event is applied without waiting for the next poll.
+        """
+        if self._wakeup is not None:
+            background_loop.call_soon(self._wakeup.set)
+
+    async def _run(self):
+        while True:
+            try:
+                count, notifications = await background_loop.run_blocking(self._apply_batch)
+                for token, chat_id, text in notifications:
+                    await self._notify(token, chat_id, text)
+                if count:
+                    continue
+            except Exception as e:
+                self.failed_batches += 1
+                logging.error(f"--- IPN batch failed: {e} ---", exc_info=True)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _notify(self, token, chat_id, text):
+        try:
+            with bulk():
+                await bot_clients.get(token).send_message(chat_id=chat_id, text=text)
+        except Exception as e:
+            logging.error(f"--- Failed to notify chat {chat_id} about a payment: {e} ---")
+
+    def _claim(self):
+        from .models import IpnEvent
+        now = datetime.datetime.utcnow()
+        claimable = or_(IpnEvent.claimed_at.is_(None), IpnEvent.claimed_at < now - self.lease)
+        pending_ids = (
+            select(IpnEvent.id)
+            .where(IpnEvent.processed_at.is_(None), claimable)
+            .order_by(IpnEvent.received_at)
+            .limit(self.batch_size)
+        )
+        # The conditions are repeated on the UPDATE so two workers cannot claim the same row.
+        db.session.execute(
+            update(IpnEvent)
+            .where(IpnEvent.id.in_(pending_ids), IpnEvent.processed_at.is_(None), claimable)
+            .values(claimed_by=self.worker_id, claimed_at=now)
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+        # Only this claim's rows: events that failed earlier wait for their lease to expire.
+        return (
+            IpnEvent.query
+            .filter_by(claimed_by=self.worker_id, claimed_at=now, processed_at=None)
+            .order_by(IpnEvent.received_at)
+            .all()
+        )
+
+    def _apply_batch(self):
+        """
+        Applies one batch of claimed events. Returns how many were handled and
+        the notifications to send.
+        """
+        with self.app.app_context():
+            # Plain values: the rows expire on each commit or rollback below.
+            events = [(event.id, event.payment_id, event.payment_status, event.payload) for event in self._claim()]
+            notifications = []
+            for event_id, payment_id, payment_status, payload in events:
+                try:
+                    data = parse_ipn(payload)
+                except (ValueError, KeyError, TypeError) as e:
+                    # A malformed event must not block the rest of the inbox.
+                    logging.error(f"--- Skipping malformed IPN {payment_id}/{payment_status}: {e} ---")
+                    self._mark_processed(event_id)
+                    db.session.commit()
+                    self.skipped += 1
+                    continue
+
+                # Each event gets its own transaction, so a failing one only undoes itself.
+                try:
+                    event_notifications = apply_ipn(data)
+                    self._mark_processed(event_id)
+                    db.session.commit()
+                except Exception as e:
+                    db.session.rollback()
+                    self.retried += 1
+                    logging.error(f"--- IPN {payment_id}/{payment_status} failed, retrying after the lease: {e} ---", exc_info=True)
+                    continue
+                self.processed += 1
+                notifications.extend(event_notifications)
+            return len(events), notifications
+
+    @staticmethod
+    def _mark_processed(event_id):
+        from .models import IpnEvent
+        db.session.execute(
+            update(IpnEvent)
+            .where(IpnEvent.id == event_id)
+            .values(processed_at=datetime.datetime.utcnow())
+            .execution_options(synchronize_session=False)
+        )
+
+    def stats(self):
+        return {
+            'processed': self.processed,
+            'skipped': self.skipped,
+            'retried': self.retried,
+            'failed_batches': self.failed_batches,
+        }
+
+
+def parse_ipn(payload):
+    """
+    Decodes a stored IPN payload and checks the fields apply_ipn relies on.
+    Raises ValueError, KeyError or TypeError for a payload that can never be
+    applied, however often it is retried.
+    """
+    data = json.loads(payload)
+    if not isinstance(data, dict):
+        raise ValueError("IPN payload is not a JSON object")
+    if data.get('payment_status') == 'finished':
+        float(data['pay_amount'])
+        float(data['price_amount'])
+        if not isinstance(data.get('pay_currency'), str):
+            raise ValueError("IPN payload has no pay_currency")
+    return data
+
+
+def apply_ipn(data):
+    """
+    Applies one IPN payload to its Order. Returns (bot token, chat id, text)
+    tuples for the customer messages to send once the changes are committed.
+    """
+    from .models import Order
+    order = db.session.get(Order, data.get('order_id'))
+    if not order or order.status != 'awaiting_payment':
+        # Unknown or already processed order.
+        return []
+
+    notifications = []
+    payment_status = data.get('payment_status')
+    if payment_status == 'finished':
+        amount_paid = data.get('pay_amount')
+        expected_price = data.get('price_amount')
+        currency_paid = data.get('pay_currency')
+
+        order.amount_paid = float(amount_paid)
+        order.payment_currency = currency_paid
+
+        if float(amount_paid) < float(expected_price):
+            order.status = 'underpaid'
+            underpaid_amount = float(expected_price) - float(amount_paid)
+            notifications.append((order.bot.token, order.chat_id, (
+                f"⚠️ Payment Issue: Your order has been underpaid.\n\n"
+                f"Expected: {expected_price} {currency_paid.upper()}\n"
+                f"Received: {amount_paid} {currency_paid.upper()}\n\n"
+                f"Amount missing: {underpaid_amount:.8f} {currency_paid.upper()}"
+            )))
+        elif float(amount_paid) > float(expected_price):
+            order.status = 'overpaid'
+        else:
+            order.status = AWAITING_ADDRESS
+            if order.chat_id:
+                conversations.set(order.bot_id, order.chat_id, AWAITING_ADDRESS, order.id)
+            notifications.append((order.bot.token, order.chat_id, "✅ Payment confirmed! Please reply with your full shipping address."))
+
+    elif payment_status in ['failed', 'refunded', 'expired']:
+        order.status = 'failed'
+
+    # Payout logic can be added here in the future
+    # execute_payout(order)
+    return notifications
+
+
+ipn_consumer = IpnConsumer()
@@ -0,0 +1,97 @@
+"""
+Product photo sending that reuses Telegram file_ids.
+
+The first successful send of a product's Cloudinary URL records the file_id
+Telegram returns. Later sends pass that id, so Telegram skips re-downloading
+the image and Cloudinary serves it once. The id is stored on the Product row
+for other workers and restarts, and in memory for this worker, because the
+catalog snapshot is not rebuilt for file_id changes. The database writes run
+on the background loop's blocking pool.
+"""
+import collections
+import logging
+import threading
+
+import telegram
+from sqlalchemy import update
+
+from . import db
+from .event_loop import background_loop
+
+# Most recently used file_ids kept in memory; the rest are read from the Product row.
+MAX_CACHED_FILE_IDS = 4096
+# BadRequest texts meaning the file_id itself is no good; anything else is not the id's fault.
+STALE_FILE_ID_ERRORS = ('wrong file identifier', 'wrong remote file identifier', 'file reference expired')
+
+_file_ids = collections.OrderedDict()
+_lock = threading.Lock()
+
+
+def is_stale_file_id_error(error):
+    message = str(error).lower()
+    return any(text in message for text in STALE_FILE_ID_ERRORS)
+
+
+def cached_file_id(product):
+    """
+    Returns a file_id for the product's current image_url, or None.
+    """
+    with _lock:
+        entry = _file_ids.get(product.id)
+        if entry is not None:
+            _file_ids.move_to_end(product.id)
+    if entry and entry[0] == product.image_url:
+        return entry[1]
+    return product.image_file_id
+
+
+def remember_file_id(product, file_id):
+    from .models import Product
+    with _lock:
+        _file_ids[product.id] = (product.image_url, file_id)
+        _file_ids.move_to_end(product.id)
+        while len(_file_ids) > MAX_CACHED_FILE_IDS:
+            _file_ids.popitem(last=False)
+    # Only store it if the image has not been replaced in the meantime.
+    db.session.execute(
+        update(Product)
+        .where(Product.id == product.id, Product.image_url == product.image_url)
+        .values(image_file_id=file_id)
+    )
+    db.session.commit()
+
+
+def forget_file_id(product, file_id):
+    from .models import Product
+    with _lock:
+        entry = _file_ids.get(product.id)
+        if entry and entry[1] == file_id:
+            del _file_ids[product.id]
+    db.session.execute(
+        update(Product)
+        .where(Product.id == product.id, Product.image_file_id == file_id)
+        .values(image_file_id=None)
+    )
+    db.session.commit()
+
+
+async def send_product_photo(bot, product, **kwargs):
+    """
+    Sends the product's photo, preferring the cached file_id and falling back
+    to the image URL if Telegram rejects it.
+    """
+    file_id = cached_file_id(product)
+    if file_id:
+        try:
+            return await bot.send_photo(photo=file_id, **kwargs)
+        except telegram.error.BadRequest as e:
+            if not is_stale_file_id_error(e):
+                raise
+            logging.warning(f"--- Cached file_id for product {product.id} was rejected ({e}), re-sending URL ---")
+            await background_loop.run_blocking(forget_file_id, product, file_id)
+
+    message = await bot.send_photo(photo=product.image_url, **kwargs)
+    if message.photo:
+        # Telegram lists the photo sizes smallest first.
+        await background_loop.run_blocking(remember_file_id, product, message.photo[-1].file_id)
+    return message
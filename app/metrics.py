@@ -0,0 +1,303 @@
+"""
+In-process metrics with a Prometheus text endpoint.
+
+Code records measurements through the `metrics` singleton:
+
+    metrics.observe('telegram_update_seconds', elapsed, action='add_cart')
+    metrics.inc('nowpayments_errors_total', endpoint='POST /v1/payment')
+
+Every metric is declared once in DEFINITIONS, which keeps label sets and
+names in one place. Recording is a dict update under a lock, so it is cheap
+enough for per-statement SQL timing.
+
+Gunicorn workers do not share memory, so each worker writes a JSON snapshot
+of its metrics to METRICS_DIR/<pid>-<start time>.json every
+METRICS_FLUSH_INTERVAL seconds, and again just before it serves /metrics.
+/metrics, served by whichever worker gets the scrape, merges all snapshots.
+Counters and histograms are summed, including those of workers that have
+exited, so totals never go backwards while the app runs. The start time in
+the file name keeps a worker that reuses an exited worker's pid from
+overwriting its totals. Gauges such as queue depths come only from live
+workers and carry a `pid` label. Clear METRICS_DIR on deploy, as with
+prometheus_client's multiprocess mode.
+
+Metrics are off unless METRICS_ENABLED=1, since /metrics is only protected
+when METRICS_TOKEN is set.
+
+Also instrumented here:
+- HTTP requests: latency, count by status, and SQL statements and SQL time per request.
+- Every SQL statement, through engine events.
+"""
+import bisect
+import glob
+import json
+import logging
+import os
+import threading
+import time
+
+from flask import g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+# name -> (type, help, histogram buckets)
+DEFINITIONS = {
+    'http_requests_total': ('counter', 'HTTP requests by endpoint, method and status.', None),
+    'http_request_seconds': ('histogram', 'HTTP request latency by endpoint.', LATENCY_BUCKETS),
+    'http_request_sql_statements': ('histogram', 'SQL statements run per HTTP request, by endpoint.', COUNT_BUCKETS),
+    'http_request_sql_seconds': ('histogram', 'Time spent in SQL per HTTP request, by endpoint.', LATENCY_BUCKETS),
+    'sql_statement_seconds': ('histogram', 'Latency of individual SQL statements.', LATENCY_BUCKETS),
+    'telegram_update_seconds': ('histogram', 'Telegram update handling time by callback action.', LATENCY_BUCKETS),
+    'telegram_update_errors_total': ('counter', 'Telegram updates whose handler raised, by callback action.', None),
+    'telegram_api_seconds': ('histogram', 'Telegram Bot API call latency by method.', LATENCY_BUCKETS),
+    'telegram_api_errors_total': ('counter', 'Failed Telegram Bot API calls by method.', None),
+    'nowpayments_request_seconds': ('histogram', 'NOWPayments API call latency by endpoint, per attempt.', LATENCY_BUCKETS),
+    'nowpayments_errors_total': ('counter', 'NOWPayments API calls that failed for good, by endpoint.', None),
+    'update_queue_depth': ('gauge', 'Telegram updates waiting for a queue worker.', None),
+    'outbound_queue_depth': ('gauge', 'Telegram messages waiting for their rate limit.', None),
+    'event_loop_in_flight': ('gauge', 'Coroutines running on the background event loop.', None),
+    'write_lane_depth': ('gauge', 'Writes waiting for the SQLite write lane.', None),
+    'password_hash_pending': ('gauge', 'Password hashes queued or running in the hashing pool.', None),
+    'cart_writer_pending': ('gauge', 'Carts with coalesced taps not yet written.', None),
+}
+
+
+def _queue_depths():
+    # Imported here: these modules are loaded after metrics by app/__init__.py.
+    from .carts import cart_writer
+    from .event_loop import background_loop
+    from .outbound import outbound
+    from .passwords import password_hasher
+    from .update_queue import update_queue
+    from .write_lane import write_lane
+    return {
+        'update_queue_depth': update_queue.depth(),
+        'outbound_queue_depth': outbound.depth(),
+        'event_loop_in_flight': background_loop.in_flight,
+        'write_lane_depth': write_lane.stats()['queued'],
+        'password_hash_pending': password_hasher.stats()['pending'],
+        'cart_writer_pending': cart_writer.stats()['pending_carts'],
+    }
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+class Metrics:
+    def __init__(self, app=None):
+        self.enabled = False
+        self.directory = None
+        self.flush_interval = 10.0
+        self.token = None
+        self._counters = {}      # (name, labels) -> value
+        self._histograms = {}    # (name, labels) -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+        self._pid = None
+        self._file_pid = None
+        self._file_name = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = bool(app.config.get('METRICS_ENABLED', False))
+        self.directory = app.config.get('METRICS_DIR') or os.path.join(app.instance_path, 'metrics')
+        self.flush_interval = float(app.config.get('METRICS_FLUSH_INTERVAL', 10))
+        self.token = app.config.get('METRICS_TOKEN')
+        app.extensions['metrics'] = self
+        if self.enabled:
+            app.before_request(self._start_request)
+            app.after_request(self._finish_request)
+
+    # --- Recording ---
+
+    def inc(self, name, amount=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        buckets = DEFINITIONS[name][2]
+        key = (name, _label_key(labels))
+        with self._lock:
+            series = self._histograms.get(key)
+            if series is None:
+                series = self._histograms[key] = [0] * (len(buckets) + 3)
+            # Counts per bucket (the last one is +Inf), then sum and count.
+            series[bisect.bisect_left(buckets, value)] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    # --- HTTP requests and SQL ---
+
+    def _start_request(self):
+        self._ensure_flushing()
+        g.metrics_started = time.perf_counter()
+        g.sql_statements = 0
+        g.sql_seconds = 0.0
+
+    def _finish_request(self, response):
+        started = g.pop('metrics_started', None)
+        if started is None:
+            return response
+        endpoint = request.endpoint or 'unmatched'
+        self.observe('http_request_seconds', time.perf_counter() - started, endpoint=endpoint)
+        self.inc('http_requests_total', endpoint=endpoint, method=request.method, status=str(response.status_code))
+        self.observe('http_request_sql_statements', g.get('sql_statements', 0), endpoint=endpoint)
+        self.observe('http_request_sql_seconds', g.get('sql_seconds', 0.0), endpoint=endpoint)
+        return response
+
+    def sql_executed(self, seconds):
+        self.observe('sql_statement_seconds', seconds)
+        # Only statements run on a request's own app context count toward that request.
+        if has_app_context() and 'sql_statements' in g:
+            g.sql_statements += 1
+            g.sql_seconds += seconds
+
+    # --- Snapshots ---
+
+    def snapshot(self):
+        """
+        This worker's metrics as a JSON-ready dict.
+        """
+        with self._lock:
+            counters = [[name, list(labels), value] for (name, labels), value in self._counters.items()]
+            histograms = [[name, list(labels), list(series)] for (name, labels), series in self._histograms.items()]
+        try:
+            gauges = [[name, [], value] for name, value in _queue_depths().items()]
+        except Exception as e:
+            logging.warning(f"--- Could not read queue depths for metrics: {e} ---")
+            gauges = []
+        return {'pid': os.getpid(), 'counters': counters, 'histograms': histograms, 'gauges': gauges}
+
+    def flush(self):
+        """
+        Writes this worker's snapshot to METRICS_DIR.
+        """
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, self._snapshot_name())
+            with open(f"{path}.tmp", 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(f"{path}.tmp", path)
+        except OSError as e:
+            logging.warning(f"--- Could not write metrics snapshot to {self.directory}: {e} ---")
+
+    def _snapshot_name(self):
+        # Named once per process; the start time tells apart workers that got the same pid.
+        if self._file_pid != os.getpid():
+            self._file_pid = os.getpid()
+            self._file_name = f"{self._file_pid}-{time.time_ns()}.json"
+        return self._file_name
+
+    def _ensure_flushing(self):
+        # One flusher thread per worker, started from its first request.
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        threading.Thread(target=self._flush_forever, name="metrics-flush", daemon=True).start()
+
+    def _flush_forever(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def collect(self):
+        """
+        Returns the metrics of all workers merged: {(name, labels): value or
+        histogram series}. Gauges carry each live worker's pid as a label.
+        """
+        self.flush()
+        merged = {}
+        for path in glob.glob(os.path.join(self.directory, '*.json')):
+            try:
+                with open(path) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue  # Being replaced right now, or left half-written by a killed worker.
+            for name, labels, value in snapshot['counters']:
+                key = (name, tuple(map(tuple, labels)))
+                merged[key] = merged.get(key, 0) + value
+            for name, labels, series in snapshot['histograms']:
+                key = (name, tuple(map(tuple, labels)))
+                total = merged.get(key)
+                merged[key] = series if total is None else [a + b for a, b in zip(total, series)]
+            if _alive(snapshot['pid']):
+                for name, labels, value in snapshot['gauges']:
+                    merged[(name, tuple(map(tuple, labels)) + (('pid', str(snapshot['pid'])),))] = value
+        return merged
+
+    def render(self):
+        """
+        All workers' metrics in the Prometheus text exposition format.
+        """
+        by_name = {}
+        for (name, labels), value in self.collect().items():
+            by_name.setdefault(name, []).append((labels, value))
+
+        lines = []
+        for name in sorted(by_name):
+            kind, help_text, buckets = DEFINITIONS.get(name, ('untyped', '', None))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in sorted(by_name[name]):
+                if kind != 'histogram':
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + ('+Inf',), value[:-2]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', str(bound)),))} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {value[-2]}")
+                lines.append(f"{name}_count{_format_labels(labels)} {value[-1]}")
+        return '\n'.join(lines) + '\n'
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass  # Exists, but owned by another user.
+    return True
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels) + '}'
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _sql_started(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('metrics_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _sql_finished(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('metrics_started')
+    if started:
+        metrics.sql_executed(time.perf_counter() - started.pop())
+
+
+@event.listens_for(Engine, 'handle_error')
+def _sql_failed(exception_context):
+    # after_cursor_execute does not run for a failed statement.
+    started = exception_context.connection.info.get('metrics_started') if exception_context.connection else None
+    if started:
+        started.pop()
+
+
+metrics = Metrics()
@@ -28,7 +28,9 @@ class Bot(db.Model):
     token = db.Column(db.String(100), unique=True, nullable=False)
     wallet = db.Column(db.String(100), nullable=False)
     welcome_message = db.Column(db.String(1024), default="Welcome to my shop!")
-    user_id = db.Column(db.String(36), db.ForeignKey('user.id'), nullable=False)
+    # Bumped by every category/product/price tier edit; browsing caches key off it.
+    catalog_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    user_id = db.Column(db.String(36), db.ForeignKey('user.id'), nullable=False, index=True)
     
     owner = db.relationship('User', back_populates='bots')
     categories = db.relationship('Category', back_populates='bot', lazy=True, cascade="all, delete-orphan")
@@ -53,6 +55,8 @@ class Category(db.Model):
     bot = db.relationship('Bot', back_populates='categories')
     sub_categories = db.relationship('Category', backref=db.backref('parent', remote_side=[id]), cascade="all, delete-orphan")
     products = db.relationship('Product', back_populates='category', lazy=True, cascade="all, delete-orphan")
+
+    __table_args__ = (db.Index('ix_category_bot_parent', 'bot_id', 'parent_id'),)
     
     def to_dict(self): 
         return {
@@ -68,7 +72,10 @@ class Product(db.Model):
     unit = db.Column(db.String(20), default='item')
     image_url = db.Column(db.Text, nullable=True)
     video_url = db.Column(db.Text, nullable=True)
-    category_id = db.Column(db.String(36), db.ForeignKey('category.id'), nullable=False)
+    # Telegram file_id from the first successful send of image_url. File ids are only
+    # valid for the bot that received them, which is fine since a product has one bot.
+    image_file_id = db.Column(db.Text, nullable=True)
+    category_id = db.Column(db.String(36), db.ForeignKey('category.id'), nullable=False, index=True)
     
     category = db.relationship('Category', back_populates='products')
     price_tiers = db.relationship('PriceTier', back_populates='product', lazy=True, cascade="all, delete-orphan")
@@ -84,7 +91,7 @@ class PriceTier(db.Model):
     id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
     label = db.Column(db.String(100), nullable=False)
     price = db.Column(db.Float, nullable=False)
-    product_id = db.Column(db.String(36), db.ForeignKey('product.id'), nullable=False)
+    product_id = db.Column(db.String(36), db.ForeignKey('product.id'), nullable=False, index=True)
     
     product = db.relationship('Product', back_populates='price_tiers')
     cart_items = db.relationship('CartItem', back_populates='price_tier')
@@ -126,6 +133,19 @@ class Order(db.Model):
             'amount_paid': self.amount_paid
         }
 
+    __table_args__ = (
+        # The owner's order listing: newest first, optionally narrowed by status or payout status.
+        db.Index('ix_order_bot_timestamp', 'bot_id', 'timestamp', 'id'),
+        db.Index('ix_order_bot_status_timestamp', 'bot_id', 'status', 'timestamp', 'id'),
+        db.Index('ix_order_bot_payout_timestamp', 'bot_id', 'payout_status', 'timestamp', 'id'),
+        # A customer's orders in one shop ("My Orders").
+        db.Index('ix_order_bot_chat_timestamp', 'bot_id', 'chat_id', 'timestamp'),
+        # Orders waiting on a reply, read when backfilling conversation states.
+        db.Index('ix_order_status_chat', 'status', 'chat_id'),
+        # The platform-wide order log and recent orders on the admin dashboard.
+        db.Index('ix_order_timestamp', 'timestamp', 'id'),
+    )
+
 class Cart(db.Model):
     id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
     chat_id = db.Column(db.String(100), nullable=False)
@@ -141,4 +161,69 @@ class CartItem(db.Model):
     quantity = db.Column(db.Integer, nullable=False, default=1)
     
     cart = db.relationship('Cart', back_populates='items')
-    price_tier = db.relationship('PriceTier', back_populates='cart_items')
\ No newline at end of file
+    price_tier = db.relationship('PriceTier', back_populates='cart_items')
+
+    # One row per tier per cart; adding to the cart is an upsert against this index.
+    __table_args__ = (db.Index('ux_cart_item_tier', 'cart_id', 'price_tier_id', unique=True),)
+
+
+class IpnEvent(db.Model):
+    """
+    A verified NOWPayments IPN, stored before anything else happens to it.
+    The (payment_id, payment_status) constraint turns redeliveries into a
+    cheap insert conflict; the background consumer applies the rest.
+    """
+    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    payment_id = db.Column(db.String(64), nullable=False)
+    payment_status = db.Column(db.String(30), nullable=False)
+    order_id = db.Column(db.String(36), nullable=True)
+    payload = db.Column(db.Text, nullable=False)
+    received_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, nullable=False)
+    claimed_by = db.Column(db.String(100), nullable=True)
+    claimed_at = db.Column(db.DateTime, nullable=True)
+    processed_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.UniqueConstraint('payment_id', 'payment_status', name='_payment_status_uc'),
+        db.Index('ix_ipn_event_pending', 'processed_at', 'received_at'),
+        db.Index('ix_ipn_event_claimed', 'claimed_by', 'processed_at'),
+    )
+
+class ProcessedUpdate(db.Model):
+    """
+    Telegram update_ids already accepted per bot, so retried webhook
+    deliveries are recognised after a worker restart. Only written when
+    TELEGRAM_DEDUPE_PERSIST is on; old rows are pruned by the deduper.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    bot_id = db.Column(db.String(36), nullable=False)
+    update_id = db.Column(db.BigInteger, nullable=False)
+    received_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, nullable=False, index=True)
+
+    __table_args__ = (db.UniqueConstraint('bot_id', 'update_id', name='_bot_update_uc'),)
+
+class ConversationState(db.Model):
+    """
+    What the bot is waiting for from a chat, e.g. a shipping address for an
+    order. Lets the free-text handler skip the orders table for ordinary messages.
+    """
+    bot_id = db.Column(db.String(36), primary_key=True)
+    chat_id = db.Column(db.String(100), primary_key=True)
+    state = db.Column(db.String(30), nullable=False)
+    order_id = db.Column(db.String(36), nullable=True)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+class SalesRollup(db.Model):
+    """
+    Order counts and totals per bot, day, status and payment currency. Kept
+    up to date by app/rollups.py on every order change, so dashboards read
+    a few rows per day instead of scanning the orders table.
+    """
+    bot_id = db.Column(db.String(36), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    status = db.Column(db.String(30), primary_key=True)
+    # '' until the customer has paid in a specific currency.
+    currency = db.Column(db.String(20), primary_key=True, default='')
+    order_count = db.Column(db.Integer, nullable=False, default=0)
+    price_total = db.Column(db.Float, nullable=False, default=0.0)
+    amount_paid_total = db.Column(db.Float, nullable=False, default=0.0)
@@ -0,0 +1,143 @@
+"""
+Async NOWPayments API client.
+
+All calls share one httpx.AsyncClient per worker process, living on the
+background event loop, so connections to the payment provider are reused and
+a slow response never blocks the loop. Every call has a timeout. Idempotent
+calls are retried with exponential backoff. Non-idempotent calls (creating a
+payment) are only retried when the connection failed before anything was
+sent. Per-endpoint latency and error counts are kept for runtime stats.
+"""
+import asyncio
+import collections
+import logging
+import os
+import random
+import time
+
+import httpx
+
+from .metrics import metrics
+
+RETRYABLE_STATUS = frozenset({429, 500, 502, 503, 504})
+# Failures where the request never reached the server, so even a POST is safe to resend.
+NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class NowPaymentsError(Exception):
+    def __init__(self, message, status_code=None, body=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.body = body
+
+
+def _new_endpoint_stats():
+    return {'calls': 0, 'errors': 0, 'retries': 0, 'seconds_total': 0.0, 'seconds_max': 0.0}
+
+
+class NowPaymentsClient:
+    def __init__(self, app=None):
+        self.api_url = 'https://api.nowpayments.io'
+        self.api_key = None
+        self.timeout = 10.0
+        self.max_retries = 2
+        self.pool_size = 10
+        self._client = None
+        self._pid = None
+        self._stats = collections.defaultdict(_new_endpoint_stats)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.api_url = app.config.get('NOWPAYMENTS_API_URL', self.api_url).rstrip('/')
+        self.api_key = app.config.get('NOWPAYMENTS_API_KEY')
+        self.timeout = float(app.config.get('NOWPAYMENTS_TIMEOUT', 10))
+        self.max_retries = int(app.config.get('NOWPAYMENTS_MAX_RETRIES', 2))
+        self.pool_size = int(app.config.get('NOWPAYMENTS_POOL_SIZE', 10))
+        app.extensions['nowpayments'] = self
+
+    @property
+    def client(self):
+        # Built on first use inside the background loop, once per process.
+        if self._client is None or self._pid != os.getpid():
+            self._client = httpx.AsyncClient(
+                base_url=self.api_url,
+                timeout=httpx.Timeout(self.timeout, connect=min(self.timeout, 5.0)),
+                limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+            )
+            self._pid = os.getpid()
+        return self._client
+
+    async def _request(self, method, path, idempotent, endpoint=None, **kwargs):
+        # `endpoint` names the call for stats when the path has ids in it.
+        endpoint = endpoint or f"{method} {path}"
+        stats = self._stats[endpoint]
+        headers = {'x-api-key': self.api_key or ''}
+        attempt = 0
+        while True:
+            stats['calls'] += 1
+            started = time.monotonic()
+            retry_reason = None
+            try:
+                response = await self.client.request(method, path, headers=headers, **kwargs)
+                if response.status_code in RETRYABLE_STATUS and idempotent:
+                    retry_reason = f"HTTP {response.status_code}"
+                elif response.is_error:
+                    stats['errors'] += 1
+                    metrics.inc('nowpayments_errors_total', endpoint=endpoint)
+                    raise NowPaymentsError(
+                        f"NOWPayments {method} {path} failed: {response.status_code} {response.text}",
+                        status_code=response.status_code, body=response.text
+                    )
+                else:
+                    try:
+                        return response.json()
+                    except ValueError as e:
+                        # A 2xx with a non-JSON body, e.g. an HTML page from a proxy.
+                        stats['errors'] += 1
+                        metrics.inc('nowpayments_errors_total', endpoint=endpoint)
+                        raise NowPaymentsError(
+                            f"NOWPayments {method} {path} returned a body that is not JSON: {response.text[:200]}",
+                            status_code=response.status_code, body=response.text
+                        ) from e
+            except NOT_SENT_ERRORS as e:
+                retry_reason = repr(e)
+            except httpx.HTTPError as e:
+                if not idempotent:
+                    stats['errors'] += 1
+                    metrics.inc('nowpayments_errors_total', endpoint=endpoint)
+                    raise NowPaymentsError(f"NOWPayments {method} {path} failed: {e!r}") from e
+                retry_reason = repr(e)
+            finally:
+                elapsed = time.monotonic() - started
+                stats['seconds_total'] += elapsed
+                stats['seconds_max'] = max(stats['seconds_max'], elapsed)
+                metrics.observe('nowpayments_request_seconds', elapsed, endpoint=endpoint)
+
+            if attempt >= self.max_retries:
+                stats['errors'] += 1
+                metrics.inc('nowpayments_errors_total', endpoint=endpoint)
+                raise NowPaymentsError(f"NOWPayments {method} {path} failed after {attempt + 1} attempts: {retry_reason}")
+            attempt += 1
+            stats['retries'] += 1
+            delay = 0.25 * (2 ** (attempt - 1)) * (1 + random.random())
+            logging.warning(f"--- NOWPayments {method} {path}: {retry_reason}, retrying in {delay:.2f}s ---")
+            await asyncio.sleep(delay)
+
+    async def full_currencies(self):
+        return await self._request('GET', '/v1/full-currencies', idempotent=True)
+
+    async def create_payment(self, payload):
+        return await self._request('POST', '/v1/payment', idempotent=False, json=payload)
+
+    async def payment_status(self, payment_id):
+        return await self._request('GET', f'/v1/payment/{payment_id}', idempotent=True, endpoint='GET /v1/payment/{id}')
+
+    def stats(self):
+        return {
+            endpoint: dict(s, seconds_avg=round(s['seconds_total'] / s['calls'], 4) if s['calls'] else 0.0)
+            for endpoint, s in list(self._stats.items())
+        }
+
+
+nowpayments = NowPaymentsClient()
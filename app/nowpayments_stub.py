@@ -0,0 +1,109 @@
+"""
+A local stand-in for the NOWPayments API, for tests and load runs.
+
+Run it with:
+
+    python -m app.nowpayments_stub --port 8099 [--latency-ms 50]
+
+then start the shop with NOWPAYMENTS_API_URL=http://127.0.0.1:8099 and
+SERVER_URL=http://127.0.0.1:5000 (wherever the shop listens).
+
+Besides the currency list and payment creation it exposes
+POST /stub/payments/<payment_id>/ipn?status=finished, which sends a signed IPN
+for that payment to its ipn_callback_url, the same way NOWPayments does. The
+IPN is signed with NOWPAYMENTS_IPN_SECRET_KEY. IPNs are only ever sent to
+local hosts, so a shop still pointing SERVER_URL at production gets a 400
+rather than a forged payment.
+"""
+import argparse
+import hashlib
+import hmac
+import itertools
+import json
+import os
+import time
+from urllib.parse import urlsplit
+
+import requests
+from flask import Flask, jsonify, request
+
+LOCAL_HOSTS = {'127.0.0.1', 'localhost', '::1'}
+CURRENCIES = ['btc', 'eth', 'ltc', 'usdttrc20', 'xmr', 'doge', 'trx', 'sol', 'bnbbsc', 'usdc']
+
+
+def sign_ipn(payload, secret):
+    sorted_payload = json.dumps(payload, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    return hmac.new(secret.encode('utf-8'), sorted_payload, hashlib.sha512).hexdigest()
+
+
+def create_stub_app(latency_ms=0, ipn_secret=None):
+    app = Flask(__name__)
+    payments = {}
+    payment_ids = itertools.count(5000000000)
+    ipn_secret = ipn_secret or os.environ.get('NOWPAYMENTS_IPN_SECRET_KEY', 'stub-secret')
+
+    @app.before_request
+    def simulate_latency():
+        if latency_ms:
+            time.sleep(latency_ms / 1000)
+
+    @app.route('/v1/full-currencies', methods=['GET'])
+    def full_currencies():
+        return jsonify({'currencies': [{'code': code, 'available_for_payment': True} for code in CURRENCIES]})
+
+    @app.route('/v1/payment', methods=['POST'])
+    def create_payment():
+        data = request.get_json()
+        if not data or 'price_amount' not in data or 'pay_currency' not in data:
+            return jsonify({'message': 'price_amount and pay_currency are required'}), 400
+        payment_id = next(payment_ids)
+        payment = {
+            'payment_id': payment_id,
+            'payment_status': 'waiting',
+            'pay_address': f"stub-{data['pay_currency']}-address-{payment_id}",
+            'price_amount': data['price_amount'],
+            'price_currency': data.get('price_currency', 'usd'),
+            'pay_amount': round(float(data['price_amount']) / 1000, 8),
+            'pay_currency': data['pay_currency'],
+            'order_id': data.get('order_id'),
+            'ipn_callback_url': data.get('ipn_callback_url'),
+        }
+        payments[payment_id] = payment
+        return jsonify(payment), 201
+
+    @app.route('/v1/payment/<int:payment_id>', methods=['GET'])
+    def payment_status(payment_id):
+        payment = payments.get(payment_id)
+        if not payment:
+            return jsonify({'message': 'Payment not found'}), 404
+        return jsonify(payment)
+
+    @app.route('/stub/payments/<int:payment_id>/ipn', methods=['POST'])
+    def send_ipn(payment_id):
+        payment = payments.get(payment_id)
+        if not payment:
+            return jsonify({'message': 'Payment not found'}), 404
+        payment['payment_status'] = request.args.get('status', 'finished')
+        payload = {k: v for k, v in payment.items() if k != 'ipn_callback_url'}
+        if 'pay_amount' in request.args:
+            payload['pay_amount'] = float(request.args['pay_amount'])
+        callback_url = request.args.get('callback_url') or payment['ipn_callback_url']
+        if not callback_url or urlsplit(callback_url).hostname not in LOCAL_HOSTS:
+            return jsonify({'message': f"Refusing to send an IPN to {callback_url!r}: only local hosts are allowed. "
+                                       "Start the shop with SERVER_URL=http://127.0.0.1:<port>."}), 400
+        response = requests.post(
+            callback_url, data=json.dumps(payload),
+            headers={'Content-Type': 'application/json', 'x-nowpayments-sig': sign_ipn(payload, ipn_secret)},
+            timeout=10
+        )
+        return jsonify({'callback_status': response.status_code, 'payload': payload})
+
+    return app
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local NOWPayments stand-in.")
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--latency-ms', type=int, default=0)
+    args = parser.parse_args()
+    create_stub_app(latency_ms=args.latency_ms).run(host='127.0.0.1', port=args.port, threaded=True)
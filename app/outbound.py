@@ -0,0 +1,309 @@
+"""
+Outbound Telegram send scheduler.
+
+Every message-producing Bot API call waits here for a token from two token
+buckets: one per bot (Telegram's global ~30 msg/s limit) and one per chat
+(~1 msg/s in private chats, 20/min in groups). Waiting calls are granted in
+priority order, so interactive replies overtake bulk sends such as product
+listings, while each chat keeps its own FIFO order.
+Edits of existing messages only spend from the bot's bucket and queue apart
+from the chat's sends, so menu navigation is never held back by a product
+listing still going out; they do wait out a chat's RetryAfter.
+A RetryAfter from Telegram blocks that chat (or the whole bot) for the
+requested time, and the call is requeued at the front of its chat's queue.
+
+Bots get this for free by being ScheduledBot instances (see bot_clients), so
+call sites keep using the normal telegram.Bot API.
+"""
+import asyncio
+import collections
+import contextlib
+import contextvars
+import datetime
+import functools
+import itertools
+import logging
+import os
+import time
+
+import telegram
+
+INTERACTIVE = 0
+BULK = 1
+
+# Endpoints that send new messages and so count against both the bot and the chat limits.
+CHAT_LIMITED_ENDPOINTS = frozenset({
+    'sendMessage', 'sendPhoto', 'sendVideo', 'sendDocument', 'sendAnimation', 'sendMediaGroup',
+})
+# Endpoints that count against Telegram's message rate limits.
+RATE_LIMITED_ENDPOINTS = CHAT_LIMITED_ENDPOINTS | {
+    'editMessageText', 'editMessageCaption', 'editMessageMedia', 'editMessageReplyMarkup',
+}
+
+_priority = contextvars.ContextVar('outbound_priority', default=INTERACTIVE)
+
+
+@contextlib.contextmanager
+def bulk():
+    """
+    Sends made inside this block yield to interactive replies.
+    """
+    token = _priority.set(BULK)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def _retry_after_seconds(error):
+    retry_after = error.retry_after
+    if isinstance(retry_after, datetime.timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated', 'blocked_until')
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+        self.blocked_until = 0.0
+
+    def wait_time(self, now, cost=1):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        wait = max(0.0, self.blocked_until - now)
+        # Calls costing more than the burst (albums) only need a full bucket and go into debt.
+        needed = min(cost, self.capacity)
+        if cost and self.tokens < needed:
+            wait = max(wait, (needed - self.tokens) / self.rate)
+        return wait
+
+    def take(self, cost=1):
+        self.tokens -= cost
+
+    def idle(self, now):
+        return self.tokens >= self.capacity and self.blocked_until <= now
+
+
+class _Pending:
+    __slots__ = ('priority', 'seq', 'bot_key', 'cost', 'chat_cost', 'future')
+
+    def __init__(self, priority, seq, bot_key, cost, chat_cost, future):
+        self.priority = priority
+        self.seq = seq
+        self.bot_key = bot_key
+        self.cost = cost
+        self.chat_cost = chat_cost
+        self.future = future
+
+
+def _new_bot_stats():
+    return {
+        'sent': 0, 'errors': 0, 'throttled': 0, 'deferred': 0,
+        'wait_seconds_total': 0.0, 'wait_seconds_max': 0.0,
+        'send_seconds_total': 0.0, 'send_seconds_max': 0.0,
+    }
+
+
+class OutboundScheduler:
+    def __init__(self, app=None):
+        self.bot_rate = 30.0
+        self.chat_rate = 1.0
+        self.chat_burst = 3
+        self.group_rate = 20 / 60
+        self.max_retries = 3
+        self._chats = {}
+        self._bot_buckets = {}
+        self._chat_buckets = {}
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._task = None
+        self._pid = None
+        self._bot_stats = collections.defaultdict(_new_bot_stats)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.bot_rate = float(app.config.get('TELEGRAM_BOT_RATE', 30))
+        self.chat_rate = float(app.config.get('TELEGRAM_CHAT_RATE', 1))
+        self.chat_burst = max(1, int(app.config.get('TELEGRAM_CHAT_BURST', 3)))
+        self.group_rate = float(app.config.get('TELEGRAM_GROUP_RATE', 20 / 60))
+        self.max_retries = int(app.config.get('TELEGRAM_MAX_RETRIES', 3))
+        app.extensions['outbound'] = self
+
+    # --- Buckets ---
+
+    def _bot_bucket(self, bot_key, now):
+        bucket = self._bot_buckets.get(bot_key)
+        if bucket is None:
+            bucket = self._bot_buckets[bot_key] = TokenBucket(self.bot_rate, self.bot_rate, now)
+        return bucket
+
+    def _chat_bucket(self, chat_key, now):
+        bucket = self._chat_buckets.get(chat_key)
+        if bucket is None:
+            # Group and channel ids are negative.
+            rate = self.group_rate if str(chat_key[1]).startswith('-') else self.chat_rate
+            bucket = self._chat_buckets[chat_key] = TokenBucket(rate, self.chat_burst, now)
+        return bucket
+
+    def _prune(self, now):
+        for buckets in (self._chat_buckets, self._bot_buckets):
+            for key in [k for k, b in buckets.items() if b.idle(now) and k not in self._chats]:
+                del buckets[key]
+
+    # --- Dispatcher ---
+
+    def _ensure_running(self):
+        if self._task is not None and self._pid == os.getpid() and not self._task.done():
+            return
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._dispatch(), name="outbound-dispatcher")
+        self._pid = os.getpid()
+
+    async def _dispatch(self):
+        last_prune = time.monotonic()
+        while True:
+            now = time.monotonic()
+            best_key, best, next_wake = None, None, None
+            for chat_key, queue in list(self._chats.items()):
+                item = queue[0]
+                if item.future.done():
+                    # The caller went away (cancelled); drop it without spending tokens.
+                    queue.popleft()
+                    if not queue:
+                        del self._chats[chat_key]
+                    continue
+                wait = self._bot_bucket(item.bot_key, now).wait_time(now, item.cost)
+                if chat_key[1] is not None:
+                    wait = max(wait, self._chat_bucket(chat_key[:2], now).wait_time(now, item.chat_cost))
+                if wait > 0:
+                    next_wake = wait if next_wake is None else min(next_wake, wait)
+                    continue
+                if best is None or (item.priority, item.seq) < (best.priority, best.seq):
+                    best_key, best = chat_key, item
+
+            if best is not None:
+                queue = self._chats[best_key]
+                queue.popleft()
+                if not queue:
+                    del self._chats[best_key]
+                self._bot_bucket(best.bot_key, now).take(best.cost)
+                if best_key[1] is not None:
+                    self._chat_bucket(best_key[:2], now).take(best.chat_cost)
+                best.future.set_result(None)
+                continue
+
+            if now - last_prune > 60:
+                self._prune(now)
+                last_prune = now
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), next_wake)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _acquire(self, bot_key, chat_id, cost, chat_cost, priority, seq, front):
+        self._ensure_running()
+        future = asyncio.get_running_loop().create_future()
+        item = _Pending(priority, seq, bot_key, cost, chat_cost, future)
+        # Edits get a queue of their own, so they never wait behind the chat's sends.
+        chat_key = (bot_key, chat_id) if chat_cost else (bot_key, chat_id, 'edits')
+        queue = self._chats.setdefault(chat_key, collections.deque())
+        if front:
+            queue.appendleft(item)
+        else:
+            queue.append(item)
+        self._wakeup.set()
+        await future
+
+    # --- Public API ---
+
+    async def call(self, bot, endpoint, data, send):
+        """
+        Waits for rate-limit clearance, then awaits `send()`. RetryAfter
+        responses are honoured and the call is requeued, up to max_retries.
+        """
+        bot_key = bot.token.split(':', 1)[0]
+        chat_id = data.get('chat_id')
+        chat_id = str(chat_id) if chat_id is not None else None
+        cost = max(len(data.get('media') or ()) if endpoint == 'sendMediaGroup' else 1, 1)
+        chat_cost = cost if endpoint in CHAT_LIMITED_ENDPOINTS else 0
+        priority = _priority.get()
+        seq = next(self._seq)
+        stats = self._bot_stats[bot_key]
+        attempt = 0
+
+        while True:
+            enqueued_at = time.monotonic()
+            await self._acquire(bot_key, chat_id, cost, chat_cost, priority, seq, front=attempt > 0)
+            started = time.monotonic()
+            waited = started - enqueued_at
+            stats['wait_seconds_total'] += waited
+            stats['wait_seconds_max'] = max(stats['wait_seconds_max'], waited)
+            if waited > 0.001:
+                stats['deferred'] += 1
+
+            try:
+                result = await send()
+            except telegram.error.RetryAfter as e:
+                delay = _retry_after_seconds(e)
+                stats['throttled'] += 1
+                self._block(bot_key, chat_id, delay)
+                attempt += 1
+                logging.warning(f"--- Telegram asked bot {bot_key} to retry {endpoint} after {delay}s (attempt {attempt}) ---")
+                if attempt > self.max_retries:
+                    stats['errors'] += 1
+                    raise
+                continue
+            except Exception:
+                stats['errors'] += 1
+                raise
+            finally:
+                elapsed = time.monotonic() - started
+                stats['send_seconds_total'] += elapsed
+                stats['send_seconds_max'] = max(stats['send_seconds_max'], elapsed)
+
+            stats['sent'] += 1
+            return result
+
+    def _block(self, bot_key, chat_id, delay):
+        now = time.monotonic()
+        if chat_id is not None:
+            bucket = self._chat_bucket((bot_key, chat_id), now)
+        else:
+            bucket = self._bot_bucket(bot_key, now)
+        bucket.blocked_until = max(bucket.blocked_until, now + delay)
+
+    def depth(self):
+        return sum(len(queue) for queue in self._chats.values())
+
+    def stats(self):
+        bots = {}
+        for bot_key, s in list(self._bot_stats.items()):
+            attempts = s['sent'] + s['errors'] + s['throttled']
+            bots[bot_key] = dict(
+                s,
+                wait_seconds_avg=round(s['wait_seconds_total'] / attempts, 4) if attempts else 0.0,
+                send_seconds_avg=round(s['send_seconds_total'] / attempts, 4) if attempts else 0.0,
+            )
+        return {'queued': self.depth(), 'bots': bots}
+
+
+outbound = OutboundScheduler()
+
+
+class ScheduledBot(telegram.Bot):
+    """
+    A telegram.Bot whose message-producing calls go through the scheduler.
+    """
+
+    async def _do_post(self, endpoint, data, **kwargs):
+        send = functools.partial(super()._do_post, endpoint, data, **kwargs)
+        if endpoint not in RATE_LIMITED_ENDPOINTS:
+            return await send()
+        return await outbound.call(self, endpoint, data, send)
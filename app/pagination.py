@@ -0,0 +1,87 @@
+"""
+Keyset pagination and filters for order listings.
+
+Orders are listed newest first, ordered by (timestamp, id). A page ends with
+an opaque cursor that encodes the last row's key, and the next page starts
+strictly after it. Each page is therefore one index range scan, however deep
+the caller has paged, and rows inserted meanwhile cannot shift the pages.
+"""
+import base64
+import datetime
+
+from sqlalchemy import tuple_
+
+from .models import Order
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+def encode_cursor(timestamp, order_id):
+    raw = f"{timestamp.isoformat()}|{order_id}"
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    Returns the (timestamp, id) encoded in `cursor`. Raises ValueError if it is malformed.
+    """
+    try:
+        timestamp, order_id = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').split('|', 1)
+        return datetime.datetime.fromisoformat(timestamp), order_id
+    except (UnicodeError, ValueError, TypeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from e
+
+
+def _parse_date(value, name):
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"{name} must be an ISO date or datetime, e.g. 2024-05-01")
+
+
+def order_filters(args):
+    """
+    Builds filter criteria from request args. `status` and `payout_status`
+    take comma-separated values. `from` and `to` are ISO dates; a bare `to`
+    date includes that whole day. Raises ValueError on bad input.
+    """
+    criteria = []
+    if args.get('status'):
+        criteria.append(Order.status.in_(args['status'].split(',')))
+    if args.get('payout_status'):
+        criteria.append(Order.payout_status.in_(args['payout_status'].split(',')))
+    if args.get('from'):
+        criteria.append(Order.timestamp >= _parse_date(args['from'], 'from'))
+    if args.get('to'):
+        end = _parse_date(args['to'], 'to')
+        if len(args['to']) == 10:
+            end += datetime.timedelta(days=1)
+            criteria.append(Order.timestamp < end)
+        else:
+            criteria.append(Order.timestamp <= end)
+    return criteria
+
+
+def page_size(args):
+    try:
+        limit = int(args.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        raise ValueError("limit must be a number")
+    return min(max(limit, 1), MAX_PAGE_SIZE)
+
+
+def keyset_page(query, cursor=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    Applies newest-first keyset pagination to a query whose rows start with
+    ORDER_COLUMNS (so row[0] is the id and row[3] the timestamp). Returns the
+    rows and the cursor for the next page, or None on the last page.
+    """
+    if cursor:
+        timestamp, order_id = decode_cursor(cursor)
+        query = query.filter(tuple_(Order.timestamp, Order.id) < tuple_(timestamp, order_id))
+    rows = query.order_by(Order.timestamp.desc(), Order.id.desc()).limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(rows[-1][3], rows[-1][0])
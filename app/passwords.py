@@ -0,0 +1,204 @@
+"""
+Password hashing off the request thread, with login throttling.
+
+Hashing is slow by design, and on a web worker it competes with webhook
+traffic. PasswordHasher runs werkzeug's hash and verify functions in a small
+process pool. Requests only wait on a future, which releases the GIL. The pool
+takes at most PASSWORD_HASH_QUEUE jobs at once; beyond that it raises
+HasherBusy, which the routes turn into a 503, so a login storm cannot queue
+up unbounded work. Hashes made with other parameters than
+PASSWORD_HASH_METHOD are flagged so the caller can rehash after a successful
+login. PASSWORD_HASH_WORKERS=0 hashes inline, as before.
+
+LoginThrottle counts failed logins per email and per client IP over a
+sliding window, and refuses further attempts (429) before any hashing is done.
+"""
+import collections
+import concurrent.futures
+import concurrent.futures.process
+import multiprocessing
+import os
+import threading
+import time
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+SWEEP_EVERY = 1000  # Failed logins between sweeps of expired throttle keys.
+
+
+class HasherBusy(Exception):
+    pass
+
+
+def _hash_prefix(pwhash):
+    return pwhash.split('$', 1)[0]
+
+
+class PasswordHasher:
+    def __init__(self, app=None):
+        self.workers = 2
+        self.max_pending = 32
+        self.timeout = 10.0
+        self.method = 'scrypt'
+        self._current_prefix = None
+        self._pool = None
+        self._pid = None
+        self._pending = 0
+        self._lock = threading.Lock()
+        self.rejected = 0
+        self.completed = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.workers = max(0, int(app.config.get('PASSWORD_HASH_WORKERS', 2)))
+        self.max_pending = max(1, int(app.config.get('PASSWORD_HASH_QUEUE', 32)))
+        self.timeout = float(app.config.get('PASSWORD_HASH_TIMEOUT', 10))
+        self.method = app.config.get('PASSWORD_HASH_METHOD', 'scrypt')
+        self._current_prefix = None
+        self.current_prefix()
+        app.extensions['password_hasher'] = self
+
+    def _executor(self):
+        # A pool must not be inherited across a fork; 'spawn' also keeps the
+        # background loop's threads out of the children.
+        if self._pool is None or self._pid != os.getpid():
+            self._pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context('spawn')
+            )
+            self._pid = os.getpid()
+        return self._pool
+
+    def _run(self, fn, *args):
+        if not self.workers:
+            return fn(*args)
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self.rejected += 1
+                raise HasherBusy(f"{self._pending} password hashes already queued")
+            self._pending += 1
+        future = None
+        try:
+            future = self._executor().submit(fn, *args)
+            # The slot is freed when the job ends, not when a caller stops waiting for it.
+            future.add_done_callback(self._job_done)
+            return future.result(timeout=self.timeout)
+        except concurrent.futures.TimeoutError:
+            raise HasherBusy(f"password hash took longer than {self.timeout}s")
+        except concurrent.futures.process.BrokenProcessPool:
+            # A worker died (e.g. OOM-killed); start a fresh pool on the next call.
+            self._pool = None
+            raise HasherBusy("password hashing pool was restarted")
+        finally:
+            if future is None:
+                self._job_done(None)
+
+    def _job_done(self, future):
+        with self._lock:
+            self._pending -= 1
+            self.completed += 1
+
+    def hash(self, password):
+        """
+        Returns a new hash of `password` made with the configured method.
+        Raises HasherBusy if the pool is saturated.
+        """
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, pwhash, password):
+        """
+        Returns (matches, needs_rehash). Raises HasherBusy if the pool is saturated.
+        """
+        matches = self._run(check_password_hash, pwhash, password)
+        return matches, matches and _hash_prefix(pwhash) != self.current_prefix()
+
+    def current_prefix(self):
+        """
+        The parameter prefix (e.g. "scrypt:32768:8:1") that new hashes get.
+        """
+        if self._current_prefix is None:
+            # Hashed here rather than in the pool, so a busy pool cannot fail a correct login.
+            self._current_prefix = _hash_prefix(generate_password_hash('prefix-probe', self.method))
+        return self._current_prefix
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'pending': self._pending,
+            'max_pending': self.max_pending,
+            'completed': self.completed,
+            'rejected': self.rejected,
+        }
+
+
+class LoginThrottle:
+    def __init__(self, app=None):
+        self.window = 300.0
+        self.max_per_email = 10
+        self.max_per_ip = 50
+        self._failures = collections.defaultdict(collections.deque)
+        self._lock = threading.Lock()
+        self._recorded = 0
+        self.throttled = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.window = float(app.config.get('LOGIN_THROTTLE_WINDOW', 300))
+        self.max_per_email = int(app.config.get('LOGIN_MAX_FAILURES_PER_EMAIL', 10))
+        self.max_per_ip = int(app.config.get('LOGIN_MAX_FAILURES_PER_IP', 50))
+        app.extensions['login_throttle'] = self
+
+    def _keys(self, email, ip):
+        keys = [(f"email:{(email or '').strip().lower()}", self.max_per_email)]
+        # A per-IP limit of 0 turns it off, e.g. behind a proxy whose hops are not configured.
+        if self.max_per_ip > 0:
+            keys.append((f"ip:{ip}", self.max_per_ip))
+        return keys
+
+    def _recent(self, key, now):
+        failures = self._failures.get(key)
+        if failures is None:
+            return 0
+        while failures and failures[0] <= now - self.window:
+            failures.popleft()
+        if not failures:
+            del self._failures[key]
+            return 0
+        return len(failures)
+
+    def retry_after(self, email, ip):
+        """
+        Returns how many seconds to wait if this email or IP has failed too
+        often, otherwise 0.
+        """
+        now = time.monotonic()
+        with self._lock:
+            for key, limit in self._keys(email, ip):
+                if self._recent(key, now) >= limit:
+                    self.throttled += 1
+                    return max(1, int(self._failures[key][0] + self.window - now))
+        return 0
+
+    def failed(self, email, ip):
+        now = time.monotonic()
+        with self._lock:
+            for key, _ in self._keys(email, ip):
+                self._failures[key].append(now)
+            self._recorded += 1
+            if self._recorded % SWEEP_EVERY == 0:
+                # Drop keys nobody has tried again within the window.
+                for key in list(self._failures):
+                    self._recent(key, now)
+
+    def succeeded(self, email, ip):
+        # Only the account's counter is reset; a shared IP keeps its history.
+        with self._lock:
+            self._failures.pop(self._keys(email, ip)[0][0], None)
+
+    def stats(self):
+        return {'tracked_keys': len(self._failures), 'throttled': self.throttled}
+
+
+password_hasher = PasswordHasher()
+login_throttle = LoginThrottle()
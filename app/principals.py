@@ -0,0 +1,113 @@
+"""
+Cached snapshots of the logged-in user for Flask-Login.
+
+`load_user` runs on every authenticated request. Instead of loading the User
+row, and then its bots for ownership checks, it returns a Principal: the user's
+id, admin and active flags and owned bot ids, loaded in one query and cached
+for PRINCIPAL_CACHE_TTL seconds. Ownership checks become set lookups. Admin
+changes to a user and bot creation or deletion invalidate the entry in this
+worker; other workers pick the change up when the TTL runs out, except that a
+failed ownership check reloads the principal once before denying, so a bot
+created in another worker is usable straight away.
+"""
+import threading
+import time
+
+from . import db
+
+
+class Principal:
+    """
+    The parts of a User that request handling needs. Implements the
+    Flask-Login user interface.
+    """
+    __slots__ = ('id', 'is_admin', '_active', 'bot_ids')
+
+    is_authenticated = True
+    is_anonymous = False
+
+    def __init__(self, user_id, is_admin, is_active, bot_ids):
+        self.id = user_id
+        self.is_admin = is_admin
+        self._active = is_active
+        self.bot_ids = frozenset(bot_ids)
+
+    @property
+    def is_active(self):
+        return self._active
+
+    def get_id(self):
+        return self.id
+
+    def owns(self, bot_id):
+        return bot_id in self.bot_ids
+
+
+class PrincipalCache:
+    def __init__(self, app=None):
+        self.ttl = 30
+        self.max_entries = 10000
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttl = float(app.config.get('PRINCIPAL_CACHE_TTL', 30))
+        self.max_entries = max(1, int(app.config.get('PRINCIPAL_CACHE_SIZE', 10000)))
+        app.extensions['principal_cache'] = self
+
+    def get(self, user_id):
+        """
+        Returns the Principal for `user_id`, or None if the user does not exist.
+        Must be called inside an app context.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+
+        self.misses += 1
+        principal = self._load(user_id)
+        if principal is not None:
+            with self._lock:
+                if len(self._entries) >= self.max_entries:
+                    self._entries.clear()
+                self._entries[user_id] = (now + self.ttl, principal)
+        return principal
+
+    @staticmethod
+    def _load(user_id):
+        from .models import Bot, User
+        rows = (
+            db.session.query(User.id, User.is_admin, User.is_active, Bot.id)
+            .outerjoin(Bot, Bot.user_id == User.id)
+            .filter(User.id == user_id)
+            .all()
+        )
+        if not rows:
+            return None
+        _, is_admin, is_active, _ = rows[0]
+        return Principal(user_id, is_admin, is_active, [row[3] for row in rows if row[3] is not None])
+
+    def refresh(self, user_id):
+        """
+        Reloads and caches the Principal for `user_id`, skipping the cached entry.
+        """
+        self.invalidate(user_id)
+        return self.get(user_id)
+
+    def invalidate(self, *user_ids):
+        with self._lock:
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+
+    def stats(self):
+        return {'users': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+principal_cache = PrincipalCache()
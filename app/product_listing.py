@@ -0,0 +1,166 @@
+"""
+Paged product listings for view_category.
+
+A category is shown one page at a time with a "More" button instead of one
+message per product for the whole category. Pages can be sent as
+send_media_group albums: one call carries up to ten photos in order, followed
+by a single message holding every "Add to cart" button for the page.
+
+Telegram does not order parallel requests to the same chat, so each chat's
+messages go out one after another under a per-chat lock. Different chats are
+served concurrently. Listing sends are marked bulk, so the outbound scheduler
+lets interactive replies overtake them under the rate limits.
+"""
+import asyncio
+import logging
+import weakref
+
+import telegram
+from flask import current_app
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
+
+from .event_loop import background_loop
+from .outbound import bulk
+from .media import cached_file_id, forget_file_id, is_stale_file_id_error, remember_file_id, send_product_photo
+
+MAX_ALBUM_SIZE = 10
+
+_chat_locks = weakref.WeakValueDictionary()
+
+
+def _chat_lock(bot, chat_id):
+    key = (bot.token, chat_id)
+    lock = _chat_locks.get(key)
+    if lock is None:
+        lock = _chat_locks[key] = asyncio.Lock()
+    return lock
+
+
+def product_caption(product):
+    caption = f"**{product.name}**\n{product.description or ''}\n\n"
+    for tier in product.price_tiers:
+        caption += f"- {tier.label}: £{tier.price}\n"
+    return caption
+
+
+def product_keyboard(product, label_prefix=''):
+    return [
+        [InlineKeyboardButton(f"Add {label_prefix}{tier.label} to Cart", callback_data=f"add_cart:{tier.id}")]
+        for tier in product.price_tiers
+    ]
+
+
+def listing_page_size():
+    page_size = current_app.config.get('PRODUCT_PAGE_SIZE', 5)
+    if current_app.config.get('PRODUCT_ALBUMS', False):
+        page_size = min(page_size, MAX_ALBUM_SIZE)
+    return page_size
+
+
+def page_count(category, page_size=None):
+    page_size = page_size or listing_page_size()
+    return max(1, (len(category.products) + page_size - 1) // page_size)
+
+
+def nav_keyboard(category, page, page_size, back_button_data):
+    rows = []
+    if page + 1 < page_count(category, page_size):
+        remaining = len(category.products) - (page + 1) * page_size
+        rows.append([InlineKeyboardButton(f"⬇️ More ({remaining})", callback_data=f"view_category:{category.id}:{page + 1}")])
+    rows.append([
+        InlineKeyboardButton("⬅️ Back", callback_data=back_button_data),
+        InlineKeyboardButton("🛒 View Cart", callback_data="view_cart"),
+        InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")
+    ])
+    return rows
+
+
+async def _send_individually(bot, chat_id, products):
+    for product in products:
+        caption = product_caption(product)
+        reply_markup = InlineKeyboardMarkup(product_keyboard(product))
+        try:
+            if product.image_url:
+                await send_product_photo(bot, product, chat_id=chat_id, caption=caption, reply_markup=reply_markup, parse_mode='Markdown')
+            else:
+                await bot.send_message(chat_id=chat_id, text=caption, reply_markup=reply_markup, parse_mode='Markdown')
+        except telegram.error.BadRequest:
+            await bot.send_message(chat_id=chat_id, text=caption, reply_markup=reply_markup, parse_mode='Markdown')
+
+
+async def _send_album(bot, chat_id, products):
+    """
+    Sends photo products as albums of up to ten. Returns the products that
+    could not be sent as photos, so they can be listed as text instead.
+    """
+    failed = []
+    for start in range(0, len(products), MAX_ALBUM_SIZE):
+        chunk = products[start:start + MAX_ALBUM_SIZE]
+        if len(chunk) == 1:
+            try:
+                await send_product_photo(bot, chunk[0], chat_id=chat_id, caption=product_caption(chunk[0]), parse_mode='Markdown')
+            except telegram.error.BadRequest:
+                failed.extend(chunk)
+            continue
+
+        file_ids = [cached_file_id(product) for product in chunk]
+        try:
+            messages = await bot.send_media_group(chat_id=chat_id, media=[
+                InputMediaPhoto(file_id or product.image_url, caption=product_caption(product), parse_mode='Markdown')
+                for product, file_id in zip(chunk, file_ids)
+            ])
+        except telegram.error.BadRequest as e:
+            if not any(file_ids) or not is_stale_file_id_error(e):
+                logging.warning(f"--- Album send failed, listing products as text: {e} ---")
+                failed.extend(chunk)
+                continue
+            # One stale file_id fails the whole album; retry once from the URLs.
+            for product, file_id in zip(chunk, file_ids):
+                if file_id:
+                    await background_loop.run_blocking(forget_file_id, product, file_id)
+            file_ids = [None] * len(chunk)
+            try:
+                messages = await bot.send_media_group(chat_id=chat_id, media=[
+                    InputMediaPhoto(product.image_url, caption=product_caption(product), parse_mode='Markdown')
+                    for product in chunk
+                ])
+            except telegram.error.BadRequest:
+                failed.extend(chunk)
+                continue
+
+        for product, file_id, message in zip(chunk, file_ids, messages):
+            if not file_id and message.photo:
+                await background_loop.run_blocking(remember_file_id, product, message.photo[-1].file_id)
+    return failed
+
+
+async def send_product_page(bot, chat_id, category, page, back_button_data):
+    """
+    Sends one page of a category's products, then a navigation message with
+    a "More" button when further pages exist.
+    """
+    use_albums = current_app.config.get('PRODUCT_ALBUMS', False)
+    page_size = listing_page_size()
+    products = category.products[page * page_size:(page + 1) * page_size]
+
+    async with _chat_lock(bot, chat_id):
+        with bulk():
+            if not use_albums:
+                await _send_individually(bot, chat_id, products)
+                await bot.send_message(chat_id=chat_id, text="What would you like to do next?",
+                                       reply_markup=InlineKeyboardMarkup(nav_keyboard(category, page, page_size, back_button_data)))
+                return
+
+            # Albums cannot carry buttons, so every tier button for the page goes on one message.
+            photo_products = [p for p in products if p.image_url]
+            text_products = [p for p in products if not p.image_url]
+            text_products += await _send_album(bot, chat_id, photo_products)
+
+            keyboard = []
+            for product in products:
+                keyboard.extend(product_keyboard(product, label_prefix=f"{product.name} "))
+            keyboard.extend(nav_keyboard(category, page, page_size, back_button_data))
+
+            text = "".join(product_caption(p) + "\n" for p in text_products) or "What would you like to do next?"
+            await bot.send_message(chat_id=chat_id, text=text,
+                                   reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
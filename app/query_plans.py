@@ -0,0 +1,148 @@
+"""
+EXPLAIN checks for the hot queries.
+
+Each entry in HOT_QUERIES builds the same statement a request path runs, with
+sample parameters. `check_query_plans()` asks the database for each plan and
+flags any query that reads a whole table instead of using an index. On
+SQLite that is a "SCAN <table>" step without an index; on Postgres it is a
+Seq Scan, with seq scans discouraged for the check so tiny development
+tables do not hide a missing index. Run it with
+`flask --app run check-query-plans`, which exits non-zero on a regression.
+"""
+import datetime
+import json
+
+from sqlalchemy import select, text, tuple_
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+from . import db
+from .models import (
+    Bot, Cart, CartItem, Category, ConversationState, IpnEvent, Order, PriceTier,
+    ProcessedUpdate, Product, SalesRollup, User,
+)
+
+SAMPLE_ID = '00000000-0000-0000-0000-000000000000'
+SAMPLE_TIME = datetime.datetime(2024, 1, 1)
+
+
+class Explain(Executable, ClauseElement):
+    inherit_cache = False
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain)
+def _compile_explain(element, compiler, **kw):
+    prefix = 'EXPLAIN QUERY PLAN ' if compiler.dialect.name == 'sqlite' else 'EXPLAIN (FORMAT JSON) '
+    return prefix + compiler.process(element.statement, **kw)
+
+
+HOT_QUERIES = {
+    'tenant by token': lambda: (
+        select(Bot.id, User.is_active, Bot.welcome_message, Bot.wallet, Bot.catalog_version)
+        .join(User, Bot.user_id == User.id).where(Bot.token == 'token')
+    ),
+    'catalog categories': lambda: (
+        select(Category.id, Category.name, Category.parent_id).where(Category.bot_id == SAMPLE_ID)
+    ),
+    'catalog products': lambda: (
+        select(Product.id, Product.name).join(Category, Product.category_id == Category.id)
+        .where(Category.bot_id == SAMPLE_ID)
+    ),
+    'catalog price tiers': lambda: (
+        select(PriceTier.id, PriceTier.price).join(Product, PriceTier.product_id == Product.id)
+        .join(Category, Product.category_id == Category.id).where(Category.bot_id == SAMPLE_ID)
+    ),
+    'sub-categories': lambda: (
+        select(Category.id).where(Category.bot_id == SAMPLE_ID, Category.parent_id == SAMPLE_ID)
+    ),
+    'cart by chat': lambda: select(Cart.id).where(Cart.chat_id == '1', Cart.bot_id == SAMPLE_ID),
+    'cart items': lambda: select(CartItem.id, CartItem.quantity).where(CartItem.cart_id == SAMPLE_ID),
+    'cart item by tier': lambda: (
+        select(CartItem.id).where(CartItem.cart_id == SAMPLE_ID, CartItem.price_tier_id == SAMPLE_ID)
+    ),
+    'conversation state': lambda: (
+        select(ConversationState.state).where(ConversationState.bot_id == SAMPLE_ID, ConversationState.chat_id == '1')
+    ),
+    'my orders': lambda: (
+        select(Order.id).where(Order.chat_id == '1', Order.bot_id == SAMPLE_ID)
+        .order_by(Order.timestamp.desc()).limit(10)
+    ),
+    'orders awaiting a reply': lambda: (
+        select(Order.id).where(Order.bot_id == SAMPLE_ID, Order.chat_id == '1', Order.status == 'awaiting_address')
+    ),
+    'owner order page': lambda: (
+        select(Order.id).where(Order.bot_id == SAMPLE_ID, tuple_(Order.timestamp, Order.id) < tuple_(SAMPLE_TIME, SAMPLE_ID))
+        .order_by(Order.timestamp.desc(), Order.id.desc()).limit(51)
+    ),
+    'owner order page by status': lambda: (
+        select(Order.id).where(Order.bot_id == SAMPLE_ID, Order.status.in_(['paid']))
+        .order_by(Order.timestamp.desc(), Order.id.desc()).limit(51)
+    ),
+    'admin order page': lambda: (
+        select(Order.id).order_by(Order.timestamp.desc(), Order.id.desc()).limit(51)
+    ),
+    'bots by owner': lambda: select(Bot.id).where(Bot.user_id == SAMPLE_ID),
+    'pending IPN events': lambda: (
+        select(IpnEvent.id).where(IpnEvent.processed_at.is_(None)).order_by(IpnEvent.received_at).limit(50)
+    ),
+    'claimed IPN events': lambda: (
+        select(IpnEvent.id).where(IpnEvent.claimed_by == 'worker', IpnEvent.processed_at.is_(None))
+    ),
+    'processed update': lambda: (
+        select(ProcessedUpdate.id).where(ProcessedUpdate.bot_id == SAMPLE_ID, ProcessedUpdate.update_id == 1)
+    ),
+    'sales rollups by bot': lambda: (
+        select(SalesRollup.status, SalesRollup.order_count).where(SalesRollup.bot_id.in_([SAMPLE_ID]))
+    ),
+}
+
+
+def _sqlite_full_scans(rows):
+    details = [row[-1] for row in rows]
+    scans = [d for d in details if d.startswith('SCAN ') and ' USING ' not in d]
+    return details, scans
+
+
+def _postgres_full_scans(rows):
+    plan = rows[0][0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    details, scans = [], []
+
+    def walk(node, depth=0):
+        relation = f" on {node['Relation Name']}" if 'Relation Name' in node else ''
+        line = f"{'  ' * depth}{node['Node Type']}{relation}"
+        details.append(line)
+        if node['Node Type'] == 'Seq Scan':
+            scans.append(line.strip())
+        for child in node.get('Plans', []):
+            walk(child, depth + 1)
+
+    walk(plan[0]['Plan'])
+    return details, scans
+
+
+def check_query_plans():
+    """
+    Returns a list of (name, plan lines, full scans) for every hot query.
+    """
+    dialect = db.engine.dialect.name
+    if dialect not in ('sqlite', 'postgresql'):
+        raise NotImplementedError(f"Query plan checks are not supported on {dialect}")
+    results = []
+    try:
+        if dialect == 'postgresql':
+            db.session.execute(text("SET LOCAL enable_seqscan = off"))
+        for name, build in HOT_QUERIES.items():
+            rows = db.session.execute(Explain(build())).all()
+            if dialect == 'sqlite':
+                details, scans = _sqlite_full_scans(rows)
+            else:
+                details, scans = _postgres_full_scans(rows)
+            results.append((name, details, scans))
+    finally:
+        db.session.rollback()
+    return results
@@ -0,0 +1,89 @@
+"""
+Remembers what each bot message was last edited to, so identical re-renders
+cost no Telegram call.
+
+Entries are keyed by (bot, chat id, message id) and hold a hash of the text,
+keyboard and parse mode, plus the message's edit_date from Telegram. When the
+caller passes the message from the callback query, an edit_date that differs
+from ours means someone else changed the message in the meantime (another
+worker, or an edit that skipped this cache), so the edit goes ahead. A "message
+is not modified" reply counts as success. Only used from the background loop.
+"""
+import collections
+import hashlib
+import json
+
+import telegram
+
+
+def render_digest(text, reply_markup=None, parse_mode=None):
+    markup = reply_markup.to_dict() if reply_markup is not None else None
+    payload = json.dumps([text, markup, parse_mode], sort_keys=True, ensure_ascii=False)
+    return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).digest()
+
+
+class RenderCache:
+    def __init__(self, app=None):
+        self.max_entries = 10000
+        self._entries = collections.OrderedDict()
+        self.edits = 0
+        self.skipped = 0
+        self.not_modified = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_entries = max(1, int(app.config.get('RENDER_CACHE_SIZE', 10000)))
+        app.extensions['render_cache'] = self
+
+    def _store(self, key, digest, edit_date):
+        self._entries[key] = (digest, edit_date)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def forget(self, bot, chat_id, message_id):
+        self._entries.pop((bot.token, int(chat_id), int(message_id)), None)
+
+    async def edit(self, bot, chat_id, message_id, text, reply_markup=None, parse_mode=None, current=None):
+        """
+        Edits the message unless it already shows exactly this render.
+        `current` is the message as Telegram last showed it to the user, if
+        known. Returns True if an edit was sent. Other BadRequests are raised.
+        """
+        key = (bot.token, int(chat_id), int(message_id))
+        digest = render_digest(text, reply_markup, parse_mode)
+        current_edit_date = current.edit_date if current is not None else None
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == digest and (current is None or entry[1] == current_edit_date):
+            self._entries.move_to_end(key)
+            self.skipped += 1
+            return False
+
+        try:
+            message = await bot.edit_message_text(
+                chat_id=chat_id, message_id=message_id, text=text,
+                reply_markup=reply_markup, parse_mode=parse_mode
+            )
+        except telegram.error.BadRequest as e:
+            if 'message is not modified' in str(e).lower():
+                self.not_modified += 1
+                self._store(key, digest, current_edit_date)
+                return False
+            self._entries.pop(key, None)
+            raise
+
+        self.edits += 1
+        self._store(key, digest, getattr(message, 'edit_date', None))
+        return True
+
+    def stats(self):
+        return {
+            'messages': len(self._entries),
+            'edits': self.edits,
+            'skipped': self.skipped,
+            'not_modified': self.not_modified,
+        }
+
+
+render_cache = RenderCache()
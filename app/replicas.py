@@ -0,0 +1,137 @@
+"""
+Read-replica routing.
+
+When DATABASE_REPLICA_URL is set, the replica becomes the 'replica' bind.
+Views decorated with `@read_replica` send their SELECTs there. These are the
+heavy, read-only GET endpoints: order listings, dashboards, user lists.
+Everything else, including any write or flush, stays on the primary.
+
+Read-your-writes: a logged-in browser session that committed a write is kept
+on the primary for REPLICA_STICKY_SECONDS afterwards, so a page loaded right
+after a change never shows the replica's older copy. Within one request, reads
+also stay on the primary once the request has written anything.
+
+`engine_options` builds the per-bind pool settings (pool size, overflow,
+pre-ping) from environment variables.
+"""
+import functools
+import os
+import time
+
+from flask import g, has_app_context, request, session as browser_session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import Select, event
+
+REPLICA_BIND = 'replica'
+USE_REPLICA = 'use_replica'     # Session.info flag set by @read_replica.
+WROTE = 'wrote'                 # Session.info flag set once the session has written.
+LAST_WRITE = '_last_write'      # Browser session key: time of the last committed write.
+
+
+def engine_options(prefix, pre_ping_default='0'):
+    """
+    Engine options for one bind from PREFIX_POOL_SIZE, PREFIX_MAX_OVERFLOW and
+    PREFIX_POOL_PRE_PING. Unset variables keep SQLAlchemy's defaults.
+    """
+    options = {'pool_pre_ping': os.environ.get(f'{prefix}_POOL_PRE_PING', pre_ping_default) == '1'}
+    if os.environ.get(f'{prefix}_POOL_SIZE'):
+        options['pool_size'] = int(os.environ[f'{prefix}_POOL_SIZE'])
+    if os.environ.get(f'{prefix}_MAX_OVERFLOW'):
+        options['max_overflow'] = int(os.environ[f'{prefix}_MAX_OVERFLOW'])
+    return options
+
+
+class RoutingSession(Session):
+    """
+    db.session's class: SELECTs go to the replica while the session is
+    flagged with USE_REPLICA and has not written anything.
+    """
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (bind is None and self.info.get(USE_REPLICA) and not self.info.get(WROTE)
+                and not self._flushing and (clause is None or isinstance(clause, Select))):
+            replica = self._db.engines.get(REPLICA_BIND)
+            if replica is not None:
+                replica_router.replica_reads += 1
+                return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+class ReplicaRouter:
+    def __init__(self, app=None):
+        self.enabled = False
+        self.sticky_seconds = 5.0
+        self.routed_views = 0
+        self.sticky_views = 0
+        self.replica_reads = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        from . import db
+        self.enabled = REPLICA_BIND in app.config.get('SQLALCHEMY_BINDS', {})
+        self.sticky_seconds = float(app.config.get('REPLICA_STICKY_SECONDS', 5))
+        app.extensions['replica_router'] = self
+        if self.enabled:
+            app.before_request(_track_browser_writes)
+        if self.enabled and not event.contains(db.session, 'after_commit', _remember_write):
+            event.listen(db.session, 'after_flush', _mark_written)
+            event.listen(db.session, 'do_orm_execute', _mark_bulk_write)
+            event.listen(db.session, 'after_commit', _remember_write)
+
+    def recently_wrote(self):
+        last_write = browser_session.get(LAST_WRITE)
+        return last_write is not None and time.time() - last_write < self.sticky_seconds
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'routed_views': self.routed_views,
+            'sticky_views': self.sticky_views,
+            'replica_reads': self.replica_reads,
+        }
+
+
+def _mark_written(session, flush_context):
+    session.info[WROTE] = True
+
+
+def _mark_bulk_write(orm_execute_state):
+    # INSERT/UPDATE/DELETE statements run through session.execute() skip the flush.
+    if not orm_execute_state.is_select:
+        orm_execute_state.session.info[WROTE] = True
+
+
+def _track_browser_writes():
+    # Only logged-in browser sessions need read-your-writes; webhooks carry no login cookie.
+    # Kept on g, so work on the background loop (which has its own app context) is never counted.
+    g.track_writes = '_user_id' in browser_session
+
+
+def _remember_write(session):
+    if session.info.get(WROTE) and has_app_context() and g.get('track_writes'):
+        browser_session[LAST_WRITE] = time.time()
+
+
+def read_replica(view):
+    """
+    Routes a read-only GET view's queries to the replica, unless this browser
+    session wrote something within the last REPLICA_STICKY_SECONDS.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        from . import db
+        if not replica_router.enabled or request.method != 'GET':
+            return view(*args, **kwargs)
+        if replica_router.recently_wrote():
+            replica_router.sticky_views += 1
+            return view(*args, **kwargs)
+        replica_router.routed_views += 1
+        db.session.info[USE_REPLICA] = True
+        try:
+            return view(*args, **kwargs)
+        finally:
+            db.session.info.pop(USE_REPLICA, None)
+    return wrapper
+
+
+replica_router = ReplicaRouter()
@@ -0,0 +1,149 @@
+"""
+Incrementally maintained sales rollups.
+
+Every flush that creates, changes or deletes an Order moves that order's
+contribution between SalesRollup rows keyed by (bot, day, status, currency).
+Each move is an atomic upsert in the same transaction, so the rollups stay
+consistent with the orders table whichever code path changed the order:
+checkout, the IPN consumer, address/note replies, dispatch or deletion.
+Bulk query-level UPDATE/DELETEs on orders bypass this; run
+`flask --app run rebuild-rollups` after one.
+"""
+import collections
+import datetime
+import logging
+
+from sqlalchemy import event, func
+from sqlalchemy.orm import attributes
+
+from . import db
+from .models import Order, SalesRollup
+from .sql import dialect_insert
+
+# Orders that were paid for; only these count towards sales.
+PAID_STATUSES = ('awaiting_address', 'awaiting_note', 'paid', 'dispatched', 'overpaid')
+
+TRACKED_ATTRIBUTES = ('bot_id', 'timestamp', 'status', 'payment_currency', 'price', 'amount_paid')
+
+
+def _value(order, name, previous):
+    if previous:
+        history = attributes.get_history(order, name)
+        if history.deleted:
+            return history.deleted[0]
+        if history.unchanged:
+            return history.unchanged[0]
+    return getattr(order, name)
+
+
+def _contribution(order, previous=False):
+    """
+    Returns (rollup key, price, amount paid) for the order's current or pre-flush state.
+    """
+    bot_id, timestamp, status, currency, price, amount_paid = (
+        _value(order, name, previous) for name in TRACKED_ATTRIBUTES
+    )
+    day = (timestamp or datetime.datetime.utcnow()).date()
+    return (bot_id, day, status, currency or ''), price or 0.0, amount_paid or 0.0
+
+
+def _collect_deltas(session):
+    deltas = collections.defaultdict(lambda: [0, 0.0, 0.0])
+
+    def add(contribution, sign):
+        key, price, amount_paid = contribution
+        delta = deltas[key]
+        delta[0] += sign
+        delta[1] += sign * price
+        delta[2] += sign * amount_paid
+
+    for obj in session.new:
+        if isinstance(obj, Order):
+            add(_contribution(obj), 1)
+    for obj in session.dirty:
+        if isinstance(obj, Order) and session.is_modified(obj):
+            before, after = _contribution(obj, previous=True), _contribution(obj)
+            if before != after:
+                add(before, -1)
+                add(after, 1)
+    for obj in session.deleted:
+        if isinstance(obj, Order):
+            add(_contribution(obj, previous=True), -1)
+    return {key: delta for key, delta in deltas.items() if delta != [0, 0.0, 0.0]}
+
+
+def apply_deltas(connection, deltas):
+    table = SalesRollup.__table__
+    for (bot_id, day, status, currency), (count, price_total, amount_paid_total) in deltas.items():
+        stmt = dialect_insert(table, connection).values(
+            bot_id=bot_id, day=day, status=status, currency=currency,
+            order_count=count, price_total=price_total, amount_paid_total=amount_paid_total
+        )
+        connection.execute(stmt.on_conflict_do_update(
+            index_elements=[table.c.bot_id, table.c.day, table.c.status, table.c.currency],
+            set_={
+                'order_count': table.c.order_count + stmt.excluded.order_count,
+                'price_total': table.c.price_total + stmt.excluded.price_total,
+                'amount_paid_total': table.c.amount_paid_total + stmt.excluded.amount_paid_total,
+            }
+        ))
+
+
+@event.listens_for(db.session, 'after_flush')
+def _update_rollups(session, flush_context):
+    deltas = _collect_deltas(session)
+    if deltas:
+        apply_deltas(session.connection(), deltas)
+
+
+def _load_previous_value(target, value, oldvalue, initiator):
+    return value
+
+
+# Load the old value on assignment even when the attribute was expired, so
+# the pre-flush state is always known.
+for _name in TRACKED_ATTRIBUTES:
+    event.listen(getattr(Order, _name), 'set', _load_previous_value, active_history=True, retval=True)
+
+
+def rebuild():
+    """
+    Recomputes every rollup row from the orders table. Returns the number of rows written.
+    """
+    day = func.date(Order.timestamp)
+    rows = (
+        db.session.query(
+            Order.bot_id, day, Order.status, func.coalesce(Order.payment_currency, ''),
+            func.count(Order.id), func.sum(Order.price), func.sum(func.coalesce(Order.amount_paid, 0.0))
+        )
+        .group_by(Order.bot_id, day, Order.status, func.coalesce(Order.payment_currency, ''))
+        .all()
+    )
+    SalesRollup.query.delete()
+    for bot_id, order_day, status, currency, count, price_total, amount_paid_total in rows:
+        if isinstance(order_day, str):
+            order_day = datetime.date.fromisoformat(order_day)
+        db.session.add(SalesRollup(
+            bot_id=bot_id, day=order_day or datetime.date.today(), status=status, currency=currency,
+            order_count=count, price_total=price_total or 0.0, amount_paid_total=amount_paid_total or 0.0
+        ))
+    db.session.commit()
+    logging.info(f"--- Rebuilt {len(rows)} sales rollup rows ---")
+    return len(rows)
+
+
+def sales_summary(bot_ids=None):
+    """
+    Sales totals from the rollups, optionally limited to some bots. Sales
+    only count paid orders; `total_orders` counts every order.
+    """
+    query = db.session.query(SalesRollup.status, func.sum(SalesRollup.order_count), func.sum(SalesRollup.price_total))
+    if bot_ids is not None:
+        query = query.filter(SalesRollup.bot_id.in_(bot_ids))
+    summary = {'total_sales': 0.0, 'total_orders': 0, 'paid_orders': 0}
+    for status, count, price_total in query.group_by(SalesRollup.status):
+        summary['total_orders'] += count or 0
+        if status in PAID_STATUSES:
+            summary['paid_orders'] += count or 0
+            summary['total_sales'] += price_total or 0.0
+    return summary
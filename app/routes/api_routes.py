@@ -1,22 +1,46 @@
 import os
 import logging
-import asyncio
-import requests
+import contextlib
 import hmac
 import hashlib
 import json
+import datetime
 import time
 from functools import wraps
 
-from flask import Blueprint, request, jsonify, current_app
+from flask import Blueprint, Response, request, jsonify, current_app, stream_with_context
 from flask_login import login_user, logout_user, login_required, current_user
 import telegram
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 import cloudinary
 import cloudinary.uploader
+from sqlalchemy.exc import IntegrityError
 
 from .. import db
-from ..models import User, Bot, Category, Product, Order, PriceTier, Cart, CartItem
+from ..event_loop import background_loop
+from ..bot_clients import bot_clients
+from ..outbound import outbound
+from ..tenants import tenant_cache
+from ..catalog import catalog_cache
+from ..currencies import currency_cache
+from ..nowpayments import nowpayments, NowPaymentsError
+from ..ipn_consumer import ipn_consumer
+from ..update_dedupe import update_dedupe
+from ..conversations import AWAITING_ADDRESS, AWAITING_NOTE, conversations
+from ..carts import cart_writer
+from ..render_cache import render_cache
+from ..serializers import ORDER_COLUMNS, order_dict, serialize_bot, serialize_bots, serialize_users
+from ..pagination import keyset_page, order_filters, page_size
+from ..exports import iter_csv, iter_ndjson, order_with_owner_dict, orders_with_owner_query
+from ..rollups import sales_summary
+from ..principals import principal_cache
+from ..passwords import HasherBusy, login_throttle, password_hasher
+from ..write_lane import write_lane
+from ..replicas import read_replica, replica_router
+from ..metrics import metrics
+from ..product_listing import send_product_page, page_count
+from ..update_queue import update_queue, is_valid_update
+from ..models import User, Bot, Category, Product, Order, PriceTier, Cart, CartItem, IpnEvent
 
 api = Blueprint('api', __name__)
 
@@ -27,130 +51,82 @@ cloudinary.config(
     api_secret=os.environ.get('CLOUDINARY_API_SECRET'),
     secure=True
 )
-SERVER_URL = "https://telegram-bot-creator.onrender.com"
-NOWPAYMENTS_API_KEY = os.environ.get('NOWPAYMENTS_API_KEY')
 NOWPAYMENTS_IPN_SECRET_KEY = os.environ.get('NOWPAYMENTS_IPN_SECRET_KEY')
+# Callbacks that read the cart, so pending add_cart taps must be written first.
+CART_READ_ACTIONS = frozenset({'view_cart', 'remove_item', 'clear_cart', 'checkout', 'select_currency'})
+# Callback actions reported to /metrics by name; anything else counts as 'unknown',
+# so forged callback data cannot create new metric series.
+CALLBACK_ACTIONS = frozenset({
+    'main_menu', 'browse_products', 'view_category', 'add_cart', 'view_cart', 'remove_item',
+    'clear_cart', 'checkout', 'view_currency_page', 'select_currency', 'my_orders', 'no_op',
+})
 
 # --- HELPER FUNCTIONS ---
 def run_async(coroutine):
-    try:
-        loop = asyncio.get_running_loop()
-    except RuntimeError:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-    return loop.run_until_complete(coroutine)
-
-def admin_required(f):
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if not current_user.is_authenticated or not current_user.is_admin:
-            return jsonify({'message': 'Admin access is required for this action.'}), 403
-        return f(*args, **kwargs)
-    return decorated_function
+    # Every caller shares the worker's long-lived background loop.
+    return background_loop.run(coroutine)
 
-# --- CACHING VARIABLES for NOWPayments Currencies ---
-currency_cache = {
-    'currencies': [],
-    'last_updated': 0
-}
-CACHE_DURATION = 3600 # Cache for 1 hour (3600 seconds)
-def get_available_currencies():
+def commit_catalog_change(bot):
     """
-    Fetches the list of available currencies from NOWPayments,
-    using a cache and enhanced logging for debugging.
+    Commits a category/product/price tier edit and bumps the bot's catalog
+    version, so every worker's browsing snapshot is rebuilt.
     """
-    global currency_cache
-    current_time = time.time()
-
-    if currency_cache['currencies'] and (current_time - currency_cache['last_updated'] < CACHE_DURATION):
-        logging.info("--- Using cached currency list. ---")
-        return currency_cache['currencies']
-
-    logging.info("--- Fetching new currency list from NOWPayments... ---")
-    try:
-        headers = {'x-api-key': NOWPAYMENTS_API_KEY}
-        response = requests.get('https://api.nowpayments.io/v1/full-currencies', headers=headers)
-        
-        if not response.ok:
-            logging.error(f"--- NOWPayments API Error: {response.status_code} {response.text} ---")
-            response.raise_for_status()
-
-        data = response.json()
-        
-        # Filter the list
-        available_currencies = [c['code'] for c in data.get('currencies', []) if c.get('available_for_payment') is True]
-
-        # --- THIS IS THE FIX ---
-        # Limit the list to the first 120 currencies to avoid Telegram limits.
-        limited_currencies = available_currencies[:120]
-
-        # Log the result of the filtering to see if it's empty.
-        logging.info(f"--- Found {len(available_currencies)} total, using {len(limited_currencies)} ---")
-        
-        currency_cache['currencies'] = limited_currencies
-        currency_cache['last_updated'] = current_time
-        
-        return limited_currencies
-        
-    except requests.exceptions.RequestException as e:
-        logging.error(f"--- Failed to fetch currencies from NOWPayments (RequestException): {e} ---")
-        return currency_cache['currencies'] if currency_cache['currencies'] else []
-
-        
-    except requests.exceptions.RequestException as e:
-        logging.error(f"--- Failed to fetch currencies from NOWPayments (RequestException): {e} ---")
-        return currency_cache['currencies'] if currency_cache['currencies'] else []
+    bot.catalog_version = Bot.catalog_version + 1
+    db.session.commit()
+    tenant_cache.invalidate(bot.token)
+    catalog_cache.invalidate(bot.id)
 
-    except requests.exceptions.RequestException as e:
-        logging.error(f"--- Failed to fetch currencies from NOWPayments (RequestException): {e} ---")
-        return currency_cache['currencies'] if currency_cache['currencies'] else []
+def owns_bot(bot_id):
+    """
+    True if the logged-in user owns the bot. Answered from the cached principal, without SQL,
+    unless the answer is no.
+    """
+    if current_user.owns(bot_id):
+        return True
+    # The bot may have been created in another worker since the principal was cached.
+    principal = principal_cache.refresh(current_user.id)
+    return principal is not None and principal.owns(bot_id)
 
-def generate_currency_keyboard(page=1, cart_id=None):
+def check_user_password(user, password):
     """
-    Creates a paginated keyboard of available currencies.
+    Verifies a login on the password hashing pool, upgrading the stored hash
+    if it was made with older parameters.
     """
-    all_currencies = get_available_currencies()
-    if not all_currencies:
-        return InlineKeyboardMarkup([[InlineKeyboardButton("Payment system unavailable.", callback_data="main_menu")]])
+    matches, needs_rehash = password_hasher.verify(user.password_hash, password or '')
+    if needs_rehash:
+        try:
+            user.password_hash = password_hasher.hash(password)
+            db.session.commit()
+        except HasherBusy:
+            pass  # Upgraded on a later login instead.
+    return matches
+
+def too_many_attempts(retry_after):
+    response = jsonify({'message': 'Too many failed login attempts. Please try again later.'})
+    response.headers['Retry-After'] = str(retry_after)
+    return response, 429
+
+@api.errorhandler(HasherBusy)
+def password_hasher_busy(e):
+    logging.warning(f"--- Password hashing pool is full: {e} ---")
+    response = jsonify({'message': 'The server is busy. Please try again in a moment.'})
+    response.headers['Retry-After'] = '1'
+    return response, 503
 
-    items_per_page = 30
-    start_index = (page - 1) * items_per_page
-    end_index = start_index + items_per_page
-    
-    page_currencies = all_currencies[start_index:end_index]
-
-    keyboard = []
-    row = []
-    for currency in page_currencies:
-        row.append(InlineKeyboardButton(
-            currency.upper(), 
-            callback_data=f"select_currency:{currency}:{cart_id}"
-        ))
-        if len(row) == 5:
-            keyboard.append(row)
-            row = []
-    if row:
-        keyboard.append(row)
-
-    nav_row = []
-    total_pages = (len(all_currencies) + items_per_page - 1) // items_per_page
-
-    if page > 1:
-        nav_row.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"view_currency_page:{page-1}:{cart_id}"))
-    
-    nav_row.append(InlineKeyboardButton(f"Page {page}/{total_pages}", callback_data="no_op"))
+def admin_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not current_user.is_authenticated or not current_user.is_admin:
+            return jsonify({'message': 'Admin access is required for this action.'}), 403
+        return f(*args, **kwargs)
+    return decorated_function
 
-    if page < total_pages:
-        nav_row.append(InlineKeyboardButton("Next ➡️", callback_data=f"view_currency_page:{page+1}:{cart_id}"))
-    
-    keyboard.append(nav_row)
-    keyboard.append([InlineKeyboardButton("⬅️ Back to Cart", callback_data=f"view_cart:{cart_id}")])
 # --- TELEGRAM & PAYMENT FUNCTIONS ---
 
 async def setup_bot_webhook(bot_token):
     logging.info(f"Setting up webhook for token: {bot_token[:10]}... ---")
-    bot = telegram.Bot(token=bot_token)
-    webhook_url = f"{SERVER_URL}/webhook/{bot_token}"
+    bot = bot_clients.get(bot_token)
+    webhook_url = f"{current_app.config['SERVER_URL']}/webhook/{bot_token}"
     
     # This will now raise an exception if it fails, which our create_bot function can catch.
     await bot.set_webhook(webhook_url)
@@ -158,12 +134,18 @@ async def setup_bot_webhook(bot_token):
     logging.info(f"--- SUCCESS: Webhook set for {bot_token[:10]}... ---")
 
 
-
 def execute_payout(order):
     pass
 
-# --- This is the new, smarter send_cart_view function ---
-async def send_cart_view(bot, chat_id, message_id, bot_id):
+# --- Database work for update handling ---
+# The update handler runs on the background event loop. These helpers run on its
+# blocking pool via background_loop.run_blocking and return plain values, so no
+# query or lazy load ever happens on the loop itself.
+
+def cart_view(bot_id, chat_id):
+    """
+    Returns the cart message for a chat as (text, reply markup).
+    """
     cart = Cart.query.filter_by(chat_id=str(chat_id), bot_id=bot_id).first()
     
     cart_text = "🛒 **Your Shopping Cart**\n\n"
@@ -185,20 +167,99 @@ async def send_cart_view(bot, chat_id, message_id, bot_id):
         keyboard_buttons.append([InlineKeyboardButton("✅ Checkout", callback_data=f"checkout:{cart.id}")])
         keyboard_buttons.append([InlineKeyboardButton("⬅️ Main Menu", callback_data="main_menu")])
 
-    reply_markup = InlineKeyboardMarkup(keyboard_buttons)
+    return cart_text, InlineKeyboardMarkup(keyboard_buttons)
+
+def delete_cart_item(cart_item_id):
+    cart_item = db.session.get(CartItem, cart_item_id)
+    if cart_item:
+        db.session.delete(cart_item)
+        db.session.commit()
+
+def empty_cart(cart_id):
+    CartItem.query.filter_by(cart_id=cart_id).delete()
+    db.session.commit()
+
+def cart_has_items(cart_id):
+    cart = db.session.get(Cart, cart_id)
+    return bool(cart and cart.items)
+
+def create_order(cart_id, chat_id, telegram_username):
+    """
+    Creates an order awaiting payment from the cart's contents.
+    Returns (order id, total price), or None if the cart is gone.
+    """
+    cart = db.session.get(Cart, cart_id)
+    if not cart:
+        return None
+
+    total_price = sum(item.quantity * item.price_tier.price for item in cart.items)
+    order_description = ", ".join([f"{item.quantity}x {item.price_tier.product.name} ({item.price_tier.label})" for item in cart.items])
+
+    new_order = Order(
+        product_name=order_description, price=total_price, bot_id=cart.bot_id,
+        chat_id=str(chat_id), telegram_username=telegram_username,
+        status='awaiting_payment'
+    )
+    db.session.add(new_order)
+    db.session.commit()
+    return new_order.id, total_price
+
+def recent_orders_text(bot_id, chat_id):
+    """
+    The chat's ten most recent orders as message text, or None if it has none.
+    """
+    orders = Order.query.filter_by(chat_id=str(chat_id), bot_id=bot_id).order_by(Order.timestamp.desc()).limit(10).all()
+    if not orders:
+        return None
+
+    orders_text = "📦 **Your Recent Orders**\n\n"
+    for order in orders:
+        status_text = order.status.replace('_', ' ').title()
+        orders_text += f"_{order.timestamp.strftime('%d %b %Y')}_ - {order.product_name}\n**Status:** {status_text}\n\n"
+    return orders_text
+
+def answer_conversation(bot_id, chat_id, text):
+    """
+    Applies a text message to the chat's pending address or note prompt.
+    Returns the reply to send, or None if nothing was pending.
+    """
+    # Only chats we asked for an address or note touch the orders table.
+    conversation = conversations.get(bot_id, chat_id)
+    order = db.session.get(Order, conversation.order_id) if conversation else None
+    if conversation and (order is None or order.status != conversation.state):
+        # Stale state, e.g. the order was changed from the dashboard.
+        conversations.clear(bot_id, chat_id)
+        db.session.commit()
+        order = None
+
+    if order and order.status == AWAITING_ADDRESS:
+        order.shipping_address = text
+        order.status = AWAITING_NOTE
+        conversations.set(bot_id, chat_id, AWAITING_NOTE, order.id)
+        db.session.commit()
+        return "Great! Please reply with any additional notes for your order."
+
+    if order and order.status == AWAITING_NOTE:
+        order.customer_note = text
+        order.status = 'paid'
+        conversations.clear(bot_id, chat_id)
+        db.session.commit()
+        return "Thank you! Your order is complete and will be processed shortly."
+    return None
+
+# --- This is the new, smarter send_cart_view function ---
+async def send_cart_view(bot, chat_id, message_id, bot_id, current_message=None):
+    cart_text, reply_markup = await background_loop.run_blocking(cart_view, bot_id, chat_id)
     
     try:
-        # First, try to edit the existing message for a smooth experience.
-        await bot.edit_message_text(
-            chat_id=chat_id, 
-            message_id=message_id, 
-            text=cart_text, 
-            reply_markup=reply_markup, 
-            parse_mode='Markdown'
+        # Edit the existing message for a smooth experience; unchanged carts are skipped.
+        await render_cache.edit(
+            bot, chat_id, message_id, cart_text,
+            reply_markup=reply_markup, parse_mode='Markdown', current=current_message
         )
-    except telegram.error.BadRequest:
-        # If editing fails (e.g., message is too old or unchanged),
-        # send a new message instead. This makes the bot more reliable.
+    except telegram.error.BadRequest as e:
+        # The message can no longer be edited (e.g. it is too old), so send a new one.
+        logging.warning(f"--- Could not edit cart view, sending a new message: {e} ---")
         await bot.send_message(
             chat_id=chat_id,
             text=cart_text,
@@ -206,24 +267,61 @@ async def send_cart_view(bot, chat_id, message_id, bot_id):
             parse_mode='Markdown'
         )
 
-    except telegram.error.BadRequest as e:
-        # If the message is not modified, that's okay. Just ignore the error.
-        if 'message is not modified' in str(e):
-            pass
-        else:
-            # If it's a different error, we should log it.
-            logging.error(f"Error editing cart view: {e}")
 
+def update_action(update_data):
+    """
+    The metrics label for an update: its callback action, 'message' or 'other'.
+    """
+    callback_query = update_data.get('callback_query')
+    if callback_query:
+        action = (callback_query.get('data') or '').split(':', 1)[0]
+        return action if action in CALLBACK_ACTIONS else 'unknown'
+    return 'message' if 'message' in update_data else 'other'
 
-# --- This is the final, hardened handle_telegram_update function ---
 async def handle_telegram_update(bot_token, update_data):
-    logging.info(f"--- RAW UPDATE RECEIVED: {update_data} ---")
-    bot = telegram.Bot(token=bot_token)
+    """
+    Handles one update, timing it per callback action for /metrics.
+    """
+    action = update_action(update_data)
+    started = time.perf_counter()
+    try:
+        await _handle_telegram_update(bot_token, update_data)
+    except Exception:
+        metrics.inc('telegram_update_errors_total', action=action)
+        raise
+    finally:
+        metrics.observe('telegram_update_seconds', time.perf_counter() - started, action=action)
+
+@contextlib.asynccontextmanager
+async def update_app_context():
+    """
+    An app context for one update whose session is closed on the blocking
+    pool, so ending its transaction does not block the loop either.
+    """
+    with current_app.app_context():
+        try:
+            yield
+        finally:
+            await background_loop.run_blocking(db.session.remove)
+
+async def send_product_page_detached(bot, chat_id, category, page, back_button_data):
+    """
+    Sends a product page after the update that asked for it has finished,
+    with an app context of its own.
+    """
+    async with update_app_context():
+        await send_product_page(bot, chat_id, category, page, back_button_data)
+
+# --- This is the final, hardened handle_telegram_update function ---
+async def _handle_telegram_update(bot_token, update_data):
+    # Lazy %-formatting: the update is only turned into a string when DEBUG logging is on.
+    logging.debug("--- RAW UPDATE RECEIVED: %s ---", update_data)
+    bot = bot_clients.get(bot_token)
     update = telegram.Update.de_json(update_data, bot)
     
-    with current_app.app_context():
-        bot_data = Bot.query.filter_by(token=bot_token).first()
-        if not bot_data or not bot_data.owner.is_active:
+    async with update_app_context():
+        bot_data = await background_loop.run_blocking(tenant_cache.resolve, bot_token)
+        if not bot_data or not bot_data.owner_active:
             return
 
         if update.callback_query:
@@ -246,114 +344,92 @@ async def handle_telegram_update(bot_token, update_data):
             action = parts[0]
             item_id = parts[1] if len(parts) > 1 else None
 
+            if action in CART_READ_ACTIONS:
+                # Write any coalesced add_cart taps before the cart is read.
+                await cart_writer.flush(bot_data.id, chat_id)
+
             if action == 'main_menu':
-                cart = Cart.query.filter_by(chat_id=str(chat_id), bot_id=bot_data.id).first()
-                cart_id = cart.id if cart else 'new'
+                # view_cart finds the cart by chat, so the menu needs no cart lookup.
                 keyboard = [
                     [InlineKeyboardButton("🛍️ Browse Products", callback_data="browse_products")],
                     [InlineKeyboardButton("📦 My Orders", callback_data="my_orders")],
-                    [InlineKeyboardButton("🛒 View Cart", callback_data=f"view_cart:{cart_id}")]
+                    [InlineKeyboardButton("🛒 View Cart", callback_data="view_cart")]
                 ]
                 reply_markup = InlineKeyboardMarkup(keyboard)
-                await query.edit_message_text(text=bot_data.welcome_message, reply_markup=reply_markup)
+                await render_cache.edit(bot, chat_id, message_id, bot_data.welcome_message, reply_markup=reply_markup, current=query.message)
 
             elif action == 'browse_products':
-                main_categories = [c for c in bot_data.categories if c.parent_id is None]
+                # Served from the in-memory catalog snapshot; view_cart finds the cart by chat.
+                main_categories = (await background_loop.run_blocking(catalog_cache.get, bot_data)).roots
                 if not main_categories:
-                    await query.edit_message_text(text="This shop has no categories yet.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")]]))
+                    await render_cache.edit(bot, chat_id, message_id, "This shop has no categories yet.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")]]), current=query.message)
                     return
                 
-                cart = Cart.query.filter_by(chat_id=str(chat_id), bot_id=bot_data.id).first()
-                cart_id = cart.id if cart else 'new'
                 keyboard = [[InlineKeyboardButton(c.name, callback_data=f"view_category:{c.id}")] for c in main_categories]
-                keyboard.append([InlineKeyboardButton("🛒 View Cart", callback_data=f"view_cart:{cart_id}"), InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")])
+                keyboard.append([InlineKeyboardButton("🛒 View Cart", callback_data="view_cart"), InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")])
                 reply_markup = InlineKeyboardMarkup(keyboard)
-                await query.edit_message_text(text="Please select a category:", reply_markup=reply_markup)
+                await render_cache.edit(bot, chat_id, message_id, "Please select a category:", reply_markup=reply_markup, current=query.message)
 
             elif action == 'view_category':
-                category = db.session.get(Category, item_id)
+                category = (await background_loop.run_blocking(catalog_cache.get, bot_data)).categories.get(item_id)
                 if not category: return
                 
-                cart = Cart.query.filter_by(chat_id=str(chat_id), bot_id=bot_data.id).first()
-                cart_id = cart.id if cart else 'new'
                 back_button_data = f"view_category:{category.parent_id}" if category.parent_id else "browse_products"
                 
                 if category.sub_categories:
                     keyboard = [[InlineKeyboardButton(sc.name, callback_data=f"view_category:{sc.id}")] for sc in category.sub_categories]
-                    keyboard.append([InlineKeyboardButton("⬅️ Back", callback_data=back_button_data), InlineKeyboardButton("🛒 View Cart", callback_data=f"view_cart:{cart_id}"), InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")])
+                    keyboard.append([InlineKeyboardButton("⬅️ Back", callback_data=back_button_data), InlineKeyboardButton("🛒 View Cart", callback_data="view_cart"), InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")])
                     reply_markup = InlineKeyboardMarkup(keyboard)
                     await query.edit_message_text(text=f"Sub-categories in {category.name}:", reply_markup=reply_markup)
                 elif category.products:
-                    await query.edit_message_text(text=f"Products in {category.name}:")
-                    for product in category.products:
-                        caption = f"**{product.name}**\n{product.description or ''}\n\n"
-                        keyboard = []
-                        for tier in product.price_tiers:
-                            caption += f"- {tier.label}: £{tier.price}\n"
-                            keyboard.append([InlineKeyboardButton(f"Add {tier.label} to Cart", callback_data=f"add_cart:{tier.id}")])
-                        
-                        reply_markup = InlineKeyboardMarkup(keyboard)
-                        try:
-                            if product.image_url:
-                                await bot.send_photo(chat_id=chat_id, photo=product.image_url, caption=caption, reply_markup=reply_markup, parse_mode='Markdown')
-                            else:
-                                await bot.send_message(chat_id=chat_id, text=caption, reply_markup=reply_markup, parse_mode='Markdown')
-                        except telegram.error.BadRequest:
-                            await bot.send_message(chat_id=chat_id, text=caption, reply_markup=reply_markup, parse_mode='Markdown')
-                    
-                    nav_keyboard = [[
-                        InlineKeyboardButton("⬅️ Back", callback_data=back_button_data),
-                        InlineKeyboardButton("🛒 View Cart", callback_data=f"view_cart:{cart_id}"),
-                        InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")
-                    ]]
-                    await bot.send_message(chat_id=chat_id, text="What would you like to do next?", reply_markup=InlineKeyboardMarkup(nav_keyboard))
+                    # Callback data comes from the client, so the page is checked and clamped.
+                    try:
+                        page = int(parts[2]) if len(parts) > 2 else 0
+                    except ValueError:
+                        page = 0
+                    page = min(max(page, 0), page_count(category) - 1)
+                    if page == 0:
+                        await query.edit_message_text(text=f"Products in {category.name}:")
+                    else:
+                        # Drop the "More" button from the previous page's navigation message.
+                        await query.edit_message_text(text=f"Products in {category.name} (page {page + 1} of {page_count(category)}):")
+                    # The page can take seconds under the chat's rate limit, so it is not awaited.
+                    background_loop.spawn(send_product_page_detached(bot, chat_id, category, page, back_button_data))
                 else:
                     await query.edit_message_text(text=f"No products or sub-categories found in {category.name}.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back", callback_data=back_button_data)]]))
             
             elif action == 'add_cart':
-                price_tier = db.session.get(PriceTier, item_id)
-                if price_tier:
-                    cart = Cart.query.filter_by(chat_id=str(chat_id), bot_id=bot_data.id).first()
-                    if not cart:
-                        cart = Cart(chat_id=str(chat_id), bot_id=bot_data.id)
-                        db.session.add(cart)
-                        db.session.flush()
-                    
-                    cart_item = CartItem.query.filter_by(cart_id=cart.id, price_tier_id=price_tier.id).first()
-                    if cart_item:
-                        cart_item.quantity += 1
+                # The tier comes from the catalog snapshot; the write is a single upsert.
+                entry = (await background_loop.run_blocking(catalog_cache.get, bot_data)).tiers.get(item_id)
+                if entry:
+                    product, _ = entry
+                    if await cart_writer.add(bot_data.id, chat_id, item_id):
+                        await query.answer(text=f"✅ Added {product.name} to cart!", show_alert=False)
                     else:
-                        cart_item = CartItem(cart_id=cart.id, price_tier_id=price_tier.id, quantity=1)
-                        db.session.add(cart_item)
-                    db.session.commit()
-                    await query.answer(text=f"✅ Added {price_tier.product.name} to cart!", show_alert=False)
+                        # Deleted since the snapshot was built: rebuild it on the next tap.
+                        tenant_cache.invalidate(bot_token)
+                        catalog_cache.invalidate(bot_data.id)
+                        await query.answer(text="❌ This item is no longer available.", show_alert=False)
 
             elif action == 'view_cart':
-                await send_cart_view(bot, chat_id, message_id, bot_data.id)
+                await send_cart_view(bot, chat_id, message_id, bot_data.id, query.message)
 
             elif action == 'remove_item':
-                cart_item = db.session.get(CartItem, item_id)
-                if cart_item:
-                    db.session.delete(cart_item)
-                    db.session.commit()
-                await send_cart_view(bot, chat_id, message_id, bot_data.id)
+                await background_loop.run_blocking(delete_cart_item, item_id)
+                await send_cart_view(bot, chat_id, message_id, bot_data.id, query.message)
             
             elif action == 'clear_cart':
-                cart = db.session.get(Cart, item_id)
-                if cart:
-                    CartItem.query.filter_by(cart_id=cart.id).delete()
-                    db.session.commit()
-                await send_cart_view(bot, chat_id, message_id, bot_data.id)
+                await background_loop.run_blocking(empty_cart, item_id)
+                await send_cart_view(bot, chat_id, message_id, bot_data.id, query.message)
 
             elif action == 'checkout':
                 logging.info("--- ENTERING CHECKOUT LOGIC ---")
-                cart = db.session.get(Cart, item_id)
-                if not cart or not cart.items:
+                if not await background_loop.run_blocking(cart_has_items, item_id):
                     await query.edit_message_text(text="Your cart is empty.")
                     return
                 await query.edit_message_text(
                     text="Please select your payment currency.",
-                    reply_markup=generate_currency_keyboard(cart_id=cart.id)
+                    reply_markup=await currency_cache.keyboard(cart_id=item_id)
                 )
 
             elif action == 'view_currency_page':
@@ -361,41 +437,31 @@ async def handle_telegram_update(bot_token, update_data):
                 cart_id = parts[2]
                 await query.edit_message_text(
                     text="Please select your payment currency.",
-                    reply_markup=generate_currency_keyboard(page=page, cart_id=cart_id)
+                    reply_markup=await currency_cache.keyboard(page=page, cart_id=cart_id)
                 )
 
             elif action == 'select_currency':
                 selected_currency = parts[1]
                 cart_id = parts[2]
-                cart = db.session.get(Cart, cart_id)
-                if not cart:
+                created = await background_loop.run_blocking(create_order, cart_id, chat_id, query.from_user.username)
+                if not created:
                     await query.edit_message_text(text="Error: Your cart could not be found.")
                     return
+                order_id, total_price = created
 
-                total_price = sum(item.quantity * item.price_tier.price for item in cart.items)
-                order_description = ", ".join([f"{item.quantity}x {item.price_tier.product.name} ({item.price_tier.label})" for item in cart.items])
-
-                new_order = Order(
-                    product_name=order_description, price=total_price, bot_id=cart.bot_id,
-                    chat_id=str(chat_id), telegram_username=query.from_user.username,
-                    status='awaiting_payment'
-                )
-                db.session.add(new_order)
-                db.session.commit()
-
-                headers = {'x-api-key': NOWPAYMENTS_API_KEY}
                 payload = {
                     "price_amount": total_price, "price_currency": "usd",
-                    "pay_currency": selected_currency, "order_id": new_order.id,
-                    "ipn_callback_url": f"{SERVER_URL}/webhook/nowpayments"
+                    "pay_currency": selected_currency, "order_id": order_id,
+                    "ipn_callback_url": f"{current_app.config['SERVER_URL']}/webhook/nowpayments"
                 }
-                response = requests.post('https://api.nowpayments.io/v1/payment', headers=headers, json=payload)
-                
-                if response.ok:
-                    CartItem.query.filter_by(cart_id=cart.id).delete()
-                    db.session.commit()
+                try:
+                    payment_data = await nowpayments.create_payment(payload)
+                except NowPaymentsError as e:
+                    logging.error(f"NOWPayments API error: {e}")
+                    await query.edit_message_text(text="Sorry, there was an error creating your payment. Please try again.")
+                else:
+                    await background_loop.run_blocking(empty_cart, cart_id)
                     
-                    payment_data = response.json()
                     payment_address = payment_data.get('pay_address')
                     payment_amount = payment_data.get('pay_amount')
                     
@@ -403,49 +469,29 @@ async def handle_telegram_update(bot_token, update_data):
                         text=f"Please send exactly `{payment_amount}` {selected_currency.upper()} to the address below:\n\n`{payment_address}`",
                         parse_mode='Markdown'
                     )
-                else:
-                    logging.error(f"NOWPayments API error: {response.text}")
-                    await query.edit_message_text(text="Sorry, there was an error creating your payment. Please try again.")
             
             elif action == 'my_orders':
-                orders = Order.query.filter_by(chat_id=str(chat_id), bot_id=bot_data.id).order_by(Order.timestamp.desc()).limit(10).all()
-                if not orders:
-                    await query.edit_message_text(text="You have no past orders.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Main Menu", callback_data="main_menu")]]))
+                orders_text = await background_loop.run_blocking(recent_orders_text, bot_data.id, chat_id)
+                if not orders_text:
+                    await render_cache.edit(bot, chat_id, message_id, "You have no past orders.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Main Menu", callback_data="main_menu")]]), current=query.message)
                     return
                 
-                orders_text = "📦 **Your Recent Orders**\n\n"
-                for order in orders:
-                    status_text = order.status.replace('_', ' ').title()
-                    orders_text += f"_{order.timestamp.strftime('%d %b %Y')}_ - {order.product_name}\n**Status:** {status_text}\n\n"
-                
-                await query.edit_message_text(text=orders_text, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Main Menu", callback_data="main_menu")]]), parse_mode='Markdown')
+                await render_cache.edit(bot, chat_id, message_id, orders_text, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Main Menu", callback_data="main_menu")]]), parse_mode='Markdown', current=query.message)
 
         elif update.message and update.message.text:
             chat_id = update.message.chat_id
             text = update.message.text
 
-            pending_order_address = Order.query.filter_by(bot_id=bot_data.id, status='awaiting_address', chat_id=str(chat_id)).first()
-            if pending_order_address:
-                pending_order_address.shipping_address = text
-                pending_order_address.status = 'awaiting_note'
-                db.session.commit()
-                await bot.send_message(chat_id=chat_id, text="Great! Please reply with any additional notes for your order.")
+            reply = await background_loop.run_blocking(answer_conversation, bot_data.id, chat_id, text)
+            if reply:
+                await bot.send_message(chat_id=chat_id, text=reply)
                 return
 
-            pending_order_note = Order.query.filter_by(bot_id=bot_data.id, status='awaiting_note', chat_id=str(chat_id)).first()
-            if pending_order_note:
-                pending_order_note.customer_note = text
-                pending_order_note.status = 'paid'
-                db.session.commit()
-                await bot.send_message(chat_id=chat_id, text="Thank you! Your order is complete and will be processed shortly.")
-                return
-            
-            cart = Cart.query.filter_by(chat_id=str(chat_id), bot_id=bot_data.id).first()
-            cart_id = cart.id if cart else 'new'
+            # view_cart finds the cart by chat, so the menu needs no cart lookup.
             keyboard = [
                 [InlineKeyboardButton("🛍️ Browse Products", callback_data="browse_products")],
                 [InlineKeyboardButton("📦 My Orders", callback_data="my_orders")],
-                [InlineKeyboardButton("🛒 View Cart", callback_data=f"view_cart:{cart_id}")]
+                [InlineKeyboardButton("🛒 View Cart", callback_data="view_cart")]
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
             await bot.send_message(chat_id=chat_id, text=bot_data.welcome_message, reply_markup=reply_markup)
@@ -453,86 +499,85 @@ async def handle_telegram_update(bot_token, update_data):
 
 @api.route('/webhook/<string:bot_token>', methods=['POST'])
 def telegram_webhook(bot_token):
-    run_async(handle_telegram_update(bot_token, request.get_json()))
+    update_data = request.get_json(silent=True)
+    if not is_valid_update(update_data):
+        return "Invalid update", 400
+
+    # Unknown tokens are acked without further work so Telegram stops retrying.
+    tenant = tenant_cache.resolve(bot_token)
+    if tenant is None:
+        return "ok", 200
+
+    # A redelivery of an update we already accepted: ack it and do nothing.
+    update_id = update_data['update_id']
+    if not update_dedupe.claim(tenant.id, update_id):
+        return "ok", 200
+
+    if update_queue.enabled:
+        # Ack straight away; the worker pool does the Telegram and DB work.
+        # Telegram never redelivers an acked update, so a handler that fails here is only logged.
+        if not update_queue.put(update_data, handle_telegram_update, bot_token, update_data):
+            logging.warning("--- Update queue is full, asking Telegram to retry later. ---")
+            update_dedupe.release(tenant.id, update_id)
+            return "busy", 503
+        return "ok", 200
+
+    try:
+        run_async(handle_telegram_update(bot_token, update_data))
+    except Exception:
+        # The 500 makes Telegram retry; the retry must not be dropped as a duplicate.
+        update_dedupe.release(tenant.id, update_id)
+        raise
     return "ok", 200
 
 @api.route('/webhook/nowpayments', methods=['POST'])
 def nowpayments_webhook():
-    # --- 1. Securely Verify the Request (No changes here) ---
+    # --- 1. Securely Verify the Request ---
     signature = request.headers.get('x-nowpayments-sig')
     if not signature or not NOWPAYMENTS_IPN_SECRET_KEY: 
         return "Configuration error", 400
     try:
-        sorted_payload = json.dumps(request.get_json(), sort_keys=True, separators=(',', ':')).encode('utf-8')
+        data = json.loads(request.get_data())
+        sorted_payload = json.dumps(data, sort_keys=True, separators=(',', ':')).encode('utf-8')
         expected_signature = hmac.new(NOWPAYMENTS_IPN_SECRET_KEY.encode('utf-8'), sorted_payload, hashlib.sha512).hexdigest()
         if not hmac.compare_digest(expected_signature, signature):
             return "Invalid signature", 400
     except Exception as e:
         return "Verification error", 400
-    
-    # --- 2. Get Data from NOWPayments ---
-    data = request.get_json()
-    order_id = data.get('order_id')
-    payment_status = data.get('payment_status')
-    
-    # --- 3. Find the Order and Check Status ---
-    order = db.session.get(Order, order_id)
-    if not order or order.status != 'awaiting_payment':
-        # If order is not found or already processed, ignore the webhook
-        return "ok", 200
 
-    # --- 4. NEW: Handle Different Payment Statuses ---
-    if payment_status == 'finished':
-        # Get the actual amount paid from the webhook data
-        amount_paid = data.get('pay_amount')
-        expected_price = data.get('price_amount')
-        currency_paid = data.get('pay_currency')
+    # --- 2. Store it in the inbox; the IPN consumer applies it off-request ---
+    event = IpnEvent(
+        payment_id=str(data.get('payment_id') or data.get('order_id')),
+        payment_status=str(data.get('payment_status')),
+        order_id=data.get('order_id'),
+        payload=sorted_payload.decode('utf-8')
+    )
+    db.session.add(event)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Already received this (payment, status) pair; NOWPayments is retrying.
+        db.session.rollback()
+        return "ok", 200
 
-        # Save the payment details to the database
-        order.amount_paid = float(amount_paid)
-        order.payment_currency = currency_paid
-        
-        # Compare paid amount to expected price
-        if float(amount_paid) < float(expected_price):
-            order.status = 'underpaid'
-         # Notify the customer about the underpayment
-            underpaid_amount = float(expected_price) - float(amount_paid)
-            bot = telegram.Bot(token=order.bot.token)
-            message = (
-                f"⚠️ Payment Issue: Your order has been underpaid.\n\n"
-                f"Expected: {expected_price} {currency_paid.upper()}\n"
-                f"Received: {amount_paid} {currency_paid.upper()}\n\n"
-                f"Amount missing: {underpaid_amount:.8f} {currency_paid.upper()}"
-            )
-            run_async(bot.send_message(chat_id=order.chat_id, text=message))
-        
-        elif float(amount_paid) > float(expected_price):
-            order.status = 'overpaid'
-        else: # The payment is correct
-            order.status = 'awaiting_address'
-            # Trigger the bot to ask for shipping info
-            bot = telegram.Bot(token=order.bot.token)
-            run_async(bot.send_message(chat_id=order.chat_id, text="✅ Payment confirmed! Please reply with your full shipping address."))
-
-    elif payment_status in ['failed', 'refunded', 'expired']:
-        order.status = 'failed'
-
-    # --- 5. Save Changes to the Database ---
-    db.session.commit()
-    
-    # Payout logic can be added here in the future
-    # execute_payout(order)
-    
+    ipn_consumer.wake()
     return "ok", 200
 # --- AUTHENTICATION ROUTES ---
 
 @api.route('/api/login', methods=['POST'])
 def login():
     data = request.get_json()
-    user = User.query.filter_by(email=data.get('email')).first()
-    if user and user.is_active and user.check_password(data.get('password')):
+    email, password = data.get('email'), data.get('password')
+    retry_after = login_throttle.retry_after(email, request.remote_addr)
+    if retry_after:
+        return too_many_attempts(retry_after)
+    user = User.query.filter_by(email=email).first()
+    if user and user.is_active and check_user_password(user, password):
+        login_throttle.succeeded(email, request.remote_addr)
         login_user(user)
+        principal_cache.invalidate(user.id)
         return jsonify({'message': 'Login successful!', 'userId': user.id}), 200
+    login_throttle.failed(email, request.remote_addr)
     return jsonify({'message': 'Invalid email or password'}), 401
 
 @api.route('/api/logout', methods=['POST'])
@@ -544,10 +589,17 @@ def logout():
 @api.route('/api/admin/login', methods=['POST'])
 def admin_login():
     data = request.get_json()
-    user = User.query.filter_by(email=data.get('email')).first()
-    if user and user.check_password(data.get('password')) and user.is_admin:
+    email, password = data.get('email'), data.get('password')
+    retry_after = login_throttle.retry_after(email, request.remote_addr)
+    if retry_after:
+        return too_many_attempts(retry_after)
+    user = User.query.filter_by(email=email).first()
+    if user and user.is_admin and check_user_password(user, password):
+        login_throttle.succeeded(email, request.remote_addr)
         login_user(user)
+        principal_cache.invalidate(user.id)
         return jsonify({'message': 'Admin login successful!'}), 200
+    login_throttle.failed(email, request.remote_addr)
     return jsonify({'message': 'Invalid admin credentials or permissions'}), 401
 
 # --- CLIENT API ROUTES (ALL SECURED) ---
@@ -564,7 +616,7 @@ def create_bot():
     # --- NEW, SAFER LOGIC ---
     try:
         # 1. Verify the token with Telegram first
-        bot = telegram.Bot(token=bot_token)
+        bot = bot_clients.get(bot_token)
         bot_info = run_async(bot.get_me())
         logging.info(f"--- Token is valid for bot: @{bot_info.username} ---")
 
@@ -572,16 +624,19 @@ def create_bot():
         new_bot = Bot(token=bot_token, wallet=data.get('wallet_address'), user_id=current_user.id)
         db.session.add(new_bot)
         db.session.commit()
+        tenant_cache.invalidate(bot_token)
+        principal_cache.invalidate(current_user.id)
 
         # 3. Now, set the webhook
         run_async(setup_bot_webhook(bot_token))
         
         logging.info(f"--- Successfully created and registered bot {new_bot.id} ---")
-        return jsonify(new_bot.to_dict()), 201
+        return jsonify(serialize_bot(new_bot.id, include_orders=True)), 201
 
     except Exception as e:
         # 4. If verification or webhook setup fails, give a clear error
         logging.error(f"--- Bot creation failed for token {bot_token[:10]}... Reason: {e} ---")
+        bot_clients.invalidate(bot_token)
         # This error message will now be shown to the user in the dashboard
         return jsonify({'message': 'Failed to create bot. The Telegram token is invalid or the bot is stopped. Please check the token with BotFather.'}), 400
 @api.route('/api/users/<string:user_id>/bots', methods=['GET'])
@@ -589,77 +644,88 @@ def create_bot():
 def get_user_bots(user_id):
     if current_user.id != user_id:
         return jsonify({'message': 'Forbidden'}), 403
-    return jsonify([bot.to_dict() for bot in current_user.bots])
+    return jsonify(serialize_bots(Bot.user_id == current_user.id))
 
 @api.route('/api/users/<string:user_id>/dashboard-stats', methods=['GET'])
 @login_required
+@read_replica
 def get_user_dashboard_stats(user_id):
     if current_user.id != user_id:
         return jsonify({'message': 'Forbidden'}), 403
-    bot_ids = [bot.id for bot in current_user.bots]
-    total_sales = db.session.query(db.func.sum(Order.price)).filter(Order.bot_id.in_(bot_ids)).scalar() or 0
-    total_orders = Order.query.filter(Order.bot_id.in_(bot_ids)).count()
-    recent_orders_query = Order.query.filter(Order.bot_id.in_(bot_ids)).order_by(Order.timestamp.desc()).limit(5).all()
-    recent_orders = [order.to_dict() for order in recent_orders_query]
-    stats = {'total_sales': round(total_sales, 2), 'total_orders': total_orders, 'recent_orders': recent_orders}
+    bot_ids = list(current_user.bot_ids)
+    # Totals come from the sales rollups; sales only count paid orders.
+    summary = sales_summary(bot_ids)
+    recent_rows = (
+        db.session.query(*ORDER_COLUMNS).filter(Order.bot_id.in_(bot_ids))
+        .order_by(Order.timestamp.desc(), Order.id.desc()).limit(5).all()
+    )
+    recent_orders = [order_dict(row) for row in recent_rows]
+    stats = {'total_sales': round(summary['total_sales'], 2), 'total_orders': summary['total_orders'], 'paid_orders': summary['paid_orders'], 'recent_orders': recent_orders}
     return jsonify(stats)
 
 @api.route('/api/bots/<string:bot_id>', methods=['GET'])
 @login_required
 def get_bot_details(bot_id):
-    bot = db.session.get(Bot, bot_id)
-    if not bot or bot.owner != current_user:
+    # Orders are left out unless asked for with ?include=orders; the manage page does not need them.
+    include_orders = 'orders' in request.args.get('include', '').split(',')
+    bots = serialize_bots(Bot.id == bot_id, include_orders=include_orders) if owns_bot(bot_id) else []
+    if not bots:
         return jsonify({'message': 'Bot not found or access denied'}), 404
-    return jsonify(bot.to_dict())
+    return jsonify(bots[0])
 
 @api.route('/api/bots/<string:bot_id>', methods=['DELETE'])
 @login_required
 def delete_bot(bot_id):
     bot = db.session.get(Bot, bot_id)
-    if not bot or bot.owner != current_user:
+    if not bot or not owns_bot(bot.id):
         return jsonify({'message': 'Bot not found or access denied'}), 404
     db.session.delete(bot)
     db.session.commit()
+    bot_clients.invalidate(bot.token)
+    tenant_cache.invalidate(bot.token)
+    principal_cache.invalidate(current_user.id)
     return jsonify({'message': 'Bot deleted successfully'}), 200
 
 @api.route('/api/bots/<string:bot_id>/welcome-message', methods=['POST'])
 @login_required
 def update_welcome_message(bot_id):
     bot = db.session.get(Bot, bot_id)
-    if not bot or bot.owner != current_user:
+    if not bot or not owns_bot(bot.id):
         return jsonify({'message': 'Bot not found or access denied'}), 404
     data = request.get_json()
     bot.welcome_message = data.get('message', '')
     db.session.commit()
+    tenant_cache.invalidate(bot.token)
     return jsonify({'message': 'Welcome message updated successfully.'}), 200
 
 @api.route('/api/bots/<string:bot_id>/categories', methods=['POST'])
 @login_required
 def create_category(bot_id):
     bot = db.session.get(Bot, bot_id)
-    if not bot or bot.owner != current_user:
+    if not bot or not owns_bot(bot.id):
         return jsonify({'message': 'Bot not found or access denied'}), 404
     data = request.get_json()
     new_category = Category(name=data.get('name'), bot_id=bot.id, parent_id=data.get('parent_id'))
     db.session.add(new_category)
-    db.session.commit()
+    commit_catalog_change(bot)
     return jsonify(new_category.to_dict()), 201
 
 @api.route('/api/categories/<string:category_id>', methods=['DELETE'])
 @login_required
 def delete_category(category_id):
     category = db.session.get(Category, category_id)
-    if not category or category.bot.owner != current_user:
+    if not category or not owns_bot(category.bot_id):
         return jsonify({'message': 'Category not found or access denied'}), 404
+    bot = category.bot
     db.session.delete(category)
-    db.session.commit()
+    commit_catalog_change(bot)
     return jsonify({'message': 'Category deleted successfully'}), 200
 
 @api.route('/api/bots/<string:bot_id>/products', methods=['POST'])
 @login_required
 def add_product_to_bot(bot_id):
     bot = db.session.get(Bot, bot_id)
-    if not bot or bot.owner != current_user:
+    if not bot or not owns_bot(bot.id):
         return jsonify({'message': 'Bot not found or access denied'}), 404
     data = request.get_json()
     category_id = data.get('category_id')
@@ -668,54 +734,75 @@ def add_product_to_bot(bot_id):
         return jsonify({'message': 'Category not found or does not belong to this bot'}), 404
     new_product = Product(name=data.get('name'), description=data.get('description'), unit=data.get('unit'), image_url=data.get('image_url'), video_url=data.get('video_url'), category_id=category.id)
     db.session.add(new_product)
-    db.session.commit()
+    commit_catalog_change(bot)
     return jsonify(new_product.to_dict()), 201
     
 @api.route('/api/products/<string:product_id>', methods=['DELETE'])
 @login_required
 def delete_product(product_id):
     product = db.session.get(Product, product_id)
-    if not product or product.category.bot.owner != current_user:
+    if not product or not owns_bot(product.category.bot_id):
         return jsonify({'message': 'Product not found or access denied'}), 404
+    bot = product.category.bot
     db.session.delete(product)
-    db.session.commit()
+    commit_catalog_change(bot)
     return jsonify({'message': 'Product deleted successfully'}), 200
 
 @api.route('/api/products/<string:product_id>/price-tiers', methods=['POST'])
 @login_required
 def add_price_tier(product_id):
     product = db.session.get(Product, product_id)
-    if not product or product.category.bot.owner != current_user:
+    if not product or not owns_bot(product.category.bot_id):
         return jsonify({'message': 'Product not found or access denied'}), 404
     data = request.get_json()
     new_price_tier = PriceTier(label=data.get('label'), price=float(data.get('price')), product_id=product.id)
     db.session.add(new_price_tier)
-    db.session.commit()
+    commit_catalog_change(product.category.bot)
     return jsonify(new_price_tier.to_dict()), 201
 
 @api.route('/api/price-tiers/<string:tier_id>', methods=['DELETE'])
 @login_required
 def delete_price_tier(tier_id):
     price_tier = db.session.get(PriceTier, tier_id)
-    if not price_tier or price_tier.product.category.bot.owner != current_user:
+    if not price_tier or not owns_bot(price_tier.product.category.bot_id):
         return jsonify({'message': 'Price tier not found or access denied'}), 404
+    bot = price_tier.product.category.bot
     db.session.delete(price_tier)
-    db.session.commit()
+    commit_catalog_change(bot)
     return jsonify({'message': 'Price tier deleted successfully'}), 200
 
 @api.route('/api/bots/<string:bot_id>/orders', methods=['GET'])
 @login_required
+@read_replica
 def get_bot_orders(bot_id):
-    bot = db.session.get(Bot, bot_id)
-    if not bot or bot.owner != current_user:
+    if not owns_bot(bot_id):
+        return jsonify({'message': 'Bot not found or access denied'}), 404
+    try:
+        criteria = order_filters(request.args)
+        query = db.session.query(*ORDER_COLUMNS).filter(Order.bot_id == bot_id, *criteria)
+        rows, next_cursor = keyset_page(query, request.args.get('cursor'), page_size(request.args))
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+    return jsonify({'orders': [order_dict(row) for row in rows], 'next_cursor': next_cursor})
+
+@api.route('/api/bots/<string:bot_id>/orders/count', methods=['GET'])
+@login_required
+@read_replica
+def count_bot_orders(bot_id):
+    if not owns_bot(bot_id):
         return jsonify({'message': 'Bot not found or access denied'}), 404
-    return jsonify([o.to_dict() for o in bot.orders])
+    try:
+        criteria = order_filters(request.args)
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+    count = db.session.query(db.func.count(Order.id)).filter(Order.bot_id == bot_id, *criteria).scalar()
+    return jsonify({'count': count})
 
 @api.route('/api/orders/<string:order_id>/dispatch', methods=['POST'])
 @login_required
 def dispatch_order(order_id):
     order = db.session.get(Order, order_id)
-    if not order or order.bot.owner != current_user:
+    if not order or not owns_bot(order.bot_id):
         return jsonify({'message': 'Order not found or access denied'}), 404
     order.status = 'dispatched'
     db.session.commit()
@@ -740,9 +827,9 @@ def upload_media():
 
 @api.route('/api/admin/users', methods=['GET'])
 @admin_required
+@read_replica
 def get_users():
-    users = User.query.all()
-    return jsonify([user.to_dict() for user in users])
+    return jsonify(serialize_users())
 
 @api.route('/api/admin/users', methods=['POST'])
 @admin_required
@@ -752,8 +839,7 @@ def create_user():
     password = data.get('password')
     if not email or not password: return jsonify({'message': 'Email and password are required.'}), 400
     if User.query.filter_by(email=email).first(): return jsonify({'message': 'User with this email already exists.'}), 409
-    new_user = User(email=email)
-    new_user.set_password(password)
+    new_user = User(email=email, password_hash=password_hasher.hash(password))
     db.session.add(new_user)
     db.session.commit()
     return jsonify(new_user.to_dict()), 201
@@ -761,17 +847,22 @@ def create_user():
 @api.route('/api/admin/users/<string:user_id>', methods=['GET'])
 @admin_required
 def get_user_details(user_id):
-    user = db.session.get(User, user_id)
-    if not user: return jsonify({'message': 'User not found'}), 404
-    return jsonify(user.to_dict())
+    users = serialize_users(User.id == user_id)
+    if not users: return jsonify({'message': 'User not found'}), 404
+    return jsonify(users[0])
 
 @api.route('/api/admin/users/<string:user_id>', methods=['DELETE'])
 @admin_required
 def delete_user(user_id):
     user = db.session.get(User, user_id)
     if not user: return jsonify({'message': 'User not found'}), 404
+    bot_tokens = [bot.token for bot in user.bots]
     db.session.delete(user)
     db.session.commit()
+    for token in bot_tokens:
+        bot_clients.invalidate(token)
+    tenant_cache.invalidate(*bot_tokens)
+    principal_cache.invalidate(user_id)
     return jsonify({'message': 'User deleted successfully'}), 200
 
 @api.route('/api/admin/users/<string:user_id>/toggle-active', methods=['POST'])
@@ -781,6 +872,8 @@ def toggle_user_active(user_id):
     if not user: return jsonify({'message': 'User not found'}), 404
     user.is_active = not user.is_active
     db.session.commit()
+    tenant_cache.invalidate(*[bot.token for bot in user.bots])
+    principal_cache.invalidate(user_id)
     return jsonify({'message': f'User status changed to {user.is_active}'}), 200
 
 @api.route('/api/admin/users/<string:user_id>/update-email', methods=['POST'])
@@ -791,6 +884,7 @@ def update_user_email(user_id):
     data = request.get_json()
     user.email = data.get('email')
     db.session.commit()
+    principal_cache.invalidate(user_id)
     return jsonify({'message': 'User email updated successfully'}), 200
 
 @api.route('/api/admin/users/<string:user_id>/reset-password', methods=['POST'])
@@ -799,33 +893,87 @@ def reset_user_password(user_id):
     user = db.session.get(User, user_id)
     if not user: return jsonify({'message': 'User not found'}), 404
     data = request.get_json()
-    user.set_password(data.get('password'))
+    user.password_hash = password_hasher.hash(data.get('password'))
     db.session.commit()
+    principal_cache.invalidate(user_id)
     return jsonify({'message': 'User password reset successfully'}), 200
 
 @api.route('/api/admin/orders', methods=['GET'])
 @admin_required
+@read_replica
 def get_all_orders():
-    orders = Order.query.order_by(Order.timestamp.desc()).all()
-    orders_with_user_info = []
-    for order in orders:
-        order_data = order.to_dict()
-        order_data['user_email'] = order.bot.owner.email
-        orders_with_user_info.append(order_data)
-    return jsonify(orders_with_user_info)
+    try:
+        query = orders_with_owner_query(*order_filters(request.args))
+        rows, next_cursor = keyset_page(query, request.args.get('cursor'), page_size(request.args))
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+    return jsonify({'orders': [order_with_owner_dict(row) for row in rows], 'next_cursor': next_cursor})
+
+@api.route('/api/admin/orders/export', methods=['GET'])
+@admin_required
+def export_orders():
+    # Streamed, so the whole order table is never held in memory; takes the same filters as the listing.
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in ('ndjson', 'csv'):
+        return jsonify({'message': "format must be 'ndjson' or 'csv'"}), 400
+    try:
+        criteria = order_filters(request.args)
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+    if export_format == 'csv':
+        body, mimetype = iter_csv(criteria), 'text/csv'
+    else:
+        body, mimetype = iter_ndjson(criteria), 'application/x-ndjson'
+    filename = f"orders-{datetime.date.today().isoformat()}.{export_format}"
+    return Response(
+        stream_with_context(body), mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+    )
 
 @api.route('/api/admin/dashboard-stats', methods=['GET'])
 @admin_required
+@read_replica
 def get_dashboard_stats():
-    total_sales = db.session.query(db.func.sum(Order.price)).scalar() or 0
-    total_orders = Order.query.count()
+    # Totals come from the sales rollups; sales only count paid orders.
+    summary = sales_summary()
+    total_sales = summary['total_sales']
     commission_earned = total_sales * 0.01
     active_users = User.query.filter_by(is_active=True).count()
-    recent_orders_query = Order.query.order_by(Order.timestamp.desc()).limit(5).all()
-    recent_orders = []
-    for order in recent_orders_query:
-        order_data = order.to_dict()
-        order_data['user_email'] = order.bot.owner.email
-        recent_orders.append(order_data)
-    stats = {'total_sales': round(total_sales, 2), 'commission_earned': round(commission_earned, 2), 'total_orders': total_orders, 'active_users': active_users, 'recent_orders': recent_orders}
+    recent_rows = orders_with_owner_query().order_by(Order.timestamp.desc(), Order.id.desc()).limit(5).all()
+    recent_orders = [order_with_owner_dict(row) for row in recent_rows]
+    stats = {'total_sales': round(total_sales, 2), 'commission_earned': round(commission_earned, 2), 'total_orders': summary['total_orders'], 'paid_orders': summary['paid_orders'], 'active_users': active_users, 'recent_orders': recent_orders}
     return jsonify(stats)
+
+@api.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    # All workers' metrics in Prometheus text format; see app/metrics.py.
+    if not metrics.enabled:
+        return "Not found", 404
+    if metrics.token and not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {metrics.token}"):
+        return "Unauthorized", 401
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@api.route('/api/admin/runtime-stats', methods=['GET'])
+@admin_required
+def get_runtime_stats():
+    # Per-worker numbers: each gunicorn worker reports its own queue.
+    return jsonify({
+        'update_queue': update_queue.stats(),
+        'event_loop': {'in_flight': background_loop.in_flight},
+        'bot_clients': bot_clients.stats(),
+        'outbound': outbound.stats(),
+        'tenant_cache': tenant_cache.stats(),
+        'catalog_cache': catalog_cache.stats(),
+        'nowpayments': nowpayments.stats(),
+        'ipn_consumer': ipn_consumer.stats(),
+        'update_dedupe': update_dedupe.stats(),
+        'conversations': conversations.stats(),
+        'cart_writer': cart_writer.stats(),
+        'render_cache': render_cache.stats(),
+        'principal_cache': principal_cache.stats(),
+        'password_hasher': password_hasher.stats(),
+        'login_throttle': login_throttle.stats(),
+        'write_lane': write_lane.stats(),
+        'replicas': replica_router.stats(),
+        'currencies': {'count': len(currency_cache.currencies), 'version': currency_cache.version},
+    })
@@ -0,0 +1,108 @@
+"""
+In-place schema upgrades for databases created before a model change.
+
+`db.create_all()` only creates missing tables. This module also adds missing
+columns and indexes to existing tables, so `flask --app run init-db` upgrades
+a live SQLite or Postgres database without a separate migration tool.
+"""
+import logging
+
+from sqlalchemy import func, inspect, text
+
+from . import db
+
+
+def _column_ddl(column, dialect):
+    ddl = f"{dialect.identifier_preparer.quote(column.name)} {column.type.compile(dialect=dialect)}"
+    if column.server_default is not None:
+        ddl += f" DEFAULT {column.server_default.arg}"
+    if not column.nullable and column.server_default is not None:
+        ddl += " NOT NULL"
+    return ddl
+
+
+def add_missing_columns():
+    """
+    Adds every model column that the live table does not have yet.
+    Returns the list of "table.column" names that were added.
+    """
+    engine = db.engine
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    added = []
+    with engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing = {c['name'] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                table_name = engine.dialect.identifier_preparer.quote(table.name)
+                connection.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {_column_ddl(column, engine.dialect)}"))
+                added.append(f"{table.name}.{column.name}")
+    for name in added:
+        logging.info(f"--- Added missing column {name} ---")
+    return added
+
+
+def merge_duplicate_cart_items():
+    """
+    Folds duplicate (cart, price tier) rows into one before the unique index
+    on them is created. Returns how many rows were removed.
+    """
+    from .models import CartItem
+    if not inspect(db.engine).has_table(CartItem.__tablename__):
+        return 0
+    duplicates = (
+        db.session.query(CartItem.cart_id, CartItem.price_tier_id, func.sum(CartItem.quantity), func.min(CartItem.id))
+        .group_by(CartItem.cart_id, CartItem.price_tier_id)
+        .having(func.count(CartItem.id) > 1)
+        .all()
+    )
+    removed = 0
+    for cart_id, price_tier_id, quantity, keep_id in duplicates:
+        db.session.query(CartItem).filter(CartItem.id == keep_id).update({'quantity': quantity})
+        removed += (
+            db.session.query(CartItem)
+            .filter(CartItem.cart_id == cart_id, CartItem.price_tier_id == price_tier_id, CartItem.id != keep_id)
+            .delete(synchronize_session=False)
+        )
+    db.session.commit()
+    if removed:
+        logging.info(f"--- Merged {removed} duplicate cart items ---")
+    return removed
+
+
+def add_missing_indexes():
+    """
+    Creates every model index that the live database does not have yet.
+    Returns the names of the indexes that were created.
+    """
+    engine = db.engine
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    added = []
+    with engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing = {i['name'] for i in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name in existing:
+                    continue
+                index.create(connection, checkfirst=True)
+                added.append(index.name)
+    for name in added:
+        logging.info(f"--- Created missing index {name} ---")
+    return added
+
+
+def upgrade_schema():
+    """
+    Creates missing tables, then brings existing tables up to date.
+    Returns the columns and indexes that were added.
+    """
+    merge_duplicate_cart_items()
+    db.create_all()
+    return add_missing_columns() + add_missing_indexes()
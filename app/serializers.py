@@ -0,0 +1,151 @@
+"""
+JSON serializers for the dashboard API that build dicts straight from row
+tuples.
+
+`Bot.to_dict()` walks lazy relationships, costing one query per category,
+product and tier, plus one object per order. These helpers load every bot
+matching a filter, with its whole category tree, in four column-only queries
+however big the shops are. Orders take one more query and are only loaded
+when asked for. The output has the same shape as the model `to_dict` methods.
+"""
+import collections
+
+from . import db
+from .models import Bot, Category, Order, PriceTier, Product, User
+
+ORDER_COLUMNS = (
+    Order.id, Order.product_name, Order.price, Order.timestamp, Order.status, Order.payout_status,
+    Order.telegram_username, Order.shipping_address, Order.customer_note,
+    Order.payment_currency, Order.amount_paid,
+)
+
+
+def order_dict(row):
+    """
+    Turns a row selected with ORDER_COLUMNS into the `Order.to_dict()` shape.
+    """
+    (order_id, product_name, price, timestamp, status, payout_status,
+     telegram_username, shipping_address, customer_note, payment_currency, amount_paid) = row[:len(ORDER_COLUMNS)]
+    return {
+        'id': order_id,
+        'product_name': product_name,
+        'price': price,
+        'timestamp': timestamp.isoformat() if timestamp else None,
+        'status': status,
+        'payout_status': payout_status,
+        'telegram_username': telegram_username,
+        'shipping_address': shipping_address,
+        'customer_note': customer_note,
+        'payment_currency': payment_currency,
+        'amount_paid': amount_paid,
+    }
+
+
+def _category_trees(bot_ids):
+    """
+    Returns {bot id: [root category dicts]} for the given bots.
+    """
+    category_rows = (
+        db.session.query(Category.id, Category.name, Category.parent_id, Category.bot_id)
+        .filter(Category.bot_id.in_(bot_ids))
+        .all()
+    )
+    product_rows = (
+        db.session.query(
+            Product.id, Product.name, Product.description, Product.unit,
+            Product.image_url, Product.video_url, Product.category_id
+        )
+        .join(Category, Product.category_id == Category.id)
+        .filter(Category.bot_id.in_(bot_ids))
+        .all()
+    )
+    tier_rows = (
+        db.session.query(PriceTier.id, PriceTier.label, PriceTier.price, PriceTier.product_id)
+        .join(Product, PriceTier.product_id == Product.id)
+        .join(Category, Product.category_id == Category.id)
+        .filter(Category.bot_id.in_(bot_ids))
+        .all()
+    )
+
+    tiers_by_product = collections.defaultdict(list)
+    for tier_id, label, price, product_id in tier_rows:
+        tiers_by_product[product_id].append({'id': tier_id, 'label': label, 'price': price})
+
+    products_by_category = collections.defaultdict(list)
+    for product_id, name, description, unit, image_url, video_url, category_id in product_rows:
+        products_by_category[category_id].append({
+            'id': product_id, 'name': name, 'description': description,
+            'unit': unit, 'image_url': image_url, 'video_url': video_url,
+            'price_tiers': tiers_by_product[product_id],
+        })
+
+    categories = {}
+    for category_id, name, parent_id, _ in category_rows:
+        categories[category_id] = {
+            'id': category_id, 'name': name, 'parent_id': parent_id,
+            'sub_categories': [], 'products': products_by_category[category_id],
+        }
+
+    roots = collections.defaultdict(list)
+    for category_id, _, parent_id, bot_id in category_rows:
+        parent = categories.get(parent_id) if parent_id else None
+        if parent is not None:
+            parent['sub_categories'].append(categories[category_id])
+        elif parent_id is None:
+            roots[bot_id].append(categories[category_id])
+    return roots
+
+
+def serialize_bots(*criteria, include_orders=False):
+    """
+    Serializes every bot matching `criteria` (e.g. `Bot.user_id == user_id`)
+    with its category tree, and its orders if `include_orders` is set.
+    """
+    bot_rows = db.session.query(Bot.id, Bot.token, Bot.wallet, Bot.welcome_message).filter(*criteria).all()
+    if not bot_rows:
+        return []
+    bot_ids = [row[0] for row in bot_rows]
+    trees = _category_trees(bot_ids)
+
+    orders = collections.defaultdict(list)
+    if include_orders:
+        order_rows = db.session.query(*ORDER_COLUMNS, Order.bot_id).filter(Order.bot_id.in_(bot_ids)).all()
+        for row in order_rows:
+            orders[row[-1]].append(order_dict(row))
+
+    result = []
+    for bot_id, token, wallet, welcome_message in bot_rows:
+        data = {
+            'id': bot_id, 'token': token, 'wallet': wallet,
+            'welcome_message': welcome_message,
+            'categories': trees[bot_id],
+        }
+        if include_orders:
+            data['orders'] = orders[bot_id]
+        result.append(data)
+    return result
+
+
+def serialize_bot(bot_id, include_orders=False):
+    """
+    Serializes one bot, or returns None if it does not exist.
+    """
+    bots = serialize_bots(Bot.id == bot_id, include_orders=include_orders)
+    return bots[0] if bots else None
+
+
+def serialize_users(*criteria):
+    """
+    Serializes users in the `User.to_dict()` shape with one query for all their bots.
+    """
+    user_rows = db.session.query(User.id, User.email, User.is_active).filter(*criteria).all()
+    if not user_rows:
+        return []
+    bots_by_user = collections.defaultdict(list)
+    bot_rows = db.session.query(Bot.id, Bot.token, Bot.user_id).filter(Bot.user_id.in_([row[0] for row in user_rows])).all()
+    for bot_id, token, user_id in bot_rows:
+        bots_by_user[user_id].append({'id': bot_id, 'token_snippet': f"{token[:6]}..."})
+    return [
+        {'id': user_id, 'email': email, 'is_active': is_active, 'bots': bots_by_user[user_id]}
+        for user_id, email, is_active in user_rows
+    ]
@@ -0,0 +1,16 @@
+"""
+Small SQL helpers shared by the modules that write with upserts.
+"""
+from sqlalchemy.dialects import postgresql, sqlite
+
+
+def dialect_insert(table, bind):
+    """
+    Returns an INSERT for `table` that supports ON CONFLICT on `bind`'s dialect.
+    """
+    dialect = bind.dialect.name
+    if dialect == 'postgresql':
+        return postgresql.insert(table)
+    if dialect == 'sqlite':
+        return sqlite.insert(table)
+    raise NotImplementedError(f"Upserts are not supported on {dialect}")
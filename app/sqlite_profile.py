@@ -0,0 +1,57 @@
+"""
+Opt-in SQLite performance profile (SQLITE_PERFORMANCE_PROFILE=1).
+
+Stock SQLite uses a rollback journal, so a writer blocks every reader and a
+second writer fails with "database is locked" almost at once. When the
+profile is on, every new connection to a SQLite engine gets these settings:
+
+- journal_mode=WAL: readers keep reading while one writer commits.
+- synchronous=NORMAL: no fsync per commit in WAL mode. A power cut can lose
+  the last commits, but it cannot corrupt the database.
+- busy_timeout: writers wait for the lock instead of failing straight away.
+- mmap_size and cache_size: reads come from memory-mapped pages and a larger
+  page cache.
+
+The profile also takes over transaction control from the sqlite3 driver. The
+driver does not issue BEGIN before a SAVEPOINT, which breaks the savepoints
+the write lane uses, so the lane is only enabled with this profile. Transactions are BEGIN DEFERRED by
+default. A connection with the `sqlite_begin` execution option set to
+'IMMEDIATE' takes the write lock up front, so it waits on busy_timeout rather
+than failing when it upgrades from reading to writing.
+"""
+import logging
+
+from sqlalchemy import event
+
+
+def install(engine, config):
+    """
+    Applies the profile to `engine` if it is a SQLite engine. Returns True if it did.
+    """
+    if engine.dialect.name != 'sqlite':
+        return False
+
+    pragmas = (
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'NORMAL'),
+        ('busy_timeout', int(config.get('SQLITE_BUSY_TIMEOUT_MS', 5000))),
+        ('mmap_size', int(config.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))),
+        # A negative cache_size is in KiB rather than pages.
+        ('cache_size', -int(config.get('SQLITE_CACHE_SIZE_KB', 64 * 1024))),
+    )
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        # Autocommit at the driver level; the 'begin' listener below starts transactions.
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+    @event.listens_for(engine, 'begin')
+    def begin(conn):
+        conn.exec_driver_sql(f"BEGIN {conn.get_execution_options().get('sqlite_begin', 'DEFERRED')}")
+
+    logging.info(f"--- SQLite performance profile enabled for {engine.url.database} ---")
+    return True
@@ -27,6 +27,10 @@ document.addEventListener('DOMContentLoaded', () => {
     const ordersListDiv = document.getElementById('master-orders-list');
     const noOrdersMessage = document.getElementById('no-orders-message');
     const logoutButton = document.getElementById('admin-logout-button');
+    const loadMoreButton = document.getElementById('load-more-button');
+
+    // Cursor for the next page of orders; null once the last page is shown.
+    let nextCursor = null;
 
     if (logoutButton) {
         logoutButton.addEventListener('click', () => {
@@ -57,13 +61,15 @@ document.addEventListener('DOMContentLoaded', () => {
     }
 
     async function fetchAllOrders() {
+        const params = new URLSearchParams();
+        if (nextCursor) params.set('cursor', nextCursor);
         try {
-            const response = await fetch('/api/admin/orders');
+            const response = await fetch(`/api/admin/orders?${params}`);
             if (response.ok) {
-                const orders = await response.json();
-                if (orders.length > 0) {
-                    orders.forEach(order => renderOrder(order));
-                }
+                const page = await response.json();
+                page.orders.forEach(order => renderOrder(order));
+                nextCursor = page.next_cursor;
+                loadMoreButton.classList.toggle('hidden', !nextCursor);
             } else {
                 console.error("Failed to fetch orders, server responded with an error.");
             }
@@ -72,5 +78,7 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
+    loadMoreButton.addEventListener('click', fetchAllOrders);
+
     fetchAllOrders();
 });
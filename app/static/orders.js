@@ -28,6 +28,14 @@ document.addEventListener('DOMContentLoaded', () => {
     const logoutButton = document.getElementById('logout-button');
     const ordersListBody = document.getElementById('orders-list');
     const noOrdersMessage = document.getElementById('no-orders-message');
+    const statusFilter = document.getElementById('status-filter');
+    const fromFilter = document.getElementById('from-filter');
+    const toFilter = document.getElementById('to-filter');
+    const ordersCount = document.getElementById('orders-count');
+    const loadMoreButton = document.getElementById('load-more-button');
+
+    // Cursor for the next page of the current listing; null once the last page is shown.
+    let nextCursor = null;
 
     const pathParts = window.location.pathname.split('/');
     const botId = pathParts[pathParts.length - 1];
@@ -113,27 +121,56 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
-    async function fetchBotOrders() {
+    function filterParams() {
+        const params = new URLSearchParams();
+        if (statusFilter.value) params.set('status', statusFilter.value);
+        if (fromFilter.value) params.set('from', fromFilter.value);
+        if (toFilter.value) params.set('to', toFilter.value);
+        return params;
+    }
+
+    async function fetchOrdersCount() {
+        try {
+            const response = await fetch(`/api/bots/${botId}/orders/count?${filterParams()}`);
+            const data = await handleApiError(response);
+            if (data) {
+                ordersCount.textContent = `${data.count} order${data.count === 1 ? '' : 's'}`;
+            }
+        } catch (error) {
+            console.error('Failed to count bot orders:', error);
+        }
+    }
+
+    async function fetchBotOrders(append = false) {
         if (!botId) return;
+        const params = filterParams();
+        if (append && nextCursor) params.set('cursor', nextCursor);
         try {
-            const response = await fetch(`/api/bots/${botId}/orders`);
-            const orders = await handleApiError(response);
+            const response = await fetch(`/api/bots/${botId}/orders?${params}`);
+            const page = await handleApiError(response);
             
-            if (orders) {
-                ordersListBody.innerHTML = '';
-                if (orders.length > 0) {
-                    noOrdersMessage.classList.add('hidden');
-                    orders.forEach(order => renderOrder(order));
-                } else {
-                    noOrdersMessage.classList.remove('hidden');
-                }
+            if (page) {
+                if (!append) ordersListBody.innerHTML = '';
+                page.orders.forEach(order => renderOrder(order));
+                nextCursor = page.next_cursor;
+                loadMoreButton.classList.toggle('hidden', !nextCursor);
+                noOrdersMessage.classList.toggle('hidden', ordersListBody.children.length > 0);
             }
         } catch (error) {
             console.error('Failed to fetch bot orders:', error);
         }
     }
 
+    function reloadOrders() {
+        nextCursor = null;
+        fetchBotOrders();
+        fetchOrdersCount();
+    }
+
+    [statusFilter, fromFilter, toFilter].forEach(input => input.addEventListener('change', reloadOrders));
+    loadMoreButton.addEventListener('click', () => fetchBotOrders(true));
+
     // --- Initial Load ---
     pageTitle.textContent = `Orders for Bot (...${botId.slice(-6)})`;
-    fetchBotOrders();
+    reloadOrders();
 });
\ No newline at end of file
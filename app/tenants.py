@@ -0,0 +1,99 @@
+"""
+In-memory token -> shop resolution for the webhook hot path.
+
+One joined query resolves a bot token to the few fields update handling
+needs. The answer is cached with a TTL, and unknown tokens are cached too, so
+spam to stale webhook URLs never reaches the database. Writes in this worker
+invalidate entries straight away; other workers see changes once the TTL
+expires.
+"""
+import collections
+import threading
+import time
+
+from . import db
+
+Tenant = collections.namedtuple(
+    'Tenant', ['id', 'owner_active', 'welcome_message', 'wallet', 'catalog_version']
+)
+
+
+class TenantCache:
+    def __init__(self, app=None):
+        self.ttl = 60
+        self.negative_ttl = 300
+        self.max_entries = 10000
+        self._entries = collections.OrderedDict()
+        self._missing = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttl = float(app.config.get('TENANT_CACHE_TTL', 60))
+        self.negative_ttl = float(app.config.get('TENANT_NEGATIVE_CACHE_TTL', 300))
+        self.max_entries = max(1, int(app.config.get('TENANT_CACHE_SIZE', 10000)))
+        app.extensions['tenant_cache'] = self
+
+    def resolve(self, token):
+        """
+        Returns the Tenant for `token`, or None if no such bot exists.
+        Must be called inside an app context.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry and entry[0] > now:
+                self._entries.move_to_end(token)
+                self.hits += 1
+                return entry[1]
+            expires = self._missing.get(token)
+            if expires and expires > now:
+                self.hits += 1
+                return None
+
+        self.misses += 1
+        tenant = self._load(token)
+        with self._lock:
+            if tenant is None:
+                self._store(self._missing, token, now + self.negative_ttl)
+            else:
+                self._missing.pop(token, None)
+                self._store(self._entries, token, (now + self.ttl, tenant))
+        return tenant
+
+    @staticmethod
+    def _load(token):
+        from .models import Bot, User
+        row = (
+            db.session.query(Bot.id, User.is_active, Bot.welcome_message, Bot.wallet, Bot.catalog_version)
+            .join(User, Bot.user_id == User.id)
+            .filter(Bot.token == token)
+            .first()
+        )
+        return Tenant(*row) if row else None
+
+    def _store(self, entries, token, value):
+        entries[token] = value
+        entries.move_to_end(token)
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+
+    def invalidate(self, *tokens):
+        with self._lock:
+            for token in tokens:
+                self._entries.pop(token, None)
+                self._missing.pop(token, None)
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'negative_entries': len(self._missing),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+tenant_cache = TenantCache()
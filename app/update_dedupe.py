@@ -0,0 +1,150 @@
+"""
+Drops Telegram updates that were already accepted.
+
+Telegram redelivers an update when the webhook is slow to answer, and handling
+it twice would add to a cart twice or open a second payment. Each bot keeps a
+window of its most recent update_ids in memory; bots themselves are evicted
+LRU-style, so memory stays bounded however many shops there are. With
+TELEGRAM_DEDUPE_PERSIST on, accepted ids are also written to ProcessedUpdate so
+the window survives restarts and is shared between workers.
+"""
+import collections
+import datetime
+import logging
+import threading
+
+from sqlalchemy.exc import IntegrityError
+
+from . import db
+from .write_lane import write_lane
+
+PRUNE_EVERY = 500   # Persisted inserts between prunes of old rows.
+
+
+def _insert_processed_update(bot_id, update_id):
+    from .models import ProcessedUpdate
+    db.session.add(ProcessedUpdate(bot_id=bot_id, update_id=update_id))
+    db.session.flush()
+
+
+class UpdateDeduper:
+    def __init__(self, app=None):
+        self.window = 1000
+        self.max_bots = 10000
+        self.persist = False
+        self.retention = datetime.timedelta(hours=24)
+        self._seen = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._inserts = 0
+        self.accepted = 0
+        self.duplicates = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.window = max(1, int(app.config.get('TELEGRAM_DEDUPE_WINDOW', 1000)))
+        self.max_bots = max(1, int(app.config.get('TELEGRAM_DEDUPE_BOTS', 10000)))
+        self.persist = bool(app.config.get('TELEGRAM_DEDUPE_PERSIST', False))
+        self.retention = datetime.timedelta(hours=float(app.config.get('TELEGRAM_DEDUPE_RETENTION_HOURS', 24)))
+        app.extensions['update_dedupe'] = self
+
+    def _remember(self, bot_id, update_id):
+        """
+        Adds the id to the bot's window. Returns False if it was already there.
+        """
+        with self._lock:
+            ids = self._seen.get(bot_id)
+            if ids is None:
+                ids = self._seen[bot_id] = collections.OrderedDict()
+                while len(self._seen) > self.max_bots:
+                    self._seen.popitem(last=False)
+            else:
+                self._seen.move_to_end(bot_id)
+            if update_id in ids:
+                return False
+            ids[update_id] = None
+            while len(ids) > self.window:
+                ids.popitem(last=False)
+            return True
+
+    def _forget(self, bot_id, update_id):
+        with self._lock:
+            ids = self._seen.get(bot_id)
+            if ids is not None:
+                ids.pop(update_id, None)
+
+    def claim(self, bot_id, update_id):
+        """
+        Returns True the first time an update is seen for a bot and False for
+        a redelivery. Must be called inside an app context.
+        """
+        if not self._remember(bot_id, update_id):
+            self.duplicates += 1
+            return False
+
+        if self.persist:
+            try:
+                persisted = self._persist(bot_id, update_id)
+            except Exception:
+                # Not accepted after all, so Telegram's retry must not be dropped as a duplicate.
+                self._forget(bot_id, update_id)
+                raise
+            if not persisted:
+                self.duplicates += 1
+                return False
+
+        self.accepted += 1
+        return True
+
+    def release(self, bot_id, update_id):
+        """
+        Undoes a claim for an update that the webhook answers with an error
+        (the queue was full, or the inline handler raised), so Telegram's retry
+        is accepted. Updates that were acked are never redelivered.
+        """
+        self._forget(bot_id, update_id)
+        if self.persist:
+            from .models import ProcessedUpdate
+            ProcessedUpdate.query.filter_by(bot_id=bot_id, update_id=update_id).delete()
+            db.session.commit()
+
+    def _persist(self, bot_id, update_id):
+        try:
+            write_lane.run(_insert_processed_update, bot_id, update_id)
+        except IntegrityError:
+            # Accepted before a restart or by another worker.
+            return False
+
+        self._inserts += 1
+        if self._inserts % PRUNE_EVERY == 0:
+            # The id is already stored; a failed prune must not fail the claim.
+            try:
+                self.prune()
+            except Exception as e:
+                db.session.rollback()
+                logging.error(f"--- Failed to prune processed Telegram update ids: {e} ---")
+        return True
+
+    def prune(self):
+        """
+        Deletes persisted ids older than the retention period.
+        """
+        from .models import ProcessedUpdate
+        cutoff = datetime.datetime.utcnow() - self.retention
+        deleted = ProcessedUpdate.query.filter(ProcessedUpdate.received_at < cutoff).delete(synchronize_session=False)
+        db.session.commit()
+        if deleted:
+            logging.info(f"--- Pruned {deleted} processed Telegram update ids ---")
+        return deleted
+
+    def stats(self):
+        return {
+            'bots': len(self._seen),
+            'window': self.window,
+            'persist': self.persist,
+            'accepted': self.accepted,
+            'duplicates': self.duplicates,
+        }
+
+
+update_dedupe = UpdateDeduper()
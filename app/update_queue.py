@@ -0,0 +1,185 @@
+"""
+Background dispatch for incoming Telegram updates.
+
+In 'queue' mode the webhook route only validates and enqueues the raw update,
+then returns straight away. A pool of worker tasks on the process-wide
+background loop drains the queue. Updates are sharded by chat id, so every
+update for a given chat is handled by the same worker in arrival order.
+"""
+import asyncio
+import atexit
+import collections
+import logging
+import os
+import threading
+import time
+import zlib
+
+from .event_loop import background_loop
+
+
+def extract_chat_id(update_data):
+    """
+    Returns the chat id an update belongs to, or None if it has no chat.
+    """
+    for key in ('message', 'edited_message', 'channel_post', 'edited_channel_post'):
+        message = update_data.get(key)
+        if isinstance(message, dict):
+            return (message.get('chat') or {}).get('id')
+
+    callback_query = update_data.get('callback_query')
+    if isinstance(callback_query, dict):
+        message = callback_query.get('message') or {}
+        chat_id = (message.get('chat') or {}).get('id')
+        if chat_id is not None:
+            return chat_id
+        return (callback_query.get('from') or {}).get('id')
+    return None
+
+
+def is_valid_update(update_data):
+    return isinstance(update_data, dict) and isinstance(update_data.get('update_id'), int)
+
+
+class UpdateQueue:
+    """
+    A bounded, chat-ordered work queue for Telegram updates.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.mode = 'inline'
+        self.num_workers = 4
+        self.maxsize = 1000
+        self._shards = []
+        self._wakeups = []
+        self._tasks = []
+        self._per_shard = 1
+        self._pid = None
+        self._lock = threading.Lock()
+
+        # --- Gauges and counters ---
+        self.enqueued = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.last_wait = 0.0
+        self.max_wait = 0.0
+        self.avg_wait = 0.0
+        self.last_run_time = 0.0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.mode = app.config.get('TELEGRAM_DISPATCH_MODE', 'inline')
+        self.num_workers = max(1, int(app.config.get('UPDATE_QUEUE_WORKERS', 4)))
+        self.maxsize = max(1, int(app.config.get('UPDATE_QUEUE_MAXSIZE', 1000)))
+        app.extensions['update_queue'] = self
+
+    @property
+    def enabled(self):
+        return self.mode == 'queue'
+
+    def _ensure_started(self):
+        # Workers are started lazily so that gunicorn's pre-fork master never owns them.
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._per_shard = max(1, self.maxsize // self.num_workers)
+            self._shards = [collections.deque() for _ in range(self.num_workers)]
+            self._wakeups = background_loop.run(self._start_workers())
+            self._pid = os.getpid()
+            logging.info(f"--- Update queue started with {self.num_workers} workers ---")
+
+    async def _start_workers(self):
+        wakeups = [asyncio.Event() for _ in self._shards]
+        self._tasks = [
+            asyncio.create_task(self._worker(shard, wakeup), name=f"update-worker-{index}")
+            for index, (shard, wakeup) in enumerate(zip(self._shards, wakeups))
+        ]
+        return wakeups
+
+    def put(self, update_data, handler, *args):
+        """
+        Enqueues `handler(*args)` on the shard that owns the update's chat.
+        Returns False if that shard is full.
+        """
+        self._ensure_started()
+        chat_id = extract_chat_id(update_data)
+        shard_key = str(chat_id if chat_id is not None else update_data['update_id']).encode()
+        index = zlib.crc32(shard_key) % len(self._shards)
+        shard = self._shards[index]
+        with self._lock:
+            if len(shard) >= self._per_shard:
+                self.rejected += 1
+                return False
+            shard.append((time.monotonic(), handler, args))
+            self.enqueued += 1
+        background_loop.call_soon(self._wakeups[index].set)
+        return True
+
+    async def _worker(self, shard, wakeup):
+        while True:
+            await wakeup.wait()
+            wakeup.clear()
+            while shard:
+                with self._lock:
+                    enqueued_at, handler, args = shard.popleft()
+                started = time.monotonic()
+                self._record_wait(started - enqueued_at)
+                try:
+                    with self.app.app_context():
+                        await handler(*args)
+                    self.processed += 1
+                except Exception as e:
+                    self.failed += 1
+                    logging.error(f"--- Queued update failed: {e} ---", exc_info=True)
+                finally:
+                    self.last_run_time = time.monotonic() - started
+
+    def _record_wait(self, wait):
+        self.last_wait = wait
+        self.max_wait = max(self.max_wait, wait)
+        # Exponentially weighted so the gauge follows recent traffic.
+        self.avg_wait = wait if not self.avg_wait else 0.9 * self.avg_wait + 0.1 * wait
+
+    def depth(self):
+        return sum(len(shard) for shard in self._shards)
+
+    def stats(self):
+        return {
+            'mode': self.mode,
+            'workers': self.num_workers,
+            'depth': self.depth(),
+            'capacity': self.maxsize,
+            'enqueued': self.enqueued,
+            'processed': self.processed,
+            'failed': self.failed,
+            'rejected': self.rejected,
+            'wait_seconds_last': round(self.last_wait, 4),
+            'wait_seconds_avg': round(self.avg_wait, 4),
+            'wait_seconds_max': round(self.max_wait, 4),
+            'run_seconds_last': round(self.last_run_time, 4),
+        }
+
+    def shutdown(self, timeout=5.0):
+        """
+        Lets the workers drain what is already queued, then stops them.
+        Registered after the background loop's own hook, so it runs first.
+        """
+        if self._pid != os.getpid():
+            return
+        deadline = time.monotonic() + timeout
+        while self.depth() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        for task in self._tasks:
+            background_loop.call_soon(task.cancel)
+        self._pid = None
+
+
+update_queue = UpdateQueue()
+atexit.register(update_queue.shutdown)
@@ -0,0 +1,143 @@
+"""
+Serialized, batched commits for small writes.
+
+SQLite has one writer at a time, so request threads and the background loop
+committing tiny transactions side by side mostly wait on each other's locks.
+With the lane on (SQLITE_WRITE_LANE, on by default with the SQLite
+performance profile and ignored without it, since stock pysqlite breaks the
+lane's savepoints), small writes such as cart taps and persisted update ids
+go to one thread per worker. The thread runs whatever has queued up in one
+BEGIN IMMEDIATE transaction, at most SQLITE_WRITE_BATCH jobs at a time. Each
+job runs in its own savepoint, so a failing job only undoes itself, and
+callers block until their batch has committed. Nothing waits for a batch to
+fill: under light load a batch is a single job.
+
+Jobs run on the lane's own session, so they should take plain values and
+return plain values rather than ORM objects. With the lane off, `run` calls the
+job on the caller's session and commits it, as the callers did before.
+"""
+import concurrent.futures
+import logging
+import os
+import queue
+import threading
+
+from . import db
+
+
+class WriteLane:
+    def __init__(self, app=None):
+        self.app = None
+        self.enabled = False
+        self.batch_size = 64
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.jobs = 0
+        self.batches = 0
+        self.failed_jobs = 0
+        self.max_batch = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = bool(app.config.get('SQLITE_WRITE_LANE', False))
+        if self.enabled and not app.config.get('SQLITE_PERFORMANCE_PROFILE'):
+            logging.warning("--- SQLITE_WRITE_LANE needs SQLITE_PERFORMANCE_PROFILE=1; the write lane stays off. ---")
+            self.enabled = False
+        self.batch_size = max(1, int(app.config.get('SQLITE_WRITE_BATCH', 64)))
+        app.extensions['write_lane'] = self
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.SimpleQueue()
+            self._thread = threading.Thread(target=self._work, name="sqlite-write-lane", daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def run(self, fn, *args):
+        """
+        Runs `fn(*args)` in a committed transaction and returns its result.
+        Exceptions raised by `fn` or by the commit are re-raised here.
+        """
+        if not self.enabled:
+            try:
+                result = fn(*args)
+                db.session.commit()
+                return result
+            except Exception:
+                db.session.rollback()
+                raise
+
+        if threading.current_thread() is self._thread:
+            # Called from inside another job: join its batch.
+            return fn(*args)
+
+        self._ensure_started()
+        future = concurrent.futures.Future()
+        self._queue.put((fn, args, future))
+        return future.result()
+
+    def _work(self):
+        while True:
+            jobs = [self._queue.get()]
+            while len(jobs) < self.batch_size:
+                try:
+                    jobs.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with self.app.app_context():
+                    self._apply(jobs)
+            except Exception as e:
+                logging.error(f"--- Write lane batch failed: {e} ---", exc_info=True)
+                for _, _, future in jobs:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _apply(self, jobs):
+        # Take the write lock up front; see app/sqlite_profile.py.
+        db.session.connection(execution_options={'sqlite_begin': 'IMMEDIATE'})
+        outcomes = []
+        for fn, args, future in jobs:
+            try:
+                with db.session.begin_nested():
+                    outcomes.append((future, fn(*args), None))
+            except Exception as e:
+                self.failed_jobs += 1
+                outcomes.append((future, None, e))
+
+        try:
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            self.failed_jobs += sum(1 for _, _, error in outcomes if error is None)
+            outcomes = [(future, None, error or e) for future, _, error in outcomes]
+
+        self.jobs += len(jobs)
+        self.batches += 1
+        self.max_batch = max(self.max_batch, len(jobs))
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'queued': self._queue.qsize() if self._queue is not None else 0,
+            'jobs': self.jobs,
+            'batches': self.batches,
+            'failed_jobs': self.failed_jobs,
+            'max_batch': self.max_batch,
+        }
+
+
+write_lane = WriteLane()
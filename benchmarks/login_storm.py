@@ -0,0 +1,138 @@
+"""
+Webhook latency during a login storm.
+
+Starts the app on a threaded werkzeug server in this process, then measures
+the latency of Telegram webhook deliveries on their own and again while
+several clients hammer /api/login. It runs once per PASSWORD_HASH_WORKERS
+value (0 hashes on the request thread, as before the hashing pool existed).
+
+    python benchmarks/login_storm.py --hash-workers 0 2
+
+Each run uses a throwaway SQLite database, so it is safe to run anywhere.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EMAIL = 'storm@example.com'
+PASSWORD = 'correct horse battery staple'
+
+
+def post(url, body):
+    request = urllib.request.Request(url, data=json.dumps(body).encode(), headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request, timeout=30) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+def probe_webhook(base_url, seconds):
+    """
+    Sends webhook updates back to back for `seconds` and returns their latencies in ms.
+    """
+    latencies = []
+    deadline = time.monotonic() + seconds
+    update_id = 0
+    while time.monotonic() < deadline:
+        update_id += 1
+        started = time.perf_counter()
+        post(f"{base_url}/webhook/0:unknown", {'update_id': update_id, 'message': {'text': 'hi'}})
+        latencies.append((time.perf_counter() - started) * 1000)
+        time.sleep(0.005)
+    return latencies
+
+
+def storm(base_url, clients, stop, counts):
+    def login_loop():
+        while not stop.is_set():
+            status = post(f"{base_url}/api/login", {'email': EMAIL, 'password': PASSWORD})
+            counts[status] = counts.get(status, 0) + 1
+    threads = [threading.Thread(target=login_loop, daemon=True) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def run_once(args):
+    from werkzeug.serving import make_server
+    from app import create_app, db
+    from app.models import User
+
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        user = User(email=EMAIL)
+        user.set_password(PASSWORD)
+        db.session.add(user)
+        db.session.commit()
+
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+
+    quiet = probe_webhook(base_url, args.seconds)
+    stop, counts = threading.Event(), {}
+    threads = storm(base_url, args.clients, stop, counts)
+    loaded = probe_webhook(base_url, args.seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    server.shutdown()
+
+    print(json.dumps({
+        'hash_workers': int(os.environ['PASSWORD_HASH_WORKERS']),
+        'quiet_p50_ms': round(statistics.median(quiet), 2),
+        'quiet_p99_ms': round(percentile(quiet, 99), 2),
+        'storm_p50_ms': round(statistics.median(loaded), 2),
+        'storm_p99_ms': round(percentile(loaded, 99), 2),
+        'login_responses': counts,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--hash-workers', type=int, nargs='+', default=[0, 2])
+    parser.add_argument('--clients', type=int, default=16, help='concurrent login clients')
+    parser.add_argument('--seconds', type=float, default=5.0, help='duration of each measurement')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        sys.path.insert(0, ROOT)
+        run_once(args)
+        return
+
+    print(f"{'hash workers':>12} {'quiet p50':>10} {'quiet p99':>10} {'storm p50':>10} {'storm p99':>10}  logins")
+    for workers in args.hash_workers:
+        with tempfile.TemporaryDirectory() as tmp:
+            env = dict(
+                os.environ,
+                PASSWORD_HASH_WORKERS=str(workers),
+                DATABASE_URL=f"sqlite:///{os.path.join(tmp, 'bench.db')}",
+            )
+            output = subprocess.run(
+                [sys.executable, __file__, '--child', '--clients', str(args.clients), '--seconds', str(args.seconds)],
+                env=env, cwd=ROOT, check=True, capture_output=True, text=True,
+            ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(f"{workers:>12} {result['quiet_p50_ms']:>10} {result['quiet_p99_ms']:>10} "
+              f"{result['storm_p50_ms']:>10} {result['storm_p99_ms']:>10}  {result['login_responses']}")
+
+
+if __name__ == '__main__':
+    main()
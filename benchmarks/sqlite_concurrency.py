@@ -0,0 +1,146 @@
+"""
+SQLite throughput under concurrent workers, stock settings vs the performance profile.
+
+Forks several worker processes (like gunicorn workers), each running a few
+threads that mix cart writes (the add_cart path) with cart reads, against one
+shared SQLite file. Reports operations per second and how many operations
+failed with "database is locked". It runs once with the stock settings and
+once with SQLITE_PERFORMANCE_PROFILE=1, which also turns on the write lane.
+
+    python benchmarks/sqlite_concurrency.py --workers 4 --threads 4 --seconds 10
+
+Each run uses a throwaway database, so it is safe to run anywhere.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from sqlalchemy.exc import OperationalError
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CHATS = 200
+
+
+def seed():
+    from app import create_app, db
+    from app.models import Bot, Category, PriceTier, Product, User
+
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        user = User(email='bench@example.com', password_hash='-')
+        db.session.add(user)
+        db.session.flush()
+        bot = Bot(token='0:bench', wallet='-', user_id=user.id)
+        db.session.add(bot)
+        db.session.flush()
+        category = Category(name='c', bot_id=bot.id)
+        db.session.add(category)
+        db.session.flush()
+        product = Product(name='p', category_id=category.id)
+        db.session.add(product)
+        db.session.flush()
+        tiers = [PriceTier(label=str(i), price=i, product_id=product.id) for i in range(5)]
+        db.session.add_all(tiers)
+        db.session.commit()
+        return bot.id, [tier.id for tier in tiers]
+
+
+def worker(bot_id, tier_ids, args, results):
+    from app import create_app, db
+    from app.carts import write_cart
+    from app.models import Cart, CartItem
+    from app.write_lane import write_lane
+
+    app = create_app()
+    totals = {'writes': 0, 'reads': 0, 'locked': 0}
+    deadline = time.monotonic() + args.seconds
+
+    def run():
+        counts = {'writes': 0, 'reads': 0, 'locked': 0}
+        with app.app_context():
+            while time.monotonic() < deadline:
+                chat_id = str(random.randrange(CHATS))
+                try:
+                    if random.random() < args.write_ratio:
+                        write_lane.run(write_cart, bot_id, chat_id, {random.choice(tier_ids): 1})
+                        counts['writes'] += 1
+                    else:
+                        (CartItem.query.join(Cart)
+                         .filter(Cart.bot_id == bot_id, Cart.chat_id == chat_id).all())
+                        db.session.commit()
+                        counts['reads'] += 1
+                except OperationalError as e:
+                    db.session.rollback()
+                    if 'locked' not in str(e):
+                        raise
+                    counts['locked'] += 1
+        for key, value in counts.items():
+            totals[key] += value
+
+    threads = [threading.Thread(target=run) for _ in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.put(totals)
+
+
+def run_once(args):
+    bot_id, tier_ids = seed()
+    ctx = multiprocessing.get_context('fork')
+    results = ctx.Queue()
+    processes = [ctx.Process(target=worker, args=(bot_id, tier_ids, args, results)) for _ in range(args.workers)]
+    started = time.monotonic()
+    for process in processes:
+        process.start()
+    totals = {'writes': 0, 'reads': 0, 'locked': 0}
+    for _ in processes:
+        for key, value in results.get().items():
+            totals[key] += value
+    for process in processes:
+        process.join()
+    elapsed = time.monotonic() - started
+    print(json.dumps(dict(totals, ops_per_second=round((totals['writes'] + totals['reads']) / elapsed, 1))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--workers', type=int, default=4, help='worker processes')
+    parser.add_argument('--threads', type=int, default=4, help='threads per worker')
+    parser.add_argument('--seconds', type=float, default=10.0)
+    parser.add_argument('--write-ratio', type=float, default=0.5, help='share of operations that write')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        sys.path.insert(0, ROOT)
+        run_once(args)
+        return
+
+    print(f"{'profile':>8} {'ops/s':>9} {'writes':>8} {'reads':>8} {'locked':>8}")
+    for profile in ('0', '1'):
+        with tempfile.TemporaryDirectory() as tmp:
+            env = dict(
+                os.environ,
+                SQLITE_PERFORMANCE_PROFILE=profile,
+                DATABASE_URL=f"sqlite:///{os.path.join(tmp, 'bench.db')}",
+            )
+            output = subprocess.run(
+                [sys.executable, __file__, '--child', *sys.argv[1:]],
+                env=env, cwd=ROOT, check=True, capture_output=True, text=True,
+            ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(f"{'on' if profile == '1' else 'off':>8} {result['ops_per_second']:>9} "
+              f"{result['writes']:>8} {result['reads']:>8} {result['locked']:>8}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,48 @@
-from app import create_app, db
+import sys
+
+from app import create_app
+from app.schema import upgrade_schema
+from app.conversations import conversations
+from app.models import Order, SalesRollup
+from app import rollups
+from app.query_plans import check_query_plans
 
 app = create_app()
 
 # This adds our custom "init-db" command to the Flask CLI.
 @app.cli.command("init-db")
 def init_db_command():
-    """Creates the database tables."""
-    db.create_all()
-    print("Initialized the database.")
+    """Creates the database tables and adds any columns or indexes missing from older databases."""
+    added = upgrade_schema()
+    print(f"Initialized the database. Added columns and indexes: {', '.join(added) or 'none'}")
+    if conversations.backend == 'db':
+        # Orders that were already waiting on an address or note before conversation states existed.
+        print(f"Backfilled {conversations.backfill()} conversation states.")
+    if SalesRollup.query.first() is None and Order.query.first() is not None:
+        # First run since sales rollups were added.
+        print(f"Built {rollups.rebuild()} sales rollup rows.")
+
+@app.cli.command("rebuild-rollups")
+def rebuild_rollups_command():
+    """Recomputes the sales rollups from the orders table."""
+    print(f"Rebuilt {rollups.rebuild()} sales rollup rows.")
+
+@app.cli.command("check-query-plans")
+def check_query_plans_command():
+    """EXPLAINs the hot queries and fails if any of them scans a whole table."""
+    failed = 0
+    for name, details, scans in check_query_plans():
+        print(f"{'FULL SCAN' if scans else 'ok':9} {name}")
+        for line in details:
+            print(f"          {line}")
+        failed += bool(scans)
+    if failed:
+        print(f"{failed} hot queries scan a whole table.")
+        sys.exit(1)
 
 # This block is only for running the server on your local computer.
 if __name__ == '__main__':
     with app.app_context():
-        db.create_all()
+        upgrade_schema()
     app.run(host='0.0.0.0', port=5000, debug=True)
     
\ No newline at end of file